@@ -0,0 +1,387 @@
+"""
+drives full simulated games through the views and phase tasks and records per step
+the sql queries, wall time and channel messages sent
+
+redis is replaced by fakeredis, the channel layer by an in memory one and celery tasks are queued
+and run in order instead of going through the broker, countdowns expire right away.
+
+results are compared against benchmark_baselines.json (python manage.py benchmarkgame --write to update it)
+
+"""
+
+import gc
+import json
+import random
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from pathlib import Path
+from unittest import mock
+
+from channels.exceptions import ChannelFull
+from channels.layers import InMemoryChannelLayer, get_channel_layer
+from django.core.cache import cache
+from django.db import connection, transaction
+from django.test import override_settings
+from django.test.utils import CaptureQueriesContext
+from rest_framework.test import APIClient
+
+from . import services, state as game_state, tasks
+from .broadcast import loop_to_sync
+from .models import Game, Player
+from .outbox import unbatch
+from .services import get_phase_token
+from .state import GameState
+
+
+BASELINE_PATH = Path(__file__).resolve().parent / 'benchmark_baselines.json'
+
+PLAYER_COUNTS = (5, 8, 10)
+ASWANG_LIMITS = {5: 1, 6: 1, 7: 1, 8: 2, 9: 2, 10: 3}
+
+# wall time depends on the machine, only fail when it's way off the baseline
+TIME_TOLERANCE = 3
+TIME_SLACK_MS = 25
+
+MAX_STEPS = 300
+
+
+class CountingChannelLayer(InMemoryChannelLayer):
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.sent = []
+
+    async def send(self, channel, message):
+        self.sent.append((channel, message))
+        await super().send(channel, message)
+
+    async def group_send(self, group, message):
+        self.sent.append((group, message))
+
+        # same as InMemoryChannelLayer.group_send, without counting the message again for each channel of the group
+        self._clean_expired()
+        for channel in self.groups.get(group, set()):
+            try:
+                await InMemoryChannelLayer.send(self, channel, message)
+            except ChannelFull:
+                pass
+
+
+@contextmanager
+def stand_in_services(queue, expire_countdown, redis_client=None, channel_layer='game.benchmark.CountingChannelLayer'):
+
+    """
+    in memory channel layer, fakeredis and celery tasks handed to queue(name, args) instead of the broker,
+    started countdowns are handed to expire_countdown(code, duration, phase, token). yields the channel layer
+
+    """
+
+    def delay(name):
+        return lambda *args, **kwargs: queue(name, tuple(args))
+
+    def apply_async(name):
+        return lambda args=None, **kwargs: queue(name, tuple(args or ()))
+
+    # fakeredis is only in requirements-dev.txt, the image imports this module without it
+    import fakeredis
+
+    redis_client = redis_client or fakeredis.FakeStrictRedis(server=fakeredis.FakeServer())
+    async_redis_client = fakeredis.FakeAsyncRedis(server=redis_client.connection_pool.connection_kwargs['server'])
+    
+    # starts fakeredis' lua runtime up front, otherwise the first step that runs a script is charged for it
+    redis_client.eval('return 0', 0)
+
+    with override_settings(
+        CHANNEL_LAYERS={'default': {'BACKEND': channel_layer, 'CONFIG': {'capacity': 1000}}},
+        CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}},
+        GAME_TIMER_BACKEND='celery',
+        GAME_COUNTDOWN_MODE='ticks',
+        GAME_BROADCAST_BACKEND='async_to_sync', # the in memory layer is read from the caller's event loop
+    ):
+        layer = get_channel_layer()
+        cache.clear() # the locmem cache outlives the fakeredis server
+
+        with mock.patch.object(services, 'redis_client', redis_client), \
+             mock.patch.object(services, 'async_redis_client', async_redis_client), \
+             mock.patch.object(game_state, 'redis_client', redis_client), \
+             mock.patch.object(tasks, 'redis_client', redis_client), \
+             mock.patch.object(tasks, 'channel_layer', layer), \
+             mock.patch.object(tasks, 'start_room_countdown', expire_countdown), \
+             mock.patch.object(tasks.phaseInitialize, 'delay', delay('phaseInitialize')), \
+             mock.patch.object(tasks.phaseInitialize, 'apply_async', apply_async('phaseInitialize')), \
+             mock.patch.object(tasks.phaseCountdown, 'delay', delay('phaseCountdown')), \
+             mock.patch.object(tasks.phaseCountdown, 'apply_async', apply_async('phaseCountdown')), \
+             mock.patch.object(tasks.leaveDisconnectedPlayer, 'delay', delay('leaveDisconnectedPlayer')):
+
+            yield layer
+
+
+class GameSimulation:
+
+    def __init__(self, player_count, seed=1):
+        self.player_count = player_count
+        self.rng = random.Random(seed)
+        self.seed = seed
+        self.usernames = [f'bench{i}' for i in range(player_count)]
+        self.client = APIClient()
+        self.pending = deque() # queued celery tasks, (name, args)
+        self.results = {}
+        self.code = None
+
+    def queue(self, name, args):
+        self.pending.append((name, args))
+
+    def expire_countdown(self, code, duration, phase=None, token=None):
+        self.pending.append(('phaseInitialize', (code, token)))
+
+    def run(self):
+
+        random.seed(self.seed) # role assignment and room codes
+
+        with stand_in_services(self.queue, self.expire_countdown) as channel_layer:
+            self.channel_layer = channel_layer
+
+            # every game starts from the same empty tables
+            with transaction.atomic():
+                self.play()
+                transaction.set_rollback(True)
+
+        return self.results
+
+    def measure(self, func, *args):
+
+        self.channel_layer.sent = []
+
+        # like timeit, a garbage collection of the whole benchmark's objects isn't charged to the step it lands in
+        gc.disable()
+        try:
+            with CaptureQueriesContext(connection) as queries:
+                start = time.perf_counter()
+                result = func(*args)
+                elapsed = (time.perf_counter() - start) * 1000
+        finally:
+            gc.enable()
+
+        return result, {'queries': len(queries), 'messages': len(self.channel_layer.sent), 'time_ms': elapsed}
+
+    def record(self, name, metrics):
+
+        # worst call for queries and messages, time is averaged at the end
+        step = self.results.setdefault(name, {'calls': 0, 'queries': 0, 'messages': 0, 'time_ms': 0})
+        step['calls'] += 1
+        step['queries'] = max(step['queries'], metrics['queries'])
+        step['messages'] = max(step['messages'], metrics['messages'])
+        step['time_ms'] += metrics['time_ms']
+
+    def request(self, name, method, path, data):
+        response, metrics = self.measure(getattr(self.client, method), path, data, 'json')
+        self.record(name, metrics)
+        return response
+
+    def play(self):
+
+        for username in self.usernames:
+            Player.objects.create(username=username)
+
+        owner, *others = self.usernames
+        self.code = self.request('createRoom', 'post', '/game-api/create-room/', {'owner': owner}).data['code']
+
+        self.client.patch('/game-api/update-room/', {'code': self.code, 'update': 'update_room', 'limit': self.player_count}, format='json')
+        self.client.patch('/game-api/update-room/', {'code': self.code, 'update': 'update_aswang', 'limit': ASWANG_LIMITS[self.player_count]}, format='json')
+
+        for username in others:
+            self.request('joinRoom', 'post', '/game-api/join-room/', {'player': username, 'code': self.code})
+
+        self.request('startGameSession', 'post', '/game-api/start/', {'code': self.code})
+
+        steps = 0
+        while self.pending and steps < MAX_STEPS:
+            steps += 1
+            name, args = self.pending.popleft()
+
+            if name == 'phaseCountdown':
+                self.record('phaseCountdown', self.measure(tasks.phaseCountdown, *args)[1])
+                continue
+
+            token = get_phase_token(self.code)
+            metrics = self.measure(tasks.phaseInitialize, *args)[1]
+
+            # transitions with a stale token don't run, they are kept apart from the phase that ran
+            if get_phase_token(self.code) == token:
+                self.record('phaseInitialize_dropped', metrics)
+                continue
+
+            state = GameState.load(self.code)
+            self.record(f'phaseInitialize_{state.game_phase}', metrics)
+
+            if state.game_phase == 3:
+                self.play_night()
+            elif state.game_phase == 7:
+                self.vote(state)
+
+        # averages instead of totals so the baseline doesn't depend on how long the game took
+        for step in self.results.values():
+            step['time_ms'] = round(step['time_ms'] / step['calls'], 3)
+
+        game = Game.objects.get(room_code=self.code)
+        self.results['game'] = {'winners': game.winners, 'night_count': game.night_count, 'day_count': game.day_count}
+
+    def next_turn(self):
+        # role of the next player to select a target, the same way the frontend follows the turns
+        for group, message in reversed(self.channel_layer.sent):
+            if group != f'room_{self.code}':
+                continue
+            for data in reversed(unbatch(message.get('data', {}))):
+                if data.get('type') == 'update_roleTurn':
+                    return data['role']
+        return None
+
+    def play_night(self):
+
+        role = self.next_turn()
+
+        while role is not None:
+            state = GameState.load(self.code)
+
+            player = night_actor(state, role)
+
+            if player is None:
+                return
+
+            response = self.request('selectTarget', 'post', '/game-api/select-target/', {
+                'code': self.code,
+                'role': role,
+                'player': player.username,
+                'target': self.rng.choice(night_targets(state, player)).username,
+            })
+
+            if response.status_code != 200 or response.data.get('message') != 'OK':
+                return
+
+            role = self.next_turn()
+
+    def vote(self, state):
+
+        players = state.alive_players()
+
+        for player in players:
+            target = self.rng.choice([target for target in players if target.username != player.username])
+            self.request('votePlayer', 'patch', '/game-api/vote-player/', {
+                'code': self.code,
+                'player': player.username,
+                'vote_target': target.username,
+            })
+
+
+# what the players would do, shared with the load generator
+
+def night_actor(state, role):
+    # player whose turn it is
+    if role.startswith('aswang'):
+        return next((player for player in state.aswang_players() if player.role == role and not player.turn_done), None)
+    return state.find(role)
+
+def night_targets(state, player):
+    # aswang don't target each other
+    return [
+        target for target in state.alive_players()
+        if target.username != player.username and not (player.is_aswang and target.is_aswang)
+    ]
+
+
+
+# broadcast micro benchmark, the same group sends through async_to_sync and through the broadcast loop
+
+BROADCAST_BACKENDS = ('async_to_sync', 'loop')
+
+def run_broadcast_benchmark(sends=1000, threads=1, channel_layer='memory'):
+
+    """
+    sends group messages from threads (like gunicorn threads or celery workers would) with each backend,
+    returns per backend the mean and p99 time of a send in microseconds and the sends per second.
+    channel_layer 'memory' is an in memory layer, 'default' is the layer in the settings (channels_redis)
+
+    """
+
+    layers = {'memory': {'BACKEND': 'channels.layers.InMemoryChannelLayer', 'CONFIG': {'capacity': 1000}}}
+    results = {}
+
+    for backend in BROADCAST_BACKENDS:
+        with override_settings(GAME_BROADCAST_BACKEND=backend, **({'CHANNEL_LAYERS': {'default': layers['memory']}} if channel_layer == 'memory' else {})):
+            layer = get_channel_layer()
+            group = f'broadcast_benchmark_{backend}'
+
+            for player in range(10):
+                loop_to_sync(layer.group_add)(group, f'broadcast_benchmark.{player}')
+
+            message = {'type': 'send_message', 'data': {'type': 'countdown', 'countdown': 10}}
+            timings = []
+
+            def send(count):
+                for _ in range(count):
+                    start = time.perf_counter()
+                    loop_to_sync(layer.group_send)(group, message)
+                    timings.append(time.perf_counter() - start)
+
+            start = time.perf_counter()
+            workers = [threading.Thread(target=send, args=(sends // threads,)) for _ in range(threads)]
+            for worker in workers:
+                worker.start()
+            for worker in workers:
+                worker.join()
+            elapsed = time.perf_counter() - start
+
+            for player in range(10):
+                loop_to_sync(layer.group_discard)(group, f'broadcast_benchmark.{player}')
+
+            timings.sort()
+            results[backend] = {
+                'sends': len(timings),
+                'mean_us': round(sum(timings) / len(timings) * 1e6, 1),
+                'p99_us': round(timings[min(int(len(timings) * 0.99), len(timings) - 1)] * 1e6, 1),
+                'sends_per_second': round(len(timings) / elapsed),
+            }
+
+    return results
+
+
+def run_benchmark(player_counts=PLAYER_COUNTS, seed=1):
+    return {str(player_count): GameSimulation(player_count, seed).run() for player_count in player_counts}
+
+
+def load_baselines():
+    with open(BASELINE_PATH) as baseline_file:
+        return json.load(baseline_file)
+
+
+def write_baselines(results):
+    with open(BASELINE_PATH, 'w') as baseline_file:
+        json.dump(results, baseline_file, indent=4, sort_keys=True)
+        baseline_file.write('\n')
+
+
+def compare_with_baseline(results, baseline, timing=True):
+
+    # returns the steps that got slower than the baseline, fewer queries or messages are fine. the tests leave the
+    # times out (timing=False), they depend too much on the machine, benchmarkgame compares them
+    regressions = []
+
+    for name, step in results.items():
+        if name == 'game':
+            continue
+
+        expected = baseline.get(name)
+        if expected is None:
+            regressions.append(f'{name}: not in the baseline')
+            continue
+
+        for metric in ('queries', 'messages'):
+            if step[metric] > expected[metric]:
+                regressions.append(f'{name}: {step[metric]} {metric}, baseline is {expected[metric]}')
+
+        if timing and step['time_ms'] > max(expected['time_ms'] * TIME_TOLERANCE, expected['time_ms'] + TIME_SLACK_MS):
+            regressions.append(f"{name}: {step['time_ms']}ms, baseline is {expected['time_ms']}ms")
+
+    return regressions
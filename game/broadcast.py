@@ -0,0 +1,61 @@
+"""
+sync code (views, celery tasks) sends to the channel layer through one event loop per process running in a
+background thread, instead of async_to_sync setting up a loop bridge for every send. channels_redis keeps its
+connections per event loop, so they are reused from one send to the next as well
+
+    loop_to_sync(channel_layer.group_send)(f'room_{code}', {'type': 'send_message', 'data': data})
+
+GAME_BROADCAST_BACKEND = 'async_to_sync' goes back to async_to_sync, needed when the channel layer can't be
+used from another event loop (the in memory layer the consumers of the tests and benchmarks read from). the celery
+workers run with -P gevent, there the loop's thread is a greenlet and the waits on it yield to the other greenlets,
+async_to_sync can't be used from two greenlets at once (they share the os thread and its running loop)
+
+"""
+
+import asyncio
+import os
+import threading
+
+from asgiref.sync import async_to_sync
+from django.conf import settings
+
+
+class BroadcastLoop:
+
+    def __init__(self):
+        self.loop = None
+        self.pid = None
+        self.lock = threading.Lock()
+
+    def get_loop(self):
+
+        # a forked worker (celery prefork) doesn't have the thread of the process it was forked from
+        if self.loop is not None and self.pid == os.getpid():
+            return self.loop
+
+        with self.lock:
+            if self.loop is None or self.pid != os.getpid():
+                loop = asyncio.new_event_loop()
+                threading.Thread(target=loop.run_forever, name='broadcast-loop', daemon=True).start()
+                self.loop, self.pid = loop, os.getpid()
+
+        return self.loop
+
+    def run(self, coroutine):
+        # waits for the send so the messages of one caller keep their order and errors reach the caller
+        return asyncio.run_coroutine_threadsafe(coroutine, self.get_loop()).result()
+
+
+broadcast_loop = BroadcastLoop()
+
+
+def loop_to_sync(func):
+
+    # same as async_to_sync(func), the coroutine runs on the broadcast loop
+    if settings.GAME_BROADCAST_BACKEND == 'async_to_sync':
+        return async_to_sync(func)
+
+    def run(*args, **kwargs):
+        return broadcast_loop.run(func(*args, **kwargs))
+
+    return run
@@ -0,0 +1,252 @@
+import asyncio
+import heapq
+import itertools
+import time
+
+from django.conf import settings
+from channels.layers import get_channel_layer
+from asgiref.sync import sync_to_async
+
+from .broadcast import loop_to_sync
+from .services import set_room_timer, clear_room_timer, schedule_phase_deadline, cancel_phase_deadline, claim_phase_deadline, claim_due_phase_deadlines
+
+
+class RoomClock:
+
+    """
+    one event loop that keeps the countdown of every room in a single heap of deadlines
+
+    each heap entry is the next second a room has to be updated, when an entry is due the clock sends
+    the remaining time to room_{code} and pushes the next tick back into the heap. once the deadline is
+    reached the clock fires phaseInitialize for that room, the same way the end of countdown_timer does.
+
+    rooms started without ticks (GAME_COUNTDOWN_MODE = 'deadline') only get a single heap entry on their deadline,
+    the clients render the countdown themselves from the phase_deadline message.
+
+    """
+
+    def __init__(self, channel_layer=None):
+        self.channel_layer = channel_layer or get_channel_layer()
+        self.heap = [] # (tick time, timer id, room code)
+        self.rooms = {} # room code -> (deadline, timer id, phase token), the timer id drops ticks of cancelled/replaced countdowns
+        self.timer_ids = itertools.count()
+        self.wakeup = None
+
+    def now(self):
+        return asyncio.get_running_loop().time()
+
+    def start(self, code, duration, ticks=True, token=None):
+
+        now = self.now()
+        timer_id = next(self.timer_ids)
+        deadline = now + int(duration)
+
+        # starting a countdown for a room that already has one replaces it
+        self.rooms[code] = (deadline, timer_id, token)
+        heapq.heappush(self.heap, (now if ticks else deadline, timer_id, code))
+
+        if self.wakeup is not None:
+            self.wakeup.set()
+
+    def cancel(self, code):
+
+        # stale heap entries are skipped once they are popped
+        self.rooms.pop(code, None)
+
+    async def tick(self, now):
+
+        countdowns = []
+        expired = []
+
+        while self.heap and self.heap[0][0] <= now:
+            when, timer_id, code = heapq.heappop(self.heap)
+            room = self.rooms.get(code)
+
+            if room is None or room[1] != timer_id:
+                continue
+
+            # use the scheduled time instead of the current time so the ticks don't drift
+            remaining = round(room[0] - when)
+
+            if remaining > 0:
+                countdowns.append(self.send_countdown(code, remaining))
+
+                # skip the seconds that were missed if the loop fell behind
+                next_tick = when + 1
+                while next_tick <= now:
+                    next_tick += 1
+
+                heapq.heappush(self.heap, (next_tick, timer_id, code))
+            else:
+                del self.rooms[code]
+                expired.append((code, room[2]))
+
+        # every room due on this second is sent at the same time instead of one after the other
+        await asyncio.gather(*countdowns, *[self.expire(code, token) for code, token in expired], return_exceptions=True)
+
+    async def send_countdown(self, code, remaining):
+
+        await self.channel_layer.group_send(
+            f'room_{code}',
+            {
+                'type': 'send_message',
+                'data': {
+                    'type': 'countdown',
+                    'countdown': remaining
+                }
+            }
+        )
+
+    async def expire(self, code, token=None):
+        await sync_to_async(expire_phase_deadline)(code, token)
+
+    async def listen(self):
+
+        while True:
+            message = await self.channel_layer.receive(settings.ROOM_CLOCK_CHANNEL)
+
+            if message['type'] == 'clock.start':
+                self.start(message['code'], message['duration'], message.get('ticks', True), message.get('token'))
+
+            elif message['type'] == 'clock.cancel':
+                self.cancel(message['code'])
+
+    async def run(self, listen=True):
+
+        # the game engine hands the clock its messages itself (listen=False)
+        self.wakeup = asyncio.Event()
+        listener = asyncio.create_task(self.listen()) if listen else None
+
+        try:
+            while True:
+                await self.tick(self.now())
+
+                timeout = max(self.heap[0][0] - self.now(), 0) if self.heap else None
+                self.wakeup.clear()
+
+                try:
+                    await asyncio.wait_for(self.wakeup.wait(), timeout)
+                except asyncio.TimeoutError:
+                    pass
+        finally:
+            if listener is not None:
+                listener.cancel()
+
+
+def start_room_countdown(code, duration, phase=None, token=None):
+
+    ticks = settings.GAME_COUNTDOWN_MODE == 'ticks'
+
+    # kept in redis before the countdown starts, if the countdown gets lost the phase still ends
+    if token is not None:
+        schedule_phase_deadline(code, token, duration)
+
+    if not ticks:
+        send_phase_deadline(code, duration, phase)
+
+    if settings.GAME_ENGINE == 'actor':
+        # imported here since the engine imports this module
+        from .engine import send_to_engine
+
+        send_to_engine({'type': 'clock.start', 'code': code, 'duration': int(duration), 'ticks': ticks, 'token': token})
+    elif settings.GAME_TIMER_BACKEND == 'clock':
+        loop_to_sync(get_channel_layer().send)(
+            settings.ROOM_CLOCK_CHANNEL,
+            {
+                'type': 'clock.start',
+                'code': code,
+                'duration': int(duration),
+                'ticks': ticks,
+                'token': token
+            }
+        )
+    elif ticks:
+        # fallback, one celery task per second
+        from .tasks import countdown_timer
+
+        countdown_timer.apply_async(args=[code, duration, set_room_timer(code), token])
+    else:
+        # nothing to send every second, only the end of the phase has to be scheduled
+        from .tasks import countdown_expired
+
+        countdown_expired.apply_async(args=[code, set_room_timer(code), token], countdown=int(duration))
+
+
+def cancel_room_countdown(code, phase=None):
+
+    cancel_phase_deadline(code)
+
+    if settings.GAME_ENGINE == 'actor':
+        from .engine import send_to_engine
+
+        send_to_engine({'type': 'clock.cancel', 'code': code})
+    elif settings.GAME_TIMER_BACKEND == 'clock':
+        loop_to_sync(get_channel_layer().send)(
+            settings.ROOM_CLOCK_CHANNEL,
+            {
+                'type': 'clock.cancel',
+                'code': code,
+            }
+        )
+    else:
+        clear_room_timer(code)
+
+    # clients rendering the countdown locally have to drop the old deadline
+    if settings.GAME_COUNTDOWN_MODE != 'ticks':
+        send_phase_deadline(code, 0, phase, correction=True)
+
+
+def send_phase_deadline(code, duration, phase=None, correction=False):
+
+    """
+    single message the clients render the countdown from, sent once per phase instead of a countdown message every second
+
+    deadline and server_time are epoch seconds, clients use server_time to work out their clock offset from the server.
+    correction is set when a running countdown is cut short, the new deadline replaces the old one
+
+    """
+
+    server_time = time.time()
+
+    loop_to_sync(get_channel_layer().group_send)(
+        f'room_{code}',
+        {
+            'type': 'send_message',
+            'data': {
+                'type': 'phase_deadline',
+                'phase': phase,
+                'duration': int(duration),
+                'deadline': server_time + int(duration),
+                'server_time': server_time,
+                'correction': correction
+            }
+        }
+    )
+
+
+def expire_phase_deadline(code, token=None):
+
+    # the countdown ended, the transition runs unless the deadline poller already ran it
+    # (imported here since tasks imports this module)
+    from .tasks import phaseInitialize
+
+    if token is None or claim_phase_deadline(code, token):
+        phaseInitialize.delay(code, token)
+
+
+def poll_phase_deadlines():
+
+    """
+    ends the phases whose deadline passed PHASE_DEADLINE_GRACE seconds ago without their countdown ending them,
+    each deadline is claimed atomically so any number of pollers can run. returns the (code, token) it ended
+
+    """
+
+    from .tasks import phaseInitialize
+
+    deadlines = claim_due_phase_deadlines()
+
+    for code, token in deadlines:
+        phaseInitialize.delay(code, token)
+
+    return deadlines
@@ -1,18 +1,27 @@
 import json
+import asyncio
+import time
 from asgiref.sync import sync_to_async, async_to_sync
-from django.shortcuts import get_object_or_404
-from django.db.models import Q
+from django.conf import settings
 
-from game.models import Game, Player
-from game.serializers import PlayersInLobby
-from game.tasks import checkDisconnectedRole
-from game.services import get_player_status, set_player_connected, set_player_disconnected, get_player_status_non_sync
+from game.tasks import leaveDisconnectedPlayer
+from game.views import GAME_ACTIONS, runGameAction
+from game.engine import send_to_engine_async
+from game.protocol import MSGPACK_SUBPROTOCOL, encode_frame, decode_frame
+from game.services import get_player_status, get_player_presence, set_player_connected, set_player_disconnected, get_roster, update_roster, get_roster_non_sync, get_room_players
 
-from channels.exceptions import StopConsumer
+from channels.db import database_sync_to_async
 from channels.generic.websocket import AsyncJsonWebsocketConsumer
 
+# leaves waiting out the reconnect grace window in this process, (code, username) -> task
+pending_leaves = {}
+
+
 class GameRoomConsumer(AsyncJsonWebsocketConsumer):
     
+    heartbeat_task = None
+    msgpack = False
+    
     async def connect(self):
         
         try:
@@ -34,23 +43,32 @@ class GameRoomConsumer(AsyncJsonWebsocketConsumer):
             print(f'Error: {e}')
             return None
         
-            
+        
         if player_status == "disconnected":
-            # Player is reconnecting after a refresh, do not remove them from the game
-            await set_player_connected(self.user, self.group_code)
-        else:
-            # New connection or a proper disconnect
-            await self.channel_layer.group_add(
-                self.room_code,
-                self.channel_name # this will be created automatically for each user
-            )
-            
-            await self.channel_layer.group_add(
-                self.player_room_code,
-                self.channel_name    
-            )
+            # Player is reconnecting after a refresh or a network drop, do not remove them from the game
+            # (a leave scheduled by another process is cancelled by the presence update below)
+            leave = pending_leaves.pop((self.group_code, self.user), None)
+            if leave is not None:
+                leave.cancel()
+        
+        await self.channel_layer.group_add(
+            self.room_code,
+            self.channel_name # this will be created automatically for each user
+        )
+        
+        await self.channel_layer.group_add(
+            self.player_room_code,
+            self.channel_name    
+        )
 
-            await self.accept()
+        # clients that ask for the msgpack subprotocol get binary frames, everyone else json
+        self.msgpack = MSGPACK_SUBPROTOCOL in self.scope.get('subprotocols', [])
+        await self.accept(subprotocol=MSGPACK_SUBPROTOCOL if self.msgpack else None)
+        
+        await set_player_connected(self.user, self.group_code)
+        
+        self.last_seen = time.monotonic()
+        self.heartbeat_task = asyncio.create_task(self.heartbeat())
         
         # Send the message on connect (e.g., player joining)
         await self._send_message_on_connect()
@@ -59,47 +77,77 @@ class GameRoomConsumer(AsyncJsonWebsocketConsumer):
     
     async def disconnect(self, code):
         """
-        end the game if user disconnects (leaves the game completely not refreshin) while it is still ongoing
+        the player is only removed from the game (leaves the game completely, not refreshing) if they don't
+        reconnect within PLAYER_RECONNECT_GRACE seconds
         """
         
-        self.player_status = await get_player_status(username=self.user, code=self.group_code)
-        self.game = await self.userDisconnectInGame(code=self.group_code, user=self.user)
+        if self.heartbeat_task is not None:
+            self.heartbeat_task.cancel()
         
-        if self.player_status == 'disconnected':
-            await set_player_disconnected(self.user, self.group_code)
+        await self.channel_layer.group_discard(self.room_code, self.channel_name)
+        await self.channel_layer.group_discard(self.player_room_code, self.channel_name)
+        
+        disconnected_at = await set_player_disconnected(self.user, self.group_code)
+        
+        leave = asyncio.create_task(self.leaveAfterGrace(disconnected_at))
+        pending_leaves[(self.group_code, self.user)] = leave
+    
+    async def leaveAfterGrace(self, disconnected_at):
+        
+        key = (self.group_code, self.user)
+        
+        try:
+            await asyncio.sleep(settings.PLAYER_RECONNECT_GRACE)
             
-        else:
-            if self.game:
-                await self.channel_layer.group_discard(self.room_code, self.channel_name)
-                await self.channel_layer.group_discard(self.player_room_code, self.channel_name)
-                
-                await checkDisconnectedRole(user=self.user, code=self.group_code)
-                
-                # notify other users who left and updating player list to change UI
-                self.players = await self.getPlayersInLobby(self.group_code)
-                data = {
-                            "type": "update_player_list",
-                            "message": f'{self.user} left the lobby',
-                            "sender": "SERVER",
-                            "players": self.players
-                        }
-                await self.channel_layer.group_send(
-                    self.room_code,
-                    {
-                        "type": "send_message",
-                        "data": data
-                    }
-                )
-                raise StopConsumer()
-            else:
-                pass
+            # reconnected in the meantime (maybe to another process), or disconnected again which scheduled a newer leave
+            if await get_player_presence(self.user, self.group_code) != ('disconnected', disconnected_at):
+                return
+            
+            # removing the player and handing over their role is done by a worker, nothing here blocks the event loop
+            # (not thread sensitive, the broker round trip doesn't wait behind the database calls of other consumers)
+            await sync_to_async(leaveDisconnectedPlayer.delay, thread_sensitive=False)(self.user, self.group_code)
+        finally:
+            if pending_leaves.get(key) is asyncio.current_task():
+                del pending_leaves[key]
+    
+    async def heartbeat(self):
+        
+        # application level ping, a socket that stops answering is closed (which starts the grace window)
+        while True:
+            await asyncio.sleep(settings.PLAYER_HEARTBEAT_INTERVAL)
+            
+            if time.monotonic() - self.last_seen > settings.PLAYER_HEARTBEAT_TIMEOUT:
+                await self.close()
+                return
+            
+            await self.send_json({'type': 'ping'})
     
     async def send_update_message(self, event):
         await self.send_json(event['data'])
         
 
-    async def receive(self, text_data):
-        text_data_json = json.loads(text_data)
+    async def receive(self, text_data=None, bytes_data=None):
+        text_data_json = decode_frame(bytes_data) if bytes_data is not None else json.loads(text_data)
+        self.last_seen = time.monotonic()
+        
+        if text_data_json.get('type') == 'pong':
+            # keeps the player's presence fresh for the reaper
+            await set_player_connected(self.user, self.group_code)
+            return
+        
+        if text_data_json.get('type') == 'ping':
+            await self.send_json({'type': 'pong'})
+            return
+        
+        if text_data_json.get('type') in GAME_ACTIONS:
+            await self.runAction(text_data_json)
+            return
+        
+        if text_data_json.get('type') == 'roster_sync':
+            # the client missed a roster_delta, it only gets the whole roster again if its version is behind
+            await self.sendRoster(text_data_json.get('version'))
+            return
+        
         print(text_data_json)
         message = text_data_json['message']
         sender = text_data_json['sender']
@@ -116,75 +164,81 @@ class GameRoomConsumer(AsyncJsonWebsocketConsumer):
             event
         )
         
+    async def runAction(self, message):
+        
+        # the client matches the acknowledgement to its action by the id it sent
+        ack = {'type': 'ack', 'id': message.get('id'), 'action': message['type']}
+        arguments = {field: value for field, value in message.items() if field not in ('type', 'id')}
+        
+        if settings.GAME_ENGINE == 'actor':
+            # in turn with the phases of the room on its actor, the engine sends the acknowledgement to this socket
+            await send_to_engine_async({
+                'type': 'engine.action',
+                'code': self.group_code,
+                'action': message['type'],
+                'username': self.user,
+                'arguments': arguments,
+                'reply_channel': self.channel_name,
+                'ack': ack,
+            })
+            return
+        
+        await self.send_json(dict(ack, **await database_sync_to_async(runGameAction)(message['type'], self.group_code, self.user, arguments)))
+    
     async def send_message(self, event):
         # Should be called by group_send only
         await self.send_json(event["data"])
         
     async def _send_message_on_connect(self):
+        # only the player who connected gets the roster, the others were sent a roster_delta when they joined the room
+        await self.sendRoster(message=f'{self.user} has joined the lobby')
+    
+    async def sendRoster(self, client_version=None, message=None):
         
         try:
-            self.players = await self.getPlayersInLobby(self.group_code)
+            roster = await get_roster(self.group_code)
+            if roster is None:
+                roster = await self.getPlayersInLobby(self.group_code)
         except Exception as e:
-            self.players = []
-            
-            
+            print(f'Error: {e}')
+            roster = (0, [])
+        
+        version, players = roster
+        if client_version == version:
+            return
+        
         data = {
             "type": "player_list",
-            "players": self.players,
-            'sender': 'SERVER',
-            'message': f'{self.user} has joined the lobby'
+            "version": version,
+            "players": players,
         }
         
-        await self.channel_layer.group_send(
-            self.room_code,
-            {
-                "type": "send_message",
-                "data": data
-            }
-        )
+        if message is not None:
+            data['sender'] = 'SERVER'
+            data['message'] = message
+        
+        await self.send_json(data)
         
     
     # function name must be the same name as the event type
     async def chat_message(self, event):
         
-        await self.send(text_data=json.dumps({
+        await self.send_json({
             'type': event['type'],
             'message': event['message'],
             'sender': event['sender']
-        }))
-        
-    @sync_to_async
-    def getPlayersInLobby(self, code):
-        
-        try:
-            game = Game.objects.get(room_code=code)
-            playerList = PlayersInLobby(game.players.filter(
-                Q(alive=True) & Q(eliminated_from_game=False)
-            ), many=True).data
-        
-        except:
-           playerList = [] 
-        
-            
-        return playerList 
+        })
     
-    @sync_to_async
-    def userDisconnectInGame(self, code, user):
+    async def send_json(self, content, close=False):
+        if self.msgpack:
+            await self.send(bytes_data=encode_frame(content), close=close)
+        else:
+            await super().send_json(content, close)
         
-        player_status = get_player_status(username=user, code=code)
-        try:
-            game = get_object_or_404(Game, room_code=code)
-            
-        except Game.DoesNotExist:
-            return False
+    @database_sync_to_async
+    def getPlayersInLobby(self, code):
         
-        player = Player.objects.get(username=user)
-        if player.in_game and not game.has_ended and player_status == 'connected':
+        # the room has no roster yet (or it expired), it is built from the cached players of the room
+        update_roster(code, get_room_players(code), replace=True)
             
-            game.players.remove(player)
-            game.save()
-            return True
-            
-        else:
-            return False
-
+        return get_roster_non_sync(code) or (0, [])
@@ -0,0 +1,311 @@
+"""
+optional game engine (GAME_ENGINE = 'actor'), every active room is an asyncio actor in the event loop of a daphne
+process, next to the consumers of the room's sockets
+
+the room tasks (phaseInitialize, phaseCountdown, ...) and the game actions of a room (from its sockets and from the
+rest endpoints) go to its actor instead of the celery broker and run one at a time in the order they were sent, the
+countdowns of every room are kept by a room clock in the same event loop. everything reaches the engine through
+ROOM_ENGINE_CHANNEL, or straight from the consumers when the engine runs in their process.
+
+every daphne process takes part in the engine lease (room_engine_owner, see RoomEngineHost in kutob_backend/asgi.py),
+only the one holding it reads the channel so a room never has actors in two processes. another daphne process takes
+over when the lease of the first one runs out. room tasks sent with a countdown are kept by the engine's loop, if the
+engine goes away before they are due the phase deadlines (runphasedeadlines) still end the phase
+
+the game state stays in redis (GameState) so the views of the other processes keep reading and changing it,
+the actor owns the order of the room's work and its timers. with GAME_ENGINE = 'celery' nothing here runs
+
+"""
+
+import asyncio
+import inspect
+import sys
+import uuid
+
+from asgiref.sync import sync_to_async
+from celery import Task
+from channels.layers import get_channel_layer
+from django.conf import settings
+
+from . import services
+from .broadcast import loop_to_sync
+from .clock import RoomClock
+from .mailbox import room_tasks, run_as_room
+
+
+ENGINE_LEASE_KEY = 'room_engine_owner'
+
+# the lease is only renewed by the process that has it
+renew_lease_script = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('PEXPIRE', KEYS[1], ARGV[2])
+end
+return 0
+"""
+
+release_lease_script = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('DEL', KEYS[1])
+end
+return 0
+"""
+
+
+class RoomActor:
+
+    def __init__(self, engine, code):
+        self.engine = engine
+        self.code = code
+        self.queue = asyncio.Queue() # (function, args, kwargs, future of its result or None)
+        self.task = asyncio.create_task(self.run())
+
+    async def run(self):
+
+        while True:
+            try:
+                func, args, kwargs, future = await asyncio.wait_for(self.queue.get(), settings.GAME_ENGINE_ROOM_IDLE)
+            except asyncio.TimeoutError:
+                # nothing happened in the room for a while, a new actor is started if it gets work again
+                if self.queue.empty():
+                    self.engine.rooms.pop(self.code, None)
+                    return
+                continue
+
+            try:
+                # off the event loop so the sockets of every room keep being served, the next task of the room waits for it
+                # the actor already runs the room's work one at a time, room tasks called from func skip the mailbox
+                result = await sync_to_async(run_as_room, thread_sensitive=False)(self.code, func, args, kwargs)
+            except Exception as e:
+                if future is None:
+                    print(f'Error: {e}')
+                elif not future.done():
+                    future.set_exception(e)
+            else:
+                if future is not None and not future.done():
+                    future.set_result(result)
+
+
+class GameEngine:
+
+    def __init__(self):
+        self.rooms = {} # room code -> RoomActor
+        self.loop = None
+        self.clock = None
+        self.tasks = []
+        self.timers = set() # room tasks waiting for their countdown
+        self.owner = uuid.uuid4().hex
+
+    async def run(self):
+
+        # hosts the engine while this process has the lease, waits to take it over otherwise
+        while True:
+            if await services.async_redis_client.set(ENGINE_LEASE_KEY, self.owner, nx=True, px=int(settings.ROOM_ENGINE_LEASE_TTL * 1000)):
+                self.start()
+                try:
+                    await self.keep_lease()
+                finally:
+                    self.stop()
+                    await services.async_redis_client.eval(release_lease_script, 1, ENGINE_LEASE_KEY, self.owner)
+
+            await asyncio.sleep(settings.ROOM_ENGINE_LEASE_TTL / 3)
+
+    async def keep_lease(self):
+
+        # returns when the lease was lost (e.g. this process was stuck for longer than the lease)
+        while True:
+            await asyncio.sleep(settings.ROOM_ENGINE_LEASE_TTL / 3)
+            if not await services.async_redis_client.eval(renew_lease_script, 1, ENGINE_LEASE_KEY, self.owner, int(settings.ROOM_ENGINE_LEASE_TTL * 1000)):
+                print('Error: the room engine lost its lease, another process hosts the rooms now')
+                return
+
+    def start(self):
+
+        # called from the event loop of the process that hosts the engine (see run), only starts once
+        if self.running_here():
+            return
+
+        self.loop = asyncio.get_running_loop()
+        self.channel_layer = get_channel_layer()
+        self.clock = RoomClock(self.channel_layer)
+        self.tasks = [
+            asyncio.create_task(self.clock.run(listen=False)),
+            asyncio.create_task(self.listen()),
+        ]
+
+    def stop(self):
+
+        # the room tasks still waiting for their countdown go too, the process that takes over the lease doesn't
+        # have them but the phase deadlines still end the phases they would have ended
+        for task in self.tasks + list(self.timers) + [actor.task for actor in self.rooms.values()]:
+            task.cancel()
+
+        self.rooms = {}
+        self.tasks = []
+        self.timers = set()
+        self.loop = None
+
+    def running_here(self):
+        return self.loop is not None and self.loop.is_running()
+
+    def submit(self, code, name, args=(), kwargs=None):
+        self.enqueue(code, room_tasks[name], args, kwargs)
+
+    def submit_later(self, delay, code, name, args=(), kwargs=None):
+
+        def due():
+            self.timers.discard(timer)
+            self.submit(code, name, args, kwargs)
+
+        timer = self.loop.call_later(delay, due)
+        self.timers.add(timer)
+
+    def enqueue(self, code, func, args=(), kwargs=None, future=None):
+
+        actor = self.rooms.get(code)
+        if actor is None:
+            actor = self.rooms[code] = RoomActor(self, code)
+
+        actor.queue.put_nowait((func, tuple(args), kwargs or {}, future))
+
+    async def call(self, code, func, *args, **kwargs):
+
+        # runs func in turn with the rest of the room's work and returns what it returned (from the engine's loop)
+        future = self.loop.create_future()
+        self.enqueue(code, func, args, kwargs, future)
+        return await future
+
+    def handle(self, message):
+
+        if message['type'] == 'engine.task':
+            if message.get('countdown'):
+                self.submit_later(message['countdown'], message['code'], message['task'], message['args'], message.get('kwargs'))
+            else:
+                self.submit(message['code'], message['task'], message['args'], message.get('kwargs'))
+
+        elif message['type'] == 'engine.action':
+            asyncio.create_task(self.run_action(message))
+
+        elif message['type'] == 'clock.start':
+            self.clock.start(message['code'], message['duration'], message.get('ticks', True), message.get('token'))
+
+        elif message['type'] == 'clock.cancel':
+            self.clock.cancel(message['code'])
+
+    async def run_action(self, message):
+
+        # imported here since the views import the tasks, which import this module
+        from .views import runGameAction
+
+        ack = await self.call(message['code'], runGameAction, message['action'], message['code'], message['username'], message['arguments'])
+
+        # back to the socket or the rest request that sent the action
+        await self.channel_layer.send(message['reply_channel'], {'type': 'send_message', 'data': dict(message['ack'], **ack)})
+
+    async def listen(self):
+
+        while True:
+            message = await self.channel_layer.receive(settings.ROOM_ENGINE_CHANNEL)
+            self.handle(message)
+
+
+engine = GameEngine()
+
+
+class RoomEngineHost:
+
+    """
+    asgi application wrapper that runs the engine's lease loop (GameEngine.run) in the event loop of the daphne
+    process, started with daphne's reactor or by the first connection of a server without one
+
+    """
+
+    def __init__(self, application):
+        self.application = application
+        self.lease = None
+
+        # daphne runs twisted's asyncio reactor, the callback runs once its loop is running
+        reactor = sys.modules.get('twisted.internet.reactor')
+        if settings.GAME_ENGINE == 'actor' and reactor is not None:
+            reactor.callLater(0, self.start)
+
+    def start(self):
+        if self.lease is None:
+            self.lease = asyncio.get_running_loop().create_task(engine.run())
+
+    async def __call__(self, scope, receive, send):
+        if settings.GAME_ENGINE == 'actor':
+            self.start()
+        return await self.application(scope, receive, send)
+
+
+def send_to_engine(message):
+
+    # straight to the engine when it runs in this process, through the channel layer otherwise
+    if engine.running_here():
+        engine.loop.call_soon_threadsafe(engine.handle, message)
+    else:
+        loop_to_sync(get_channel_layer().send)(settings.ROOM_ENGINE_CHANNEL, message)
+
+
+async def send_to_engine_async(message):
+
+    if engine.running_here():
+        engine.loop.call_soon_threadsafe(engine.handle, message)
+    else:
+        await get_channel_layer().send(settings.ROOM_ENGINE_CHANNEL, message)
+
+
+def call_engine_action(name, code, username, arguments):
+
+    """
+    runs a game action on the actor of its room and waits for its acknowledgement, for the rest endpoints
+    (served outside of daphne). returns the same as runGameAction
+
+    """
+
+    channel_layer = get_channel_layer()
+
+    async def call():
+        reply_channel = await channel_layer.new_channel()
+        await send_to_engine_async({
+            'type': 'engine.action',
+            'code': code,
+            'action': name,
+            'username': username,
+            'arguments': arguments,
+            'reply_channel': reply_channel,
+            'ack': {},
+        })
+        reply = await asyncio.wait_for(channel_layer.receive(reply_channel), settings.ROOM_ENGINE_REPLY_TIMEOUT)
+        return reply['data']
+
+    try:
+        return loop_to_sync(call)()
+    except asyncio.TimeoutError:
+        print(f'Error: the room engine did not answer {name} of room {code}')
+        return {'status': 503, 'message': 'Game engine is not available'}
+
+
+class RoomTask(Task):
+
+    """
+    celery task that goes to the actor of its room instead of the broker when GAME_ENGINE = 'actor'
+
+    """
+
+    def apply_async(self, args=None, kwargs=None, countdown=None, **options):
+
+        if settings.GAME_ENGINE != 'actor':
+            return super().apply_async(args, kwargs, countdown=countdown, **options)
+
+        name = self.run.__name__
+        args, kwargs = tuple(args or ()), kwargs or {}
+        code = inspect.signature(room_tasks[name]).bind(*args, **kwargs).arguments['code']
+
+        message = {'type': 'engine.task', 'code': code, 'task': name, 'args': list(args), 'kwargs': kwargs}
+
+        # the engine's loop waits for the countdown instead of the broker
+        if countdown:
+            message['countdown'] = countdown
+
+        send_to_engine(message)
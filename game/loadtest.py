@@ -0,0 +1,332 @@
+"""
+headless load generator, plays many games at once against the real views, phase tasks and consumers
+
+every room gets one websocket client per player (connected through the channels test communicator)
+and its players act through the rest endpoints like the frontend would. redis is stood in by fakeredis,
+the channel layer is in memory and the celery tasks run in one worker thread in the order they are queued.
+countdowns really wait, scaled by time_scale so a game doesn't take minutes
+
+reports the message latency (group_send until the consumer sends it to the socket), the phase transition
+jitter (countdown deadline until the next phase was sent), rest latency and worker/redis throughput
+
+"""
+
+import asyncio
+import random
+import time
+from dataclasses import dataclass, field
+
+from asgiref.sync import sync_to_async
+from channels.layers import InMemoryChannelLayer
+from channels.routing import URLRouter
+from channels.testing import WebsocketCommunicator
+from django.urls import path
+from rest_framework.test import APIClient
+
+from . import tasks
+from .benchmark import ASWANG_LIMITS, stand_in_services, night_actor, night_targets
+from .consumers import GameRoomConsumer
+from .models import Player
+from .outbox import unbatch
+from .services import get_phase_token
+from .state import GameState
+
+
+class LoadChannelLayer(InMemoryChannelLayer):
+
+    """
+    stamps every group message with the time it was sent and keeps the last turn announced in each room,
+    the players follow the turns the same way the frontend does
+
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.messages = 0
+        self.turns = {}
+
+    async def group_send(self, group, message):
+        self.messages += 1
+
+        for data in unbatch(message.get('data') or {}):
+            if data.get('type') == 'update_roleTurn':
+                self.turns[group] = data['role']
+
+        await super().group_send(group, dict(message, sent_at=time.perf_counter()))
+
+
+def counting_redis():
+
+    # fakeredis is only in requirements-dev.txt, imported when a load test runs
+    import fakeredis
+
+    class CountingRedis(fakeredis.FakeStrictRedis):
+
+        # counts the calls to redis, a pipeline counts once
+        def __init__(self, *args, **kwargs):
+            super().__init__(*args, **kwargs)
+            self.calls = 0
+
+        def execute_command(self, *args, **options):
+            self.calls += 1
+            return super().execute_command(*args, **options)
+
+        def pipeline(self, *args, **kwargs):
+            pipe = super().pipeline(*args, **kwargs)
+            execute = pipe.execute
+
+            def counted_execute(*args, **kwargs):
+                self.calls += 1
+                return execute(*args, **kwargs)
+
+            pipe.execute = counted_execute
+            return pipe
+
+    return CountingRedis(server=fakeredis.FakeServer())
+
+
+class TimedGameRoomConsumer(GameRoomConsumer):
+
+    def __init__(self, stats, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.stats = stats
+
+    async def send_message(self, event):
+        if 'sent_at' in event:
+            self.stats.latencies.append(time.perf_counter() - event['sent_at'])
+
+        await super().send_message(event)
+
+
+@dataclass
+class LoadStats:
+    latencies: list = field(default_factory=list)
+    jitters: list = field(default_factory=list)
+    requests: list = field(default_factory=list)
+    tasks: int = 0
+    finished: int = 0
+    stalled: int = 0
+
+
+@dataclass
+class Room:
+    index: int
+    usernames: list
+    client: APIClient = field(default_factory=APIClient)
+    queue: asyncio.Queue = field(default_factory=asyncio.Queue) # celery tasks of this room, (name, args, countdown deadline)
+    code: str = None
+
+
+def percentile(values, percent):
+
+    if not values:
+        return 0
+
+    values = sorted(values)
+    return values[min(int(len(values) * percent / 100), len(values) - 1)]
+
+
+class LoadTest:
+
+    def __init__(self, rooms=10, players=5, strategy='random', time_scale=0.01, stall_timeout=30, seed=1):
+        self.room_count = rooms
+        self.player_count = players
+        self.strategy = strategy
+        self.time_scale = time_scale
+        self.stall_timeout = stall_timeout
+        self.rng = random.Random(seed)
+        self.seed = seed
+        self.stats = LoadStats()
+        self.rooms = {} # room code -> Room
+        self.loop = None
+
+    # called from the worker thread
+
+    def queue(self, name, args):
+
+        # the players only leave once their game is over
+        if name == 'leaveDisconnectedPlayer':
+            return
+
+        room = self.rooms[args[0]]
+        self.loop.call_soon_threadsafe(room.queue.put_nowait, (name, args, None))
+
+    def expire_countdown(self, code, duration, phase=None, token=None):
+        room = self.rooms[code]
+        delay = int(duration) * self.time_scale
+        deadline = time.perf_counter() + delay
+
+        self.loop.call_soon_threadsafe(
+            self.loop.call_later, delay, room.queue.put_nowait, ('phaseInitialize', (code, token), deadline)
+        )
+
+    def choose(self, targets):
+        if self.strategy == 'first':
+            return targets[0]
+        return self.rng.choice(targets)
+
+    def run(self):
+
+        random.seed(self.seed)
+        self.redis_client = counting_redis()
+
+        with stand_in_services(self.queue, self.expire_countdown, self.redis_client, 'game.loadtest.LoadChannelLayer') as channel_layer:
+            self.channel_layer = channel_layer
+            return asyncio.run(self.play())
+
+    async def play(self):
+
+        self.loop = asyncio.get_running_loop()
+        self.application = URLRouter([
+            path('ws/socket-server/<str:username>/<str:code>/', TimedGameRoomConsumer.as_asgi(stats=self.stats)),
+        ])
+
+        start = time.perf_counter()
+        await asyncio.gather(*[self.play_room(index) for index in range(self.room_count)])
+        elapsed = time.perf_counter() - start
+
+        return self.report(elapsed)
+
+    async def request(self, room, method, url, data):
+
+        start = time.perf_counter()
+        response = await sync_to_async(getattr(room.client, method))(url, data, format='json')
+        self.stats.requests.append(time.perf_counter() - start)
+
+        return response
+
+    async def run_task(self, task, args):
+        await sync_to_async(task)(*args)
+        self.stats.tasks += 1
+
+    async def play_room(self, index):
+
+        room = Room(index, [f'load{index}_{i}' for i in range(self.player_count)])
+
+        await sync_to_async(Player.objects.bulk_create)([Player(username=username) for username in room.usernames])
+
+        owner, *others = room.usernames
+        room.code = (await self.request(room, 'post', '/game-api/create-room/', {'owner': owner})).data['code']
+        self.rooms[room.code] = room
+
+        await self.request(room, 'patch', '/game-api/update-room/', {'code': room.code, 'update': 'update_room', 'limit': self.player_count})
+        await self.request(room, 'patch', '/game-api/update-room/', {'code': room.code, 'update': 'update_aswang', 'limit': ASWANG_LIMITS[self.player_count]})
+
+        for username in others:
+            await self.request(room, 'post', '/game-api/join-room/', {'player': username, 'code': room.code})
+
+        communicators = [WebsocketCommunicator(self.application, f'/ws/socket-server/{username}/{room.code}/') for username in room.usernames]
+        for communicator in communicators:
+            await communicator.connect()
+
+        # the clients only have to keep up with what they are sent
+        readers = [asyncio.create_task(self.read(communicator)) for communicator in communicators]
+
+        await self.request(room, 'post', '/game-api/start/', {'code': room.code})
+
+        try:
+            await self.play_game(room)
+        finally:
+            for reader in readers:
+                reader.cancel()
+            for communicator in communicators:
+                await communicator.disconnect()
+
+    async def read(self, communicator):
+        # output_queue directly, receive_output cancels the consumer when it times out
+        while True:
+            message = await communicator.output_queue.get()
+            if message['type'] == 'websocket.close':
+                return
+
+    async def play_game(self, room):
+
+        while True:
+            try:
+                name, args, deadline = await asyncio.wait_for(room.queue.get(), self.stall_timeout)
+            except asyncio.TimeoutError:
+                # no phase transition was scheduled, the game is stuck
+                self.stats.stalled += 1
+                return
+
+            if name == 'phaseCountdown':
+                await self.run_task(tasks.phaseCountdown, args)
+                continue
+
+            token = await sync_to_async(get_phase_token)(room.code)
+            await self.run_task(tasks.phaseInitialize, args)
+
+            # the transition was dropped, the phase had already moved on
+            if await sync_to_async(get_phase_token)(room.code) == token:
+                continue
+
+            if deadline is not None:
+                self.stats.jitters.append(time.perf_counter() - deadline)
+
+            state = await sync_to_async(GameState.load)(room.code)
+
+            if state.game_phase == 9 and state.winners is not None:
+                self.stats.finished += 1
+                return
+
+            if state.game_phase == 3:
+                await self.play_night(room)
+            elif state.game_phase == 7:
+                await self.vote(room, state)
+
+    async def play_night(self, room):
+
+        role = self.channel_layer.turns.get(f'room_{room.code}')
+
+        while role is not None:
+            state = await sync_to_async(GameState.load)(room.code)
+            player = night_actor(state, role)
+
+            if player is None:
+                return
+
+            response = await self.request(room, 'post', '/game-api/select-target/', {
+                'code': room.code,
+                'role': role,
+                'player': player.username,
+                'target': self.choose(night_targets(state, player)).username,
+            })
+
+            if response.status_code != 200 or response.data.get('message') != 'OK':
+                return
+
+            role = self.channel_layer.turns.get(f'room_{room.code}')
+
+    async def vote(self, room, state):
+
+        players = state.alive_players()
+
+        for player in players:
+            target = self.choose([target for target in players if target.username != player.username])
+            await self.request(room, 'patch', '/game-api/vote-player/', {
+                'code': room.code,
+                'player': player.username,
+                'vote_target': target.username,
+            })
+
+    def report(self, elapsed):
+
+        ms = lambda seconds: round(seconds * 1000, 3)
+
+        return {
+            'rooms': self.room_count,
+            'clients': self.room_count * self.player_count,
+            'finished_games': self.stats.finished,
+            'stalled_games': self.stats.stalled,
+            'seconds': round(elapsed, 3),
+            'messages_sent': self.channel_layer.messages,
+            'messages_delivered': len(self.stats.latencies),
+            'message_latency_ms': {'p50': ms(percentile(self.stats.latencies, 50)), 'p99': ms(percentile(self.stats.latencies, 99))},
+            'phase_jitter_ms': {'p50': ms(percentile(self.stats.jitters, 50)), 'p99': ms(percentile(self.stats.jitters, 99))},
+            'request_latency_ms': {'p50': ms(percentile(self.stats.requests, 50)), 'p99': ms(percentile(self.stats.requests, 99))},
+            'requests': len(self.stats.requests),
+            'worker_tasks': self.stats.tasks,
+            'worker_tasks_per_second': round(self.stats.tasks / elapsed, 1),
+            'redis_calls': self.redis_client.calls,
+            'redis_calls_per_second': round(self.redis_client.calls / elapsed, 1),
+        }
@@ -0,0 +1,167 @@
+"""
+per room mailbox, the room tasks of one room run one at a time in the order they arrived while different rooms
+run in parallel on as many workers as there are
+
+a room task pushes itself onto room_{code}_mailbox and tries to take the room (room_{code}_mailbox_owner). the
+worker that has the room runs everything in the mailbox, the others return right away and leave their task to it.
+the owner key expires ROOM_MAILBOX_TTL seconds after the last task started, if its worker died the next room
+task or redrive_mailboxes (a beat task) takes the room over and runs what was left. the rooms with a mailbox
+are kept in room_mailboxes so they can be found without scanning the keys
+
+"""
+
+import inspect
+import json
+import threading
+import uuid
+from functools import wraps
+
+from django.conf import settings
+
+from . import services
+
+
+# tasks that can be put into a mailbox, task name -> function
+room_tasks = {}
+
+# rooms whose mailbox this thread (greenlet under gevent) is running, a room task called from another one runs right away
+running = threading.local()
+
+take_room_script = services.redis_client.register_script("""
+if redis.call('SET', KEYS[1], ARGV[1], 'NX', 'EX', ARGV[2]) then
+    return 1
+end
+return 0
+""")
+
+# next task of the mailbox, the room is given up in the same step when there is none left so a task pushed
+# right after can't be missed by both workers
+next_task_script = services.redis_client.register_script("""
+if redis.call('GET', KEYS[1]) ~= ARGV[1] then
+    return false
+end
+local task = redis.call('LPOP', KEYS[2])
+if task then
+    redis.call('EXPIRE', KEYS[1], ARGV[2])
+    return task
+end
+redis.call('DEL', KEYS[1])
+redis.call('SREM', KEYS[3], ARGV[3])
+return false
+""")
+
+# codes of the rooms whose mailbox may still have tasks in it
+MAILBOX_ROOMS_KEY = 'room_mailboxes'
+
+
+def mailbox_keys(code):
+    return [f'room_{code}_mailbox_owner', f'room_{code}_mailbox']
+
+
+def room_task(func):
+
+    """
+    runs the decorated function through the mailbox of the room in its code argument. returns what the
+    function returned if this call ran it, None if it was left to the worker that has the room
+
+    """
+
+    room_tasks[func.__name__] = func
+    signature = inspect.signature(func)
+
+    @wraps(func)
+    def run(*args, **kwargs):
+
+        code = signature.bind(*args, **kwargs).arguments['code']
+
+        if code in getattr(running, 'rooms', set()):
+            return func(*args, **kwargs)
+
+        task_id = uuid.uuid4().hex
+        mailbox_key = mailbox_keys(code)[1]
+        with services.redis_client.pipeline() as pipe:
+            pipe.rpush(mailbox_key, json.dumps({'id': task_id, 'task': func.__name__, 'args': args, 'kwargs': kwargs}))
+            pipe.expire(mailbox_key, settings.ROOM_MAILBOX_TTL)
+            pipe.sadd(MAILBOX_ROOMS_KEY, code)
+            pipe.execute()
+
+        result, error = run_mailbox(code).get(task_id, (None, None))
+
+        # the task of this call failed, the same as if it had been called directly
+        if error is not None:
+            raise error
+
+        return result
+
+    return run
+
+
+def run_mailbox(code):
+
+    # runs the mailbox of the room if no other worker has the room, returns task id -> (result, error) of the tasks it ran
+    owner = uuid.uuid4().hex
+    keys = mailbox_keys(code)
+    results = {}
+
+    if not take_room_script(keys=keys[:1], args=[owner, settings.ROOM_MAILBOX_TTL], client=services.redis_client):
+        return results
+
+    if not hasattr(running, 'rooms'):
+        running.rooms = set()
+    running.rooms.add(code)
+
+    try:
+        while True:
+            task = next_task_script(keys=keys + [MAILBOX_ROOMS_KEY], args=[owner, settings.ROOM_MAILBOX_TTL, code], client=services.redis_client)
+            if task is None:
+                return results
+
+            task = json.loads(task)
+            try:
+                results[task['id']] = (room_tasks[task['task']](*task['args'], **task['kwargs']), None)
+            except Exception as e:
+                # one failing task doesn't hold up the rest of the room
+                print(f'Error: {e}')
+                results[task['id']] = (None, e)
+    finally:
+        running.rooms.discard(code)
+
+
+def redrive_mailboxes():
+
+    # runs the mailboxes left behind by a worker that died, returns the codes of the rooms it ran
+    redriven = []
+
+    for code in services.redis_client.smembers(MAILBOX_ROOMS_KEY):
+        code = code.decode('utf-8')
+        owner_key, mailbox_key = mailbox_keys(code)
+
+        if services.redis_client.exists(owner_key):
+            continue
+
+        if not services.redis_client.exists(mailbox_key):
+            # nothing left in it (or it expired), the set is only cleaned up here and by the worker that empties it
+            services.redis_client.srem(MAILBOX_ROOMS_KEY, code)
+            continue
+
+        if run_mailbox(code):
+            redriven.append(code)
+
+    return redriven
+
+
+def run_as_room(code, func, args=(), kwargs=None):
+
+    # runs func as the owner of the room (the game engine's actors), the room tasks it calls run right away
+    # instead of going through the mailbox
+    if not hasattr(running, 'rooms'):
+        running.rooms = set()
+
+    nested = code in running.rooms
+    running.rooms.add(code)
+
+    try:
+        return func(*args, **(kwargs or {}))
+    finally:
+        if not nested:
+            running.rooms.discard(code)
@@ -0,0 +1,20 @@
+import json
+
+from django.core.management.base import BaseCommand
+
+from game.benchmark import run_broadcast_benchmark
+
+
+class Command(BaseCommand):
+    help = 'Times channel layer group sends from sync code through async_to_sync and through the broadcast loop'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--sends', type=int, default=2000)
+        parser.add_argument('--threads', type=int, default=1, help='threads sending at the same time')
+        parser.add_argument('--channel-layer', choices=['memory', 'default'], default='memory', help='in memory layer or the layer in the settings (channels_redis)')
+
+    def handle(self, *args, **options):
+
+        results = run_broadcast_benchmark(options['sends'], options['threads'], options['channel_layer'])
+
+        self.stdout.write(json.dumps(results, indent=4))
@@ -0,0 +1,48 @@
+import json
+
+from django.core.management.base import BaseCommand, CommandError
+from django.test.utils import setup_test_environment, teardown_test_environment
+from django.test.runner import DiscoverRunner
+
+from game.benchmark import PLAYER_COUNTS, run_benchmark, load_baselines, write_baselines, compare_with_baseline
+
+
+class Command(BaseCommand):
+    help = 'Plays simulated games against a test database and compares query counts, messages and time per step with the baselines'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--players', type=int, nargs='+', default=list(PLAYER_COUNTS))
+        parser.add_argument('--seed', type=int, default=1)
+        parser.add_argument('--write', action='store_true', help='store the results as the new baselines')
+
+    def handle(self, *args, **options):
+
+        # games are played in a throwaway database
+        setup_test_environment()
+        runner = DiscoverRunner(verbosity=0)
+        databases = runner.setup_databases()
+
+        try:
+            results = run_benchmark(options['players'], options['seed'])
+        finally:
+            runner.teardown_databases(databases)
+            teardown_test_environment()
+
+        self.stdout.write(json.dumps(results, indent=4, sort_keys=True))
+
+        if options['write']:
+            write_baselines(results)
+            self.stdout.write('Baselines written')
+            return
+
+        baselines = load_baselines()
+        regressions = []
+
+        for player_count, result in results.items():
+            regressions += [f'{player_count} players, {regression}' for regression in compare_with_baseline(result, baselines.get(player_count, {}))]
+
+        # fails the command (and a ci step running it) when a step got slower or needs more queries or messages
+        if regressions:
+            raise CommandError('\n'.join(regressions))
+
+        self.stdout.write('No regressions')
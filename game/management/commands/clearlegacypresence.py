@@ -0,0 +1,11 @@
+from django.core.management.base import BaseCommand
+
+from game.services import clear_legacy_presence
+
+
+class Command(BaseCommand):
+    help = 'Removes the presence keys from before the presence hash (room_{code}_player_{username}), only needed once'
+
+    def handle(self, *args, **options):
+        removed = clear_legacy_presence()
+        self.stdout.write(f'Removed {removed} legacy presence keys')
@@ -0,0 +1,46 @@
+import json
+
+from django.core.management.base import BaseCommand, CommandError
+from django.test.utils import setup_test_environment, teardown_test_environment
+from django.test.runner import DiscoverRunner
+
+from game.loadtest import LoadTest
+
+
+class Command(BaseCommand):
+    help = 'Plays many simulated games at once with websocket clients and reports message latency, phase jitter and throughput'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--rooms', type=int, default=10)
+        parser.add_argument('--players', type=int, default=5, help='websocket clients (players) per room, 5 to 10')
+        parser.add_argument('--strategy', choices=['random', 'first'], default='random', help='random targets/votes or always the first player')
+        parser.add_argument('--time-scale', type=float, default=0.01, help='countdowns last duration * time scale seconds')
+        parser.add_argument('--stall-timeout', type=float, default=30, help='seconds without a phase transition before a room counts as stuck')
+        parser.add_argument('--seed', type=int, default=1)
+
+    def handle(self, *args, **options):
+
+        if not 5 <= options['players'] <= 10:
+            raise CommandError('players must be between 5 and 10')
+
+        load_test = LoadTest(
+            rooms=options['rooms'],
+            players=options['players'],
+            strategy=options['strategy'],
+            time_scale=options['time_scale'],
+            stall_timeout=options['stall_timeout'],
+            seed=options['seed'],
+        )
+
+        # games are played in a throwaway database
+        setup_test_environment()
+        runner = DiscoverRunner(verbosity=0)
+        databases = runner.setup_databases()
+
+        try:
+            report = load_test.run()
+        finally:
+            runner.teardown_databases(databases)
+            teardown_test_environment()
+
+        self.stdout.write(json.dumps(report, indent=4))
@@ -0,0 +1,19 @@
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from game.clock import poll_phase_deadlines
+
+
+class Command(BaseCommand):
+    help = 'Ends the phases whose countdown was lost (crashed worker or room clock), several of these can run at once'
+
+    def handle(self, *args, **options):
+        self.stdout.write('Phase deadline poller started')
+
+        while True:
+            for code, token in poll_phase_deadlines():
+                self.stdout.write(f'Ended the phase of room {code} (token {token}), its countdown was lost')
+
+            time.sleep(settings.PHASE_DEADLINE_POLL_INTERVAL)
@@ -0,0 +1,13 @@
+import asyncio
+
+from django.core.management.base import BaseCommand
+
+from game.clock import RoomClock
+
+
+class Command(BaseCommand):
+    help = 'Runs the room clock service that drives the countdown of every room from one event loop'
+
+    def handle(self, *args, **options):
+        self.stdout.write('Room clock started')
+        asyncio.run(RoomClock().run())
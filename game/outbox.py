@@ -0,0 +1,71 @@
+import asyncio
+
+from .broadcast import loop_to_sync
+
+
+class Outbox:
+
+    """
+    collects what a task or request sends to the players of a room and sends it in one go when it's done,
+    the messages to the same group are merged into one batch frame ({'type': 'batch', 'messages': [...]})
+
+        with Outbox(code, channel_layer) as outbox:
+            outbox.room({'type': 'next_phase', 'phase': 3})
+            outbox.player(username, {'type': 'player_select_target', 'player': username})
+
+    """
+
+    def __init__(self, code, channel_layer):
+        self.code = code
+        self.channel_layer = channel_layer
+        self.messages = {} # group -> messages, in the order they were added
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, traceback):
+        # nothing is sent if the task failed halfway
+        if exc_type is None:
+            self.flush()
+
+    def send(self, group, data):
+        self.messages.setdefault(group, []).append(data)
+
+    def room(self, data):
+        self.send(f'room_{self.code}', data)
+
+    def player(self, username, data):
+        self.send(f'{username}_{self.code}', data)
+
+    def flush(self):
+
+        if not self.messages:
+            return
+
+        messages, self.messages = self.messages, {}
+        loop_to_sync(self.send_all)(messages)
+
+    async def send_all(self, messages):
+
+        frames = {group: batch_frame(group_messages) for group, group_messages in messages.items()}
+
+        # the room goes first so a player's own prompt never arrives before the phase it belongs to,
+        # the groups of the players are sent all at once
+        room = f'room_{self.code}'
+        if room in frames:
+            await self.channel_layer.group_send(room, frames.pop(room))
+
+        await asyncio.gather(*[self.channel_layer.group_send(group, frame) for group, frame in frames.items()])
+
+
+def batch_frame(messages):
+
+    # a single message is sent as it is
+    data = messages[0] if len(messages) == 1 else {'type': 'batch', 'messages': messages}
+
+    return {'type': 'send_message', 'data': data}
+
+
+def unbatch(data):
+    # the messages of a frame, batched or not
+    return data.get('messages', []) if data.get('type') == 'batch' else [data]
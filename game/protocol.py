@@ -0,0 +1,74 @@
+import msgpack
+
+
+# opt in websocket subprotocol, frames are msgpack maps with an integer type code instead of json text
+MSGPACK_SUBPROTOCOL = 'kutob.msgpack'
+
+# the code of a type is its position in this list, only ever append new types so the codes stay the same for clients
+MESSAGE_TYPES = [
+    'player_list',
+    'update_player_list',
+    'update_room_owner',
+    'game_start',
+    'role_show',
+    'countdown',
+    'phase_deadline',
+    'next_phase',
+    'night_count',
+    'day_count',
+    'alive_players_list',
+    'update_roleTurn',
+    'player_select_target',
+    'mangangaso_skill_change',
+    'guess_picked',
+    'announce',
+    'announce_winners',
+    'vote_delta',
+    'vote_tie',
+    'is_aswang',
+    'not_aswang',
+    'chat_message',
+    'ping',
+    'pong',
+    'roster_delta',
+    'roster_sync',
+    'batch',
+    'select_target',
+    'cast_vote',
+    'ack',
+]
+
+TYPE_CODES = {message_type: code for code, message_type in enumerate(MESSAGE_TYPES, 1)}
+
+
+def encode_frame(data):
+
+    return msgpack.packb(to_codes(data), use_bin_type=True)
+
+
+def decode_frame(frame):
+
+    return to_types(msgpack.unpackb(frame, raw=False))
+
+
+def to_codes(data):
+
+    # types without a code are sent as they are, the messages of a batch get their codes too
+    message_type = data.get('type')
+    if message_type == 'batch':
+        data = dict(data, messages=[to_codes(message) for message in data['messages']])
+    if message_type in TYPE_CODES:
+        data = dict(data, type=TYPE_CODES[message_type])
+
+    return data
+
+
+def to_types(data):
+
+    message_type = data.get('type')
+    if isinstance(message_type, int) and 0 < message_type <= len(MESSAGE_TYPES):
+        data['type'] = MESSAGE_TYPES[message_type - 1]
+    if data.get('type') == 'batch':
+        data['messages'] = [to_types(message) for message in data['messages']]
+
+    return data
@@ -1,26 +1,84 @@
 from django.shortcuts import get_object_or_404
+from django.conf import settings
+from django.core.cache import cache
 import redis
-from asgiref.sync import sync_to_async
+import redis.asyncio
+import uuid
+import time
+import json
+import re
 
 from game.models import Player, Game
+from game.serializers import PlayersInLobby
 
-redis_client = redis.StrictRedis(host='localhost', port=6379, db=1)
+# one pool per process, views and tasks share the sync client and the consumers the asyncio one
+redis_pool = redis.ConnectionPool(
+    host=settings.REDIS_HOST,
+    port=settings.REDIS_PORT,
+    db=settings.GAME_REDIS_DB,
+    max_connections=settings.GAME_REDIS_MAX_CONNECTIONS,
+)
+redis_client = redis.StrictRedis(connection_pool=redis_pool)
 
-@sync_to_async
-def set_player_connected(username, code):
+async_redis_pool = redis.asyncio.ConnectionPool(
+    host=settings.REDIS_HOST,
+    port=settings.REDIS_PORT,
+    db=settings.GAME_REDIS_DB,
+    max_connections=settings.GAME_REDIS_MAX_CONNECTIONS,
+)
+async_redis_client = redis.asyncio.StrictRedis(connection_pool=async_redis_pool)
+
+
+# presence of the players in a room, one hash per room (room_{code}_presence) of username -> "status:timestamp"
+# the whole hash expires PRESENCE_TTL after the last change and reapStalePresence removes players
+# who stayed disconnected, or whose heartbeat stopped refreshing them, for longer than PRESENCE_STALE_AFTER
+PRESENCE_TTL = 60 * 60 * 6
+PRESENCE_STALE_AFTER = 60 * 5
+
+def presence_key(code):
+    return f'room_{code}_presence'
+
+
+def parse_presence(value):
+    # "status:timestamp" -> (status, timestamp)
+    status, _, timestamp = value.decode('utf-8').rpartition(':')
+    return status, float(timestamp)
+
+def presence_roster(values):
+    return {username.decode('utf-8'): parse_presence(value) for username, value in values.items()}
+
+
+# async, used by the consumers without going through the thread pool
+async def set_player_presence(username, code, status):
     
-    redis_key = f'room_{code}_player_{username}'
-    redis_client.set(redis_key, "connected")
+    # returns the timestamp of the change, it identifies this connect/disconnect
+    timestamp = time.time()
     
-@sync_to_async
-def set_player_disconnected(username, code):
-    redis_key = f'room_{code}_player_{username}'
-    redis_client.set(redis_key, "disconnected")
+    async with async_redis_client.pipeline(transaction=False) as pipe:
+        pipe.hset(presence_key(code), username, f'{status}:{timestamp}')
+        pipe.expire(presence_key(code), PRESENCE_TTL)
+        await pipe.execute()
     
-@sync_to_async
-def get_player_status(username, code):
-    redis_key = f'room_{code}_player_{username}'
-    return redis_client.get(redis_key)
+    return timestamp
+
+async def set_player_connected(username, code):
+    return await set_player_presence(username, code, 'connected')
+    
+async def set_player_disconnected(username, code):
+    return await set_player_presence(username, code, 'disconnected')
+    
+async def get_player_presence(username, code):
+    # (status, timestamp) or None
+    value = await async_redis_client.hget(presence_key(code), username)
+    return parse_presence(value) if value is not None else None
+
+async def get_player_status(username, code):
+    presence = await get_player_presence(username, code)
+    return presence[0] if presence is not None else None
+
+async def get_room_presence(code):
+    # username -> (status, timestamp) of everyone in the room, one round trip
+    return presence_roster(await async_redis_client.hgetall(presence_key(code)))
 
 
 def set_game_turn(code, role_turn): # mangangaso, babaylan, manghuhula, mandurugo, manananggal, berbalang
@@ -32,19 +90,431 @@ def set_game_turn(code, role_turn): # mangangaso, babaylan, manghuhula, mandurug
 def get_game_turn(code):
     redis_key = f'room_{code}_turn' 
     return redis_client.get(redis_key)
+
+
+# the night's turn order of a room, the usernames of everyone with a night action in the order they play (set once
+# when the night starts) and the position of the player whose turn it is, passing the turn only moves the position
+NIGHT_ORDER_TTL = 60 * 60
+
+# the turn only moves on if it was the player's turn, a late or repeated action of someone else leaves it where it is
+end_night_turn_script = redis_client.register_script("""
+local turn = tonumber(redis.call('GET', KEYS[2]) or '0')
+if redis.call('LINDEX', KEYS[1], turn) == ARGV[1] then
+    turn = turn + 1
+    redis.call('SET', KEYS[2], turn, 'EX', ARGV[2])
+end
+return redis.call('LRANGE', KEYS[1], turn, -1)
+""")
+
+def night_order_keys(code):
+    return [f'room_{code}_night_order', f'room_{code}_night_turn']
+
+def set_night_order(code, usernames):
+    
+    order_key, turn_key = night_order_keys(code)
+    
+    with redis_client.pipeline() as pipe:
+        pipe.delete(order_key)
+        if usernames:
+            pipe.rpush(order_key, *usernames)
+            pipe.expire(order_key, NIGHT_ORDER_TTL)
+        pipe.set(turn_key, 0, ex=NIGHT_ORDER_TTL)
+        pipe.execute()
+
+def end_night_turn(code, username):
+    # usernames whose turn is still to come this night, starting with the player whose turn it is now
+    remaining = end_night_turn_script(keys=night_order_keys(code), args=[username, NIGHT_ORDER_TTL], client=redis_client)
+    return [value.decode('utf-8') for value in remaining]
+
+
+# identifies the running countdown of a room, a countdown task that doesn't match it was cancelled or replaced
+def set_room_timer(code):
+    timer_id = uuid.uuid4().hex
+    redis_client.set(f'game_{code}_timer_id', timer_id)
+    return timer_id
+
+def get_room_timer(code):
+    timer_id = redis_client.get(f'game_{code}_timer_id')
+    return timer_id.decode('utf-8') if timer_id is not None else None
+
+def clear_room_timer(code):
+    redis_client.delete(f'game_{code}_timer_id')
+
+
+# every scheduled phase transition carries the phase token of the room from when it was scheduled,
+# only the first transition with the current token runs, stale or duplicate ones are dropped
+PHASE_TOKEN_TTL = 60 * 60 * 24
+
+# compare-and-set in one round trip so two transitions can't both see the same token
+claim_phase_token_script = redis_client.register_script("""
+local current = redis.call('GET', KEYS[1]) or '0'
+if current ~= ARGV[1] then
+    return 0
+end
+local token = redis.call('INCR', KEYS[1])
+redis.call('EXPIRE', KEYS[1], ARGV[2])
+return token
+""")
+
+def new_phase_token(code):
+    # the token keeps increasing across the games of a room, so a transition left over from the last game can't claim it
+    with redis_client.pipeline() as pipe:
+        pipe.incr(f'room_{code}_phase_token')
+        pipe.expire(f'room_{code}_phase_token', PHASE_TOKEN_TTL)
+        token, _ = pipe.execute()
+    return int(token)
+
+def get_phase_token(code):
+    token = redis_client.get(f'room_{code}_phase_token')
+    return int(token) if token is not None else 0
+
+def claim_phase_token(code, token):
+    # returns the new token of the room, 0 if the token was already used
+    return int(claim_phase_token_script(keys=[f'room_{code}_phase_token'], args=[int(token), PHASE_TOKEN_TTL], client=redis_client))
+
+
+
+# deadline of the running countdown of every room, kept in redis so a countdown lost with a crashed worker or clock
+# still ends. phase_deadlines is a sorted set of "code:token" scored by the epoch time the poller may end it at
+# (deadline + PHASE_DEADLINE_GRACE), phase_deadline_rooms holds code -> member to replace or cancel the deadline of a room.
+# whoever claims (removes) the member runs the transition, the countdown when it ends or the poller when it didn't
+PHASE_DEADLINES_KEY = 'phase_deadlines'
+PHASE_DEADLINE_ROOMS_KEY = 'phase_deadline_rooms'
+
+schedule_phase_deadline_script = redis_client.register_script("""
+local previous = redis.call('HGET', KEYS[2], ARGV[1])
+if previous then
+    redis.call('ZREM', KEYS[1], previous)
+end
+if ARGV[2] ~= '' then
+    redis.call('ZADD', KEYS[1], ARGV[3], ARGV[2])
+    redis.call('HSET', KEYS[2], ARGV[1], ARGV[2])
+else
+    redis.call('HDEL', KEYS[2], ARGV[1])
+end
+return 1
+""")
+
+# claims the given members (or every member due by ARGV[1] when there are none), returns the claimed ones
+claim_phase_deadlines_script = redis_client.register_script("""
+local members = {}
+if #ARGV > 2 then
+    for i = 3, #ARGV do
+        table.insert(members, ARGV[i])
+    end
+else
+    members = redis.call('ZRANGEBYSCORE', KEYS[1], '-inf', ARGV[1], 'LIMIT', 0, ARGV[2])
+end
+local claimed = {}
+for _, member in ipairs(members) do
+    if redis.call('ZREM', KEYS[1], member) == 1 then
+        local code = string.match(member, '^(.*):[^:]*$')
+        if redis.call('HGET', KEYS[2], code) == member then
+            redis.call('HDEL', KEYS[2], code)
+        end
+        table.insert(claimed, member)
+    end
+end
+return claimed
+""")
+
+def phase_deadline_member(code, token):
+    return f'{code}:{token}'
+
+def schedule_phase_deadline(code, token, duration):
+    # replaces the deadline the room had
+    due = time.time() + int(duration) + settings.PHASE_DEADLINE_GRACE
+    schedule_phase_deadline_script(keys=[PHASE_DEADLINES_KEY, PHASE_DEADLINE_ROOMS_KEY], args=[code, phase_deadline_member(code, token), due], client=redis_client)
+
+def cancel_phase_deadline(code):
+    schedule_phase_deadline_script(keys=[PHASE_DEADLINES_KEY, PHASE_DEADLINE_ROOMS_KEY], args=[code, '', 0], client=redis_client)
+
+def claim_phase_deadline(code, token):
+    # True if the caller gets to run the transition of this deadline
+    claimed = claim_phase_deadlines_script(keys=[PHASE_DEADLINES_KEY, PHASE_DEADLINE_ROOMS_KEY], args=[0, 0, phase_deadline_member(code, token)], client=redis_client)
+    return bool(claimed)
+
+def claim_due_phase_deadlines(limit=500):
+    
+    # (code, token) of the deadlines that passed without their countdown ending them, one round trip for every room
+    claimed = claim_phase_deadlines_script(keys=[PHASE_DEADLINES_KEY, PHASE_DEADLINE_ROOMS_KEY], args=[time.time(), limit], client=redis_client)
     
+    deadlines = []
+    for member in claimed:
+        code, _, token = member.decode('utf-8').rpartition(':')
+        deadlines.append((code, int(token)))
+    
+    return deadlines
+
+
+# vote tally of the voting phase, room_{code}_votes holds voter -> target and room_{code}_vote_counts target -> votes
+# both are updated together in one script so the counts always match the votes
+VOTE_TTL = 60 * 60 * 24
+
+cast_vote_script = redis_client.register_script("""
+local previous = redis.call('HGET', KEYS[1], ARGV[1])
+if previous == ARGV[2] then
+    return {previous, tonumber(redis.call('HGET', KEYS[2], ARGV[2]) or '0'), 0, redis.call('HLEN', KEYS[1])}
+end
+local previous_count = 0
+if previous then
+    previous_count = redis.call('HINCRBY', KEYS[2], previous, -1)
+    if previous_count <= 0 then
+        redis.call('HDEL', KEYS[2], previous)
+    end
+end
+redis.call('HSET', KEYS[1], ARGV[1], ARGV[2])
+local count = redis.call('HINCRBY', KEYS[2], ARGV[2], 1)
+redis.call('EXPIRE', KEYS[1], ARGV[3])
+redis.call('EXPIRE', KEYS[2], ARGV[3])
+return {previous or '', count, previous_count, redis.call('HLEN', KEYS[1])}
+""")
+
+remove_vote_script = redis_client.register_script("""
+local previous = redis.call('HGET', KEYS[1], ARGV[1])
+if not previous then
+    return ''
+end
+redis.call('HDEL', KEYS[1], ARGV[1])
+if redis.call('HINCRBY', KEYS[2], previous, -1) <= 0 then
+    redis.call('HDEL', KEYS[2], previous)
+end
+return previous
+""")
+
+def vote_keys(code):
+    return [f'room_{code}_votes', f'room_{code}_vote_counts']
+
+def cast_vote(code, voter, target):
+    
+    # returns the previous target of the voter (None if it's their first vote), the new counts of the targets that changed
+    # and how many players have voted, counted in the same step so two votes at once can't both miss the other
+    previous, count, previous_count, voters = cast_vote_script(keys=vote_keys(code), args=[voter, target, VOTE_TTL], client=redis_client)
+    previous = previous.decode('utf-8') or None
+    
+    counts = {target: int(count)}
+    if previous is not None and previous != target:
+        counts[previous] = max(int(previous_count), 0)
+    
+    return previous, counts, int(voters)
+
+def get_voter_count(code):
+    return redis_client.hlen(vote_keys(code)[0])
+
+def remove_vote(code, voter):
+    previous = remove_vote_script(keys=vote_keys(code), args=[voter], client=redis_client)
+    return previous.decode('utf-8') or None
+
+def get_vote_counts(code):
+    return {target.decode('utf-8'): int(count) for target, count in redis_client.hgetall(vote_keys(code)[1]).items()}
+
+def clear_votes(code):
+    redis_client.delete(*vote_keys(code))
+
+
+
+# roster of a room (players in the room who are still alive and in the game), room_{code}_roster holds
+# username -> serialized player (json) and room_{code}_roster_version counts the changes. clients apply the
+# roster_delta of every change and ask for a snapshot (roster_sync) when they notice they missed a version
+ROSTER_TTL = 60 * 60 * 24
+
+# ARGV: ttl, replace (1 removes everyone not in the upserts), number of removals, the removed usernames, then username/player pairs
+update_roster_script = redis_client.register_script("""
+local removed, added, updated = {}, {}, {}
+local removals = tonumber(ARGV[3])
+local first_upsert = 4 + removals
+if ARGV[2] == '1' then
+    local keep = {}
+    for i = first_upsert, #ARGV, 2 do
+        keep[ARGV[i]] = true
+    end
+    for _, username in ipairs(redis.call('HKEYS', KEYS[1])) do
+        if not keep[username] then
+            redis.call('HDEL', KEYS[1], username)
+            table.insert(removed, username)
+        end
+    end
+end
+for i = 4, first_upsert - 1 do
+    if redis.call('HDEL', KEYS[1], ARGV[i]) == 1 then
+        table.insert(removed, ARGV[i])
+    end
+end
+for i = first_upsert, #ARGV, 2 do
+    local current = redis.call('HGET', KEYS[1], ARGV[i])
+    if not current then
+        table.insert(added, ARGV[i])
+    elseif current ~= ARGV[i + 1] then
+        table.insert(updated, ARGV[i])
+    end
+    if current ~= ARGV[i + 1] then
+        redis.call('HSET', KEYS[1], ARGV[i], ARGV[i + 1])
+    end
+end
+local version
+if #removed + #added + #updated > 0 then
+    version = redis.call('INCR', KEYS[2])
+else
+    version = tonumber(redis.call('GET', KEYS[2]) or '0')
+end
+redis.call('EXPIRE', KEYS[1], ARGV[1])
+redis.call('EXPIRE', KEYS[2], ARGV[1])
+return {version, removed, added, updated}
+""")
+
+def roster_keys(code):
+    return [f'room_{code}_roster', f'room_{code}_roster_version']
+
+def update_roster(code, players=(), removed=(), replace=False):
+    
+    """
+    adds or updates the serialized players and removes the removed usernames, with replace=True the roster becomes
+    exactly players. returns the roster_delta of the change, None if nothing changed
+    
+    """
+    
+    players = {player['username']: player for player in players}
+    args = [ROSTER_TTL, int(replace), len(removed), *removed]
+    for username, player in players.items():
+        args += [username, json.dumps(player, sort_keys=True)]
+    
+    version, removed, added, updated = update_roster_script(keys=roster_keys(code), args=args, client=redis_client)
+    
+    if not (removed or added or updated):
+        return None
+    
+    return {
+        'type': 'roster_delta',
+        'version': int(version),
+        'added': [players[username.decode('utf-8')] for username in added],
+        'removed': [username.decode('utf-8') for username in removed],
+        'updated': [players[username.decode('utf-8')] for username in updated],
+    }
+
+def parse_roster(values, version):
+    # None if the room has no roster yet
+    if version is None:
+        return None
+    players = sorted((json.loads(player) for player in values.values()), key=lambda player: player['username'])
+    return int(version), players
+
+async def get_roster(code):
+    
+    # (version, players) in one round trip
+    async with async_redis_client.pipeline(transaction=True) as pipe:
+        pipe.hgetall(roster_keys(code)[0])
+        pipe.get(roster_keys(code)[1])
+        values, version = await pipe.execute()
+    
+    return parse_roster(values, version)
+
+def get_roster_non_sync(code):
+    
+    with redis_client.pipeline(transaction=True) as pipe:
+        pipe.hgetall(roster_keys(code)[0])
+        pipe.get(roster_keys(code)[1])
+        values, version = pipe.execute()
+    
+    return parse_roster(values, version)
+
+
+
+# serialized players of a room (alive and still in the game) as the database has them, kept in the django cache
+# until the players of the room change. rebuilds the redis roster when it's missing and answers joinRoom
+ROOM_PLAYERS_TTL = 60 * 60
+
+def room_players_key(code):
+    return f'room_{code}_players'
+
+def get_room_players(code):
+    
+    players = cache.get(room_players_key(code))
+    
+    if players is None:
+        players = [dict(player) for player in PlayersInLobby(
+            Player.objects.filter(players__room_code=code, alive=True, eliminated_from_game=False).order_by('id'), many=True
+        ).data]
+        cache.set(room_players_key(code), players, ROOM_PLAYERS_TTL)
+    
+    return players
+
+def invalidate_room_players(code):
+    cache.delete(room_players_key(code))
+
+
 # non sync
-def set_player_connected_non_sync(username, code):
+def set_player_presence_non_sync(username, code, status):
     
-    redis_key = f'room_{code}_player_{username}'
-    redis_client.set(redis_key, "connected")
+    with redis_client.pipeline(transaction=False) as pipe:
+        pipe.hset(presence_key(code), username, f'{status}:{time.time()}')
+        pipe.expire(presence_key(code), PRESENCE_TTL)
+        pipe.execute()
     return True
+
+def set_player_connected_non_sync(username, code):
+    return set_player_presence_non_sync(username, code, 'connected')
    
 def set_player_disconnected_non_sync(username, code):
-    redis_key = f'room_{code}_player_{username}'
-    redis_client.set(redis_key, "disconnected")
-    return True
+    return set_player_presence_non_sync(username, code, 'disconnected')
 
 def get_player_status_non_sync(username, code):
-    redis_key = f'room_{code}_player_{username}'
-    return redis_client.get(redis_key)
+    value = redis_client.hget(presence_key(code), username)
+    return parse_presence(value)[0] if value is not None else None
+
+def get_room_presence_non_sync(code):
+    return presence_roster(redis_client.hgetall(presence_key(code)))
+
+def get_connected_players_non_sync(code):
+    return [username for username, (status, timestamp) in get_room_presence_non_sync(code).items() if status == 'connected']
+
+def remove_player_presence_non_sync(username, code):
+    redis_client.hdel(presence_key(code), username)
+
+
+# removes the players of a room that haven't been seen since before the cutoff, in one round trip per room
+# (connected players are refreshed by their heartbeat)
+reap_presence_script = redis_client.register_script("""
+local removed = 0
+local entries = redis.call('HGETALL', KEYS[1])
+for i = 1, #entries, 2 do
+    local timestamp = string.match(entries[i + 1], ':([^:]*)$')
+    if tonumber(timestamp) < tonumber(ARGV[1]) then
+        redis.call('HDEL', KEYS[1], entries[i])
+        removed = removed + 1
+    end
+end
+return removed
+""")
+
+def reap_stale_presence():
+    
+    cutoff = time.time() - PRESENCE_STALE_AFTER
+    removed = 0
+    
+    for key in redis_client.scan_iter(match='room_*_presence', count=500):
+        removed += reap_presence_script(keys=[key], args=[cutoff], client=redis_client)
+    
+    return removed
+
+
+# presence keys from before the presence hash, room_{code}_player_{username} = "connected" / "disconnected" without
+# an expiry. only keys of exactly that shape are removed, other keys of a room can have "_player_" in them too
+LEGACY_PRESENCE_KEY = re.compile(r'^room_[A-Z0-9]+_player_.+$')
+LEGACY_PRESENCE_VALUES = {b'connected', b'disconnected'}
+
+def clear_legacy_presence():
+    
+    removed = 0
+    
+    for key in redis_client.scan_iter(match='room_*_player_*', count=500):
+        if not LEGACY_PRESENCE_KEY.match(key.decode('utf-8')):
+            continue
+        if redis_client.type(key) != b'string' or redis_client.ttl(key) != -1:
+            continue
+        if redis_client.get(key) not in LEGACY_PRESENCE_VALUES:
+            continue
+        
+        redis_client.delete(key)
+        removed += 1
+    
+    return removed
@@ -0,0 +1,295 @@
+import json
+
+from django.http import Http404
+from redis.exceptions import WatchError
+
+from .models import Game, Player
+from .services import redis_client, remove_vote, invalidate_room_players
+
+
+# fields of the game and its players that the phase logic reads and changes
+GAME_FIELDS = ('game_phase', 'day_count', 'night_count', 'cycle', 'winners', 'has_ended')
+
+PLAYER_FIELDS = (
+    'role', 'alive', 'eliminated_from_game', 'turn_done',
+    'is_protected', 'skip_turn', 'night_skip', 'can_execute',
+    'night_target', 'eliminated_on_night', 'revived_on_night',
+    'vote_target', # username of the voted player instead of the foreign key
+)
+
+STATE_TTL = 60 * 60 * 24
+
+# writing any of these makes the cached players of the room stale
+ROOM_PLAYERS_FIELDS = {'role', 'alive', 'eliminated_from_game'}
+
+
+class Record:
+
+    """
+    keeps track of the fields changed since the record was loaded (saved to redis on save)
+    and of the fields not yet written to the database (written on flush)
+
+    """
+
+    FIELDS = ()
+
+    def __init__(self, unflushed=(), **fields):
+        object.__setattr__(self, 'changed', set())
+        object.__setattr__(self, 'unflushed', set(unflushed))
+        object.__setattr__(self, 'flushed', set()) # written to the database since the record was loaded
+
+        for field in self.FIELDS:
+            object.__setattr__(self, field, fields.get(field))
+
+    def __setattr__(self, name, value):
+        if name in self.FIELDS and getattr(self, name) != value:
+            self.changed.add(name)
+            self.unflushed.add(name)
+            self.flushed.discard(name)
+
+        object.__setattr__(self, name, value)
+
+    def mark_flushed(self, fields):
+        fields = set(fields)
+        self.unflushed.difference_update(fields)
+        self.flushed.update(fields)
+
+    def to_record(self):
+        record = {field: getattr(self, field) for field in self.FIELDS}
+        record['_unflushed'] = sorted(self.unflushed)
+        return record
+
+
+class PlayerState(Record):
+
+    FIELDS = PLAYER_FIELDS
+
+    def __init__(self, id, username, avatar, unflushed=(), **fields):
+        object.__setattr__(self, 'id', id)
+        object.__setattr__(self, 'username', username)
+        object.__setattr__(self, 'avatar', avatar)
+        super().__init__(unflushed, **fields)
+
+    @classmethod
+    def from_player(cls, player):
+        fields = {field: getattr(player, field) for field in PLAYER_FIELDS if field != 'vote_target'}
+        fields['vote_target'] = player.vote_target.username if player.vote_target_id else None
+
+        return cls(player.id, player.username, player.avatar, **fields)
+
+    @classmethod
+    def from_record(cls, record):
+        return cls(record.pop('id'), record.pop('username'), record.pop('avatar'), record.pop('_unflushed', ()), **record)
+
+    def to_record(self):
+        record = super().to_record()
+        record.update(id=self.id, username=self.username, avatar=self.avatar)
+        return record
+
+    @property
+    def in_game(self):
+        return bool(self.alive) and not self.eliminated_from_game
+
+    @property
+    def is_aswang(self):
+        return self.role.startswith('aswang')
+
+
+class GameState(Record):
+
+    """
+    authoritative state of a running game, stored as one redis hash per room
+
+    the hash has one field for the game and one field per player, so concurrent actions of different
+    players (e.g. votes) don't overwrite each other. the phase logic loads it once, works on it in memory
+    and writes back only what changed. changes are written to Game/Player at the phase boundaries (flush)
+
+    """
+
+    FIELDS = GAME_FIELDS
+
+    def __init__(self, code, game_id, players, unflushed=(), **fields):
+        object.__setattr__(self, 'code', code)
+        object.__setattr__(self, 'game_id', game_id)
+        object.__setattr__(self, 'players', players) # username -> PlayerState, in the order of their ids
+        super().__init__(unflushed, **fields)
+
+    @staticmethod
+    def key(code):
+        return f'room_{code}_state'
+
+    @classmethod
+    def load(cls, code):
+
+        records = redis_client.hgetall(cls.key(code))
+
+        if not records:
+            state = cls.from_db(code)
+            state.store()
+            return state
+
+        game = json.loads(records.pop(b'_game'))
+        players = sorted(
+            (PlayerState.from_record(json.loads(record)) for record in records.values()),
+            key=lambda player: player.id
+        )
+
+        return cls(code, game.pop('id'), {player.username: player for player in players}, game.pop('_unflushed', ()), **game)
+
+    @classmethod
+    def from_db(cls, code):
+
+        game = Game.objects.get(room_code=code)
+        players = game.players.select_related('vote_target').order_by('id')
+
+        return cls(
+            code,
+            game.id,
+            {player.username: PlayerState.from_player(player) for player in players},
+            **{field: getattr(game, field) for field in GAME_FIELDS}
+        )
+
+    @classmethod
+    def discard(cls, code):
+        # next load reads the game from the database again
+        redis_client.delete(cls.key(code))
+
+    @classmethod
+    def remove_player(cls, code, username):
+        redis_client.hdel(cls.key(code), f'player_{username}')
+        remove_vote(code, username)
+
+    def store(self):
+
+        record = self.to_record()
+        record['id'] = self.game_id
+
+        mapping = {'_game': json.dumps(record)}
+        for player in self.players.values():
+            mapping[f'player_{player.username}'] = json.dumps(player.to_record())
+
+        with redis_client.pipeline() as pipe:
+            pipe.delete(self.key(self.code))
+            pipe.hset(self.key(self.code), mapping=mapping)
+            pipe.expire(self.key(self.code), STATE_TTL)
+            pipe.execute()
+
+        self.clear_changes()
+
+    def save(self):
+
+        # only the changed fields are merged into what is stored, the rest may have been changed by another request
+        patches = {}
+
+        if self.changed or self.flushed:
+            patches['_game'] = self
+
+        for player in self.players.values():
+            if player.changed or player.flushed:
+                patches[f'player_{player.username}'] = player
+
+        self.merge(patches)
+        self.clear_changes()
+
+    def flush(self):
+
+        # write behind, everything changed since the last flush goes to the database in two queries
+        players = [player for player in self.players.values() if player.unflushed]
+
+        if players:
+            fields = sorted(set().union(*(player.unflushed for player in players)))
+            usernames = {player.username: player.id for player in self.players.values()}
+            rows = []
+
+            for player in players:
+                row = Player(id=player.id)
+                for field in fields:
+                    if field == 'vote_target':
+                        row.vote_target_id = usernames.get(player.vote_target)
+                    else:
+                        setattr(row, field, getattr(player, field))
+                rows.append(row)
+
+            Player.objects.bulk_update(rows, fields)
+            
+            if ROOM_PLAYERS_FIELDS.intersection(fields):
+                invalidate_room_players(self.code)
+
+            for player in players:
+                player.mark_flushed(player.unflushed)
+
+        if self.unflushed:
+            Game.objects.filter(id=self.game_id).update(**{field: getattr(self, field) for field in self.unflushed})
+            self.mark_flushed(self.unflushed)
+
+        self.save()
+
+    def merge(self, patches):
+
+        # patches: hash field -> record whose changed fields are written and whose flushed fields are no longer pending
+        if not patches:
+            return
+
+        key = self.key(self.code)
+        names = list(patches)
+
+        with redis_client.pipeline() as pipe:
+            while True:
+                try:
+                    pipe.watch(key)
+                    stored = pipe.hmget(key, names)
+
+                    mapping = {}
+                    for name, raw in zip(names, stored):
+
+                        # the player left the game in the meantime or the state was discarded
+                        if raw is None:
+                            continue
+
+                        obj = patches[name]
+                        record = json.loads(raw)
+
+                        for field in obj.changed:
+                            record[field] = getattr(obj, field)
+
+                        record['_unflushed'] = sorted((set(record.get('_unflushed', ())) | obj.unflushed) - obj.flushed)
+                        mapping[name] = json.dumps(record)
+
+                    pipe.multi()
+                    if mapping:
+                        pipe.hset(key, mapping=mapping)
+                    pipe.execute()
+                    break
+
+                except WatchError:
+                    continue
+
+    def clear_changes(self):
+        self.changed.clear()
+        self.flushed.clear()
+        for player in self.players.values():
+            player.changed.clear()
+            player.flushed.clear()
+
+    # lookups used by the phase logic
+
+    def alive_players(self):
+        # players that are alive and were not voted out
+        return [player for player in self.players.values() if player.in_game]
+
+    def aswang_players(self):
+        return [player for player in self.alive_players() if player.is_aswang]
+
+    def find(self, role, alive=True):
+        for player in self.players.values():
+            if player.role == role and (not alive or player.in_game):
+                return player
+        return None
+
+
+def get_state_or_404(code):
+
+    try:
+        return GameState.load(code)
+    except Game.DoesNotExist:
+        raise Http404('No Game matches the given query.')
@@ -4,28 +4,31 @@ from django.utils import timezone
 
 from celery import shared_task
 from channels.layers import get_channel_layer
-from asgiref.sync import async_to_sync
+from .broadcast import loop_to_sync
 from time import sleep
 from collections import Counter
 from datetime import datetime, timedelta
 
 from .models import Game, Player
 from .serializers import PlayersInLobby, PlayerSerializer, WinnersSerializer
-from .services import get_game_turn, set_game_turn
+from .services import redis_client, get_game_turn, set_game_turn, get_room_timer, get_phase_token, claim_phase_token, get_vote_counts, get_voter_count, clear_votes, reap_stale_presence, update_roster, invalidate_room_players, set_night_order, end_night_turn
+from .clock import start_room_countdown, cancel_room_countdown, expire_phase_deadline
+from .state import GameState
+from .outbox import Outbox
+from .mailbox import room_task, redrive_mailboxes
+from .engine import RoomTask
 
-import redis
-
-redis_client = redis.StrictRedis(host='localhost', port=6379, db=1)
 
 
 channel_layer = get_channel_layer()
 
-@shared_task
+@shared_task(base=RoomTask)
+@room_task
 def send_role(player,code,role):
 
     # sends message to unqiue channel where user is the only one to receive this message
     
-    async_to_sync(channel_layer.group_send)(
+    loop_to_sync(channel_layer.group_send)(
         f'{player}_{code}',
         {
             'type': 'send_message',
@@ -38,12 +41,81 @@ def send_role(player,code,role):
         }
     )
 
-@shared_task
+# sends every player their role at once, one event loop hop for all players instead of a send_role task per player
+def send_roles(code, player_roles):
+    
+    with Outbox(code, channel_layer) as outbox:
+        for player, role in player_roles.items():
+            outbox.player(player, {
+                'type': 'role_show',
+                'role': role,
+                'message': f'your role is {role}',
+                'sender': 'SERVER'
+            })
+
+
+# applies a change to the room roster and sends the players only what changed (see services.update_roster)
+# (sent with the other messages of the outbox if there is one)
+def send_roster_delta(code, players=(), removed=(), replace=False, message=None, outbox=None):
+    
+    delta = update_roster(code, players, removed, replace)
+    
+    if delta is None:
+        return None
+    
+    if message is not None:
+        delta['message'] = message
+        delta['sender'] = 'SERVER'
+    
+    if outbox is not None:
+        outbox.room(delta)
+        return delta
+    
+    loop_to_sync(channel_layer.group_send)(
+        f'room_{code}',
+        {
+            'type': 'send_message',
+            'data': delta
+        }
+    )
+    
+    return delta
+
+
+# the player didn't reconnect within the grace window (see GameRoomConsumer.leaveAfterGrace)
+@shared_task(base=RoomTask)
+@room_task
+def leaveDisconnectedPlayer(user, code):
+    
+    try:
+        game = Game.objects.get(room_code=code)
+        player = Player.objects.get(username=user)
+    except (Game.DoesNotExist, Player.DoesNotExist):
+        return None
+    
+    # only players of a running game are removed from it
+    if not player.in_game or game.has_ended:
+        return False
+    
+    game.players.remove(player)
+    GameState.remove_player(code, user)
+    invalidate_room_players(code)
+    
+    checkDisconnectedRole(user, code)
+    
+    # notify other users who left, only the player that left is sent instead of the whole player list
+    send_roster_delta(code, removed=[user], message=f'{user} left the lobby')
+    
+    return True
+
+
+@shared_task(base=RoomTask)
+@room_task
 def checkDisconnectedRole(user, code):
     
     try:
         player = get_object_or_404(Player, username=user) # get disconnected user
-        game = get_object_or_404(Game, room_code=code)
+        state = GameState.load(code)
     except Exception as e:
         
         print(f'Error: {e}')
@@ -53,38 +125,34 @@ def checkDisconnectedRole(user, code):
     if current_turn is not None:
         current_turn = current_turn.decode('utf-8')
     
-    if game.game_phase == 3:
+    if state.game_phase == 3:
         
         
         if player.role == 'mangangaso' and player.role == current_turn:
-            next_role = searchAswangRole(game=game) # returns obj
+            next_role = nextNightTurn(state, user) # returns obj
             
-            aswang_players = PlayersInLobby(game.players.filter(
-                Q(role__startswith='aswang') & Q(alive=True) & Q(eliminated_from_game=False)
-            ), many=True).data
-
             # in the event where mangangaso and aswang disconnects, end the game
-            if not aswang_players  and not next_role :
-                game.game_phase = 4
-                game.save()
+            if next_role is None or not next_role.is_aswang:
+                state.game_phase = 4
+                state.save()
                 
-                phaseInitialize.apply_async(args=[code])
+                phaseInitialize.apply_async(args=[code, get_phase_token(code)])
                 return  True
             
             set_game_turn(code=code, role_turn=next_role.role)
-            async_to_sync(channel_layer.group_send)(
+            loop_to_sync(channel_layer.group_send)(
                 f'{next_role.username}_{code}',
                 {
                     'type': 'send_message',
                     'data': {
                         'type': 'player_select_target',
                         'player': next_role.username,
-                        'aswang_players': aswang_players
+                        'aswang_players': getAswangPlayers(state)
                     }
                 }
             )
             
-            async_to_sync(channel_layer.group_send)(
+            loop_to_sync(channel_layer.group_send)(
                 f'room_{code}',
                 {
                     'type': 'send_message',
@@ -99,7 +167,7 @@ def checkDisconnectedRole(user, code):
                 'role': next_role.role,
             }
             
-            async_to_sync(channel_layer.group_send)(
+            loop_to_sync(channel_layer.group_send)(
                 f'room_{code}',
                 {
                     'type': 'send_message',
@@ -109,30 +177,24 @@ def checkDisconnectedRole(user, code):
             return True
             
         elif player.role in ['aswang - mandurugo', 'aswang - manananggal', 'aswang - berbalang'] and current_turn in ['aswang - mandurugo', 'aswang - manananggal', 'aswang - berbalang']:
-            aswang_role = searchAswangRole(game=game)
-            aswang_players = getAswangPlayers(game=game)
+            next_role = nextNightTurn(state, user) # returns player obj
             
-            if aswang_role:
-                role = aswang_role.role
-                next_player = aswang_role.username
+            if next_role:
+                role = next_role.role
+                next_player = next_role.username
             else:
-                get_role = searchBabaylanOrManghuhula(game=game) # returns player obj
-                if get_role:
-                    role = get_role.role
-                    next_player = get_role.username
-                else:
-                    role = None
+                role = None
             
             if role is not None:
                 set_game_turn(code=code, role_turn=role)
-                async_to_sync(channel_layer.group_send)(
+                loop_to_sync(channel_layer.group_send)(
                     f'{next_player}_{code}',
                     {
                         'type': 'send_message',
                         'data': {
                             'type': 'player_select_target', # helps with multiple aswang during target select
                             'player': next_player,
-                            'aswang_players': aswang_players if role == 'aswang - mandurugo' or role == 'aswang - manananggal' or role == 'aswang - berbalang' else None
+                            'aswang_players': getAswangPlayers(state) if next_role.is_aswang else None
                         }
                     }
                 )
@@ -141,7 +203,7 @@ def checkDisconnectedRole(user, code):
                     'role': role,
                 }
                 
-                async_to_sync(channel_layer.group_send)(
+                loop_to_sync(channel_layer.group_send)(
                     f'room_{code}',
                     {
                         'type': 'send_message',
@@ -153,22 +215,22 @@ def checkDisconnectedRole(user, code):
                 
             else:
                 # game ends if there is no more roles after disconnected aswang
-                game.game_phase = 4
-                game.save()
+                state.game_phase = 4
+                state.save()
                 
                 
-                phaseInitialize.apply_async(args=[code])
+                phaseInitialize.apply_async(args=[code, get_phase_token(code)])
                 return True
             
             
         elif player.role == 'babaylan' and player.role == current_turn:
-            role_manghuhula = checkRoleStatus(game=game, role='manghuhula') # returns player obj
+            role_manghuhula = nextNightTurn(state, user) # returns player obj
 
             if role_manghuhula:
                 role = role_manghuhula.role
                 next_player = role_manghuhula.username
                 set_game_turn(code=code, role_turn=role)
-                async_to_sync(channel_layer.group_send)(
+                loop_to_sync(channel_layer.group_send)(
                     f'{next_player}_{code}',
                     {
                         'type': 'send_message',
@@ -183,7 +245,7 @@ def checkDisconnectedRole(user, code):
                     'role': role,
                 }
                 
-                async_to_sync(channel_layer.group_send)(
+                loop_to_sync(channel_layer.group_send)(
                     f'room_{code}',
                     {
                         'type': 'send_message',
@@ -192,18 +254,18 @@ def checkDisconnectedRole(user, code):
                 )
                 return True
             else:
-                game.game_phase = 4
-                game.save()
+                state.game_phase = 4
+                state.save()
                 
-                phaseInitialize.apply_async(args=[code])
+                phaseInitialize.apply_async(args=[code, get_phase_token(code)])
                 return True
             
         elif player.role == 'manghuhula' and player.role == current_turn:
             
-            game.game_phase = 4
-            game.save()
+            state.game_phase = 4
+            state.save()
             
-            phaseInitialize.apply_async(args=[code])
+            phaseInitialize.apply_async(args=[code, get_phase_token(code)])
             return True
         
         else:
@@ -213,18 +275,23 @@ def checkDisconnectedRole(user, code):
         return True # ?? tama ba toh ??  
     
 
+# fallback for GAME_TIMER_BACKEND = 'celery', the room clock service (game/clock.py) handles countdowns otherwise
 @shared_task
-def countdown_timer(code, duration):
+def countdown_timer(code, duration, timer_id=None, token=None):
     
     #redis_timer = redis_client.get(f'game_{code}_timer')
     
+    # countdown was cancelled (phase ended early) or replaced by a newer one
+    if timer_id is not None and get_room_timer(code) != timer_id:
+        return None
+    
     redis_key = f'game_{code}_timer'
     
     # Store the countdown value in Redis
     redis_client.set(redis_key, duration)
     
     # Send update to the channel layer
-    async_to_sync(channel_layer.group_send)(f'room_{code}', {
+    loop_to_sync(channel_layer.group_send)(f'room_{code}', {
         'type': 'send_message',
         'data': {
             'type': 'countdown',
@@ -235,35 +302,85 @@ def countdown_timer(code, duration):
     # Check if there is more time left
     if duration > 1:
         # Schedule the next update after 1 second
-        countdown_timer.apply_async(args=[code, duration - 1], countdown=1)
+        countdown_timer.apply_async(args=[code, duration - 1, timer_id, token], countdown=1)
     else:
         # Call the next phase or action
-        phaseInitialize.apply_async(args=[code], countdown=1)
+        countdown_expired.apply_async(args=[code, timer_id, token], countdown=1)
         
+
+@shared_task
+def countdown_expired(code, timer_id=None, token=None):
+    
+    if timer_id is not None and get_room_timer(code) != timer_id:
+        return None
+    
+    expire_phase_deadline(code, token)
+    
+    
+# the room's tally and the votes in the game state are cleared together, otherwise phaseActionsComplete
+# would count the votes of the last day
+def clearVotes(code, state):
+    
+    clear_votes(code)
+    
+    # the eliminated players don't vote, theirs don't count anymore
+    for player in state.alive_players():
+        player.vote_target = None
+
+
+# checks if every action the phase is waiting for is already in, the phase doesn't need to wait for its countdown then
+# voters is the number of players in the room's tally (from cast_vote), read from the tally when not given. the
+# snapshot of the game state can miss a vote that is being cast at the same time, the tally can't
+def phaseActionsComplete(state, voters=None):
+    
+    # voting phase, every player still in the game has voted
+    if int(state.game_phase) == 7:
+        if voters is None:
+            voters = get_voter_count(state.code)
+        return voters >= len(state.alive_players())
+    
+    return False
+
+
+# ends the current phase without waiting for the rest of its countdown
+def endPhaseEarly(code, phase=None):
+    
+    # read before cancelling, if the countdown already expired both transitions share the token and only one runs
+    token = get_phase_token(code)
+    
+    cancel_room_countdown(code, phase)
+    phaseInitialize.delay(code, token)
+    
     
 # alternative solution instead of it being handled by the frontend, this ensures synchronicity of all clients related to the game
-@shared_task
-def phaseCountdown(code): 
+@shared_task(base=RoomTask)
+@room_task
+def phaseCountdown(code, token=None): 
     print('sending')
+    
+    # the room already moved past the phase this countdown was scheduled for
+    if token is not None and get_phase_token(code) != int(token):
+        return None
+    
     try:
-        game = get_object_or_404(Game, room_code=code)
+        state = GameState.load(code)
     except Exception as e:
         print(f'Error: {e}')
-        game = None
+        state = None
 
-    if game:
-        print('game countdown current phase: ',game.game_phase)
+    if state:
+        print('game countdown current phase: ',state.game_phase)
         
-        if int(game.game_phase) == 1:
+        if int(state.game_phase) == 1:
             countdown = 10
            
-        elif int(game.game_phase) == 2:
-            game.night_count += 1
+        elif int(state.game_phase) == 2:
+            state.night_count += 1
             countdown = 5
-            game.save()
-            game_time = game.night_count
+            state.save()
+            game_time = state.night_count
 
-            async_to_sync(channel_layer.group_send)(
+            loop_to_sync(channel_layer.group_send)(
                 f'room_{code}',
                 {
                     'type': 'send_message',
@@ -274,14 +391,14 @@ def phaseCountdown(code):
                 }
             )
             
-        elif int(game.game_phase) == 4:
-            game.day_count += 1
-            game.cycle += 1
-            game.save()
+        elif int(state.game_phase) == 4:
+            state.day_count += 1
+            state.cycle += 1
+            state.save()
             countdown = 5
-            game_time = game.day_count
+            game_time = state.day_count
 
-            async_to_sync(channel_layer.group_send)(
+            loop_to_sync(channel_layer.group_send)(
                 f'room_{code}',
                 {
                     'type': 'send_message',
@@ -293,16 +410,16 @@ def phaseCountdown(code):
             )
             
             
-        elif int(game.game_phase) == 5:
+        elif int(state.game_phase) == 5:
             countdown = 5
             
             
-        elif int(game.game_phase) == 6:
+        elif int(state.game_phase) == 6:
              # 1 minute for players to discuss and decide to vote
             countdown = 60
             
             
-        elif int(game.game_phase) == 7:
+        elif int(state.game_phase) == 7:
              # only given 45 secs to cast their vote
             countdown = 45
             
@@ -312,76 +429,73 @@ def phaseCountdown(code):
             print('no phase')
             countdown = 10
             
-        if int(game.game_phase) > 9:
+        if int(state.game_phase) > 9:
             return None
 
-        countdown_timer.apply_async(args=[code, countdown]) 
+        start_room_countdown(code, countdown, phase=int(state.game_phase), token=token)
         
     else:
         return None
 
 # changes UI in frontend. Here we sort of "initialize" the phase, what are the things needed in each phase that is then reflected in the frontend
-@shared_task
-def phaseInitialize(code):
+@shared_task(base=RoomTask)
+@room_task
+def phaseInitialize(code, token=None):
+
+    if token is None:
+        token = get_phase_token(code)
+    
+    # another transition with the same token already ran (or is running), nothing to do
+    token = claim_phase_token(code, token)
+    if not token:
+        return True
 
     try:
-        game = Game.objects.get(room_code=code)
+        state = GameState.load(code)
     except Exception as e:
         print(f'Error {e}')
         return True
     
     
-    phase = int(game.game_phase) + 1
+    phase = int(state.game_phase) + 1
 
     # the player select target phase, if mangangaso is not alive, then the aswang will be the first player to select their target
     if phase == 3:
         
-        player_list = game.players.filter(Q(alive=True) & Q(eliminated_from_game=False))
-    
-        new_players_state_list = refreshPlayerState(player_list)
+        # everything this phase sends goes out at once at the end, one frame per group
+        outbox = Outbox(code, channel_layer)
         
-        # serialize the player list then send to frontend
-        current_players = PlayersInLobby(new_players_state_list, many=True).data
+        new_players_state_list = refreshPlayerState(state.alive_players())
         
-
-        async_to_sync(channel_layer.group_send)(
-            f'room_{code}',
-            {
-                'type': 'send_message',
-                'data': {
-                    'type': 'alive_players_list',
-                    'player_list': current_players
-                }
-            }
-        )
+        # only the players that were eliminated or revived since the last update are sent to the frontend
+        send_roster_delta(code, PlayersInLobby(new_players_state_list, many=True).data, replace=True, outbox=outbox)
         
         # this happens immediately whereas the view 'selectTarget' only happens when there is a request from the frontend
-        mangangaso = game.players.filter(role='mangangaso').first()
-        next_role = searchAswangRole(game) # returns obj
+        mangangaso = state.find('mangangaso', alive=False)
         
         
-        aswang_players = PlayersInLobby(game.players.filter(
-            Q(role__startswith='aswang') & Q(alive=True) & Q(eliminated_from_game=False)
-        ), many=True).data
+        aswang_players = PlayersInLobby(state.aswang_players(), many=True).data
         
         
         
         # mangangaso can protect if it has the same night count (since they will be rendered ineffective for a turn by the manananggal)
-        if mangangaso.night_skip == game.night_count:
+        if mangangaso.night_skip == state.night_count:
             mangangaso.skip_turn = False
-            mangangaso.save()
             
         
         
         # every cycle divisible by 5 (except 1st cycle which is 0), mangangaso can execute a player
-        if game.cycle % 5 == 0 and game.cycle != 0:
+        if state.cycle % 5 == 0 and state.cycle != 0:
             mangangaso.can_execute = True
-            mangangaso.save()
         
+        # the night's turns are worked out once here, passing a turn afterwards doesn't search the players again
+        mangangaso_skipped = mangangaso.skip_turn == True and mangangaso.in_game and int(mangangaso.night_skip) != (state.night_count)
+        night_order = setNightOrder(state, skip_mangangaso=mangangaso_skipped)
+        next_role = next((player for player in night_order if player.is_aswang), None) # returns obj
         
         
         # this will only show if the game has aswang type is manananggal
-        if mangangaso.skip_turn == True and mangangaso.alive == True and mangangaso.eliminated_from_game == False and int(mangangaso.night_skip) != (game.night_count):
+        if mangangaso.skip_turn == True and mangangaso.alive == True and mangangaso.eliminated_from_game == False and int(mangangaso.night_skip) != (state.night_count):
             
             data = {
                 'type': 'update_roleTurn',
@@ -389,17 +503,11 @@ def phaseInitialize(code):
                 'mangangaso_message_skip' : 'You are rendered ineffective during this night by the aswang, you cannot eliminate anyone' if mangangaso.can_execute else 'You are rendered ineffective during this night by the aswang, you cannot protect anyone' 
             }
             
-            async_to_sync(channel_layer.group_send)(
-                f'{next_role.username}_{code}',
-                {
-                    'type': 'send_message',
-                    'data': {
-                        'type': 'player_select_target',
-                        'player': next_role.username,
-                        'aswang_players': aswang_players
-                    }
-                }
-            )
+            outbox.player(next_role.username, {
+                'type': 'player_select_target',
+                'player': next_role.username,
+                'aswang_players': aswang_players
+            })
             
             
         
@@ -410,17 +518,11 @@ def phaseInitialize(code):
                 'role': next_role.role,
             }
             
-            async_to_sync(channel_layer.group_send)(
-                f'{next_role.username}_{code}',
-                {
-                    'type': 'send_message',
-                    'data': {
-                        'type': 'player_select_target',
-                        'player': next_role.username,
-                        'aswang_players': aswang_players
-                    }
-                }
-            )
+            outbox.player(next_role.username, {
+                'type': 'player_select_target',
+                'player': next_role.username,
+                'aswang_players': aswang_players
+            })
         else:
             data = {
                     'type': 'update_roleTurn',
@@ -428,74 +530,54 @@ def phaseInitialize(code):
                     'mangangaso_message': "Choose who you'll EXECUTE" if mangangaso.can_execute else "Choose who you'll PROTECT"
                 }
 
-        async_to_sync(channel_layer.group_send)(
-            f'room_{code}',
-            {
-                'type': 'send_message',
-                'data': data
-            }
-        )
+        outbox.room(data)
         
-        async_to_sync(channel_layer.group_send)(
-            f'{mangangaso.username}_{code}',
-            {
-                'type': 'send_message',
-                'data': {
-                    'type': 'player_select_target',
-                    'player': mangangaso.username,
-                }
-            }
-        )
+        outbox.player(mangangaso.username, {
+            'type': 'player_select_target',
+            'player': mangangaso.username,
+        })
         
         # send update phase to frontend to select target of users
-        async_to_sync(channel_layer.group_send)(
-            f'room_{code}',
-            {
-                'type': 'send_message',
-                'data': {
-                    'type': 'next_phase',
-                    'phase': phase
-                }
-            }
-        )
+        outbox.room({
+            'type': 'next_phase',
+            'phase': phase
+        })
         
-        game.game_phase = phase
-        game.save()
+        state.game_phase = phase
+        state.flush()
+        outbox.flush()
         
     # day announcement phase
     elif phase == 5:
 
         # execute night targets if there are any
-        for player in game.players.filter(Q(alive=True) & Q(eliminated_from_game=False)):
+        for player in state.alive_players():
             
             if player.night_target:
                 player_obj = player
                 player_obj.alive = False
-                player.eliminated_on_night = int(game.night_count)
-                player_obj.save()
+                player.eliminated_on_night = int(state.night_count)
                 
 
-        current_players = game.players.filter(Q(alive=True) & Q(eliminated_from_game=False))
+        winners, aswang_player_count, non_aswang_player_count = evaluateWinners(state)
         
-        aswang_player_count = game.players.filter(Q(role__startswith='aswang') & Q(alive=True) & Q(eliminated_from_game=False)).count()
-        
-        # when aswang/s eliminate the last non aswang player during the night
-        if aswang_player_count != 0 and current_players.filter(~Q(role__startswith='aswang')).count() == 0:
-            game.winners = 'Mga Aswang'
+        # the night ended the game, send to the voting result phase which moves on to the winning phase
+        if winners is not None:
+            state.winners = winners
             
             phase = 8
-            async_to_sync(channel_layer.group_send)(
+            loop_to_sync(channel_layer.group_send)(
                 f'room_{code}',
                 {
                     'type': 'send_message',
                     'data': {
                         'type': 'announce_winners',
-                        'winners': 'Mga Aswang',
-                        'message': 'There are no more players left aside from the aswang. Aswang wins!'
+                        'winners': winners,
+                        'message': WIN_MESSAGES[winners]
                     }
                 }
             )
-            async_to_sync(channel_layer.group_send)(
+            loop_to_sync(channel_layer.group_send)(
                 f'room_{code}',
                 {
                     'type': 'send_message',
@@ -505,81 +587,18 @@ def phaseInitialize(code):
                     }
                 }
             )
-            game.game_phase = phase
-            game.has_ended = True
-            game.save()
-            phaseCountdown.apply_async(args=[code])
-            
-        # situations where the aswang is killed my the mangangaso
-        elif aswang_player_count == 0  and current_players.filter(~Q(role__startswith='aswang')).count() >= 1:
-            game.winners = 'Mga Taumbayan'
-            async_to_sync(channel_layer.group_send)(
-                f'room_{code}',
-                {
-                    'type': 'send_message',
-                    'data': {
-                        'type': 'announce_winners',
-                        'winners': 'Mga Taumbayan',
-                        'message': 'The aswang were eliminated by the mangangaso. Taumbayan wins!'
-                    }
-                }
-            )
-            phase = 8
-            async_to_sync(channel_layer.group_send)(
-                f'room_{code}',
-                {
-                    'type': 'send_message',
-                    'data': {
-                        'type': 'next_phase',
-                        'phase': phase
-                    }
-                }
-            )
-            game.game_phase = phase
-            game.has_ended = True
-            game.save()
-            phaseCountdown.apply_async(args=[code])
-        
-        # rare cases where aswang and mangangaso eliminate each other during the night
-        elif aswang_player_count == 0  and current_players.filter(~Q(role__startswith='aswang')).count() == 0:
-            game.winners = 'TIE'
-            async_to_sync(channel_layer.group_send)(
-                f'room_{code}',
-                {
-                    'type': 'send_message',
-                    'data': {
-                        'type': 'announce_winners',
-                        'winners': 'TIE',
-                        'message': 'There are no more players left in the game. the result is a TIE'
-                    }
-                }
-            )
-            phase = 8
-            async_to_sync(channel_layer.group_send)(
-                f'room_{code}',
-                {
-                    'type': 'send_message',
-                    'data': {
-                        'type': 'next_phase',
-                        'phase': phase
-                    }
-                }
-            )
-            game.game_phase = phase
-            game.has_ended = True
-            game.save()
-            phaseCountdown.apply_async(args=[code])
+            state.game_phase = phase
+            state.has_ended = True
+            state.flush()
+            phaseCountdown.apply_async(args=[code, token])
             
         else:   
-            try:
-                eliminated_players = game.players.filter(eliminated_on_night=game.night_count).count()
-                revived_players = game.players.filter(revived_on_night=game.night_count).count()
-            except:
-                pass
+            players = [player for player in state.players.values() if player.eliminated_on_night == state.night_count]
+            eliminated_players = len(players)
+            revived_players = len([player for player in state.players.values() if player.revived_on_night == state.night_count])
                             
             if eliminated_players > 0 and revived_players == 0:
                 
-                players = game.players.filter(eliminated_on_night=game.night_count)
                 playersSerialized  = PlayersInLobby(players, many=True).data
                 
                 if eliminated_players > 1:
@@ -587,7 +606,7 @@ def phaseInitialize(code):
                 else:
                     message = f'There was {eliminated_players} victim during the night'
                     
-                async_to_sync(channel_layer.group_send)(
+                loop_to_sync(channel_layer.group_send)(
                     f'room_{code}',
                     {
                         'type': 'send_message',
@@ -599,7 +618,7 @@ def phaseInitialize(code):
                         }
                     }
                 )
-                async_to_sync(channel_layer.group_send)(
+                loop_to_sync(channel_layer.group_send)(
                     f'room_{code}',
                     {
                         'type': 'send_message',
@@ -610,17 +629,17 @@ def phaseInitialize(code):
                     }
                 )
                 
-                game.game_phase = phase
-                game.save()
+                state.game_phase = phase
+                state.flush()
                 
-                phaseCountdown.delay(code)
+                phaseCountdown.delay(code, token)
                 
             else:
                 player = 'none'
                 eliminated_players = 0
                 message = 'There were no victims during the night'
             
-                async_to_sync(channel_layer.group_send)(
+                loop_to_sync(channel_layer.group_send)(
                     f'room_{code}',
                     {
                         'type': 'send_message',
@@ -634,7 +653,7 @@ def phaseInitialize(code):
                 )
                 
             
-                async_to_sync(channel_layer.group_send)(
+                loop_to_sync(channel_layer.group_send)(
                     f'room_{code}',
                     {
                         'type': 'send_message',
@@ -645,26 +664,20 @@ def phaseInitialize(code):
                     }
                 )
                 
-                game.game_phase = phase
-                game.save()
+                state.game_phase = phase
+                state.flush()
                 
-                phaseCountdown.delay(code)
+                phaseCountdown.delay(code, token)
         
     # voting phase, send alive players so users can vote on any of them to be eliminated from the game
     elif phase == 7:
-        current_players = PlayersInLobby(game.players.filter(Q(alive=True) & Q(eliminated_from_game=False)), many=True).data
-        async_to_sync(channel_layer.group_send)(
-            f'room_{code}',
-            {
-                'type': 'send_message',
-                'data': {
-                    'type': 'alive_players_list',
-                    'player_list': current_players,
-                }
-            }
-        )
         
-        async_to_sync(channel_layer.group_send)(
+        # fresh tally for this round of votes
+        clearVotes(code, state)
+        
+        send_roster_delta(code, PlayersInLobby(state.alive_players(), many=True).data, replace=True)
+        
+        loop_to_sync(channel_layer.group_send)(
             f'room_{code}',
             {
                 'type': 'send_message',
@@ -675,50 +688,39 @@ def phaseInitialize(code):
             }
         )
         
-        game.game_phase = phase
-        game.save()
+        state.game_phase = phase
+        state.flush()
         
-        phaseCountdown.delay(code)
+        phaseCountdown.delay(code, token)
     
 
     # voting result phase, players will know if they eliminated the right player
     elif phase == 8:
 
         
-        players = game.players.filter(Q(alive=True) & Q(eliminated_from_game=False))
-        
-        vote_list = []
-        
-    
-        for i in players.iterator():
-            if i.vote_target is not None: # to ignore players who have not voted during this phase
-                vote_list.append(i.vote_target.username)
+        # counts of every voted player from the room's tally, players who left are ignored
+        vote_counts = {target: count for target, count in get_vote_counts(code).items() if target in state.players}
         
-        result = most_common(vote_list)
+        result = most_common(vote_counts)
 
         
         if result != 'tie':
             
-            player_eliminated = Player.objects.get(username=result)
+            player_eliminated = state.players[result]
             player_eliminated.eliminated_from_game = True
-            player_eliminated.save()
-            
             
-            current_players = game.players.filter(Q(alive=True) & Q(eliminated_from_game=False))
             
-            aswang_player_count = game.players.filter(
-                Q(role__startswith='aswang') & Q(eliminated_from_game=False) & Q(alive=True)
-            ).count()
+            winners, aswang_player_count, non_aswang_player_count = evaluateWinners(state)
             
             # if aswang players are the only players left in the game, send to last phase
-            if aswang_player_count != 0 and current_players.filter(~Q(role__startswith='aswang')).count() == 0:
+            if winners == 'Mga Aswang':
                 
-                game.winners = 'Mga Aswang'
+                state.winners = 'Mga Aswang'
                 
                 data = {
                     'type': 'announce_winners',
                     'winners': 'Mga Aswang',
-                    'message': 'There are no more players left aside from the aswang. Aswang wins!'
+                    'message': WIN_MESSAGES['Mga Aswang']
                 }
                 
                 phase = 8
@@ -726,14 +728,14 @@ def phaseInitialize(code):
             else:
                 
                 
-                if player_eliminated.role == 'aswang - mandurugo' or player_eliminated.role == 'aswang - manananggal' or player_eliminated.role == 'aswang - berbalang':
+                if player_eliminated.is_aswang:
                 
-                    if aswang_player_count >=1:
+                    if winners is None:
                         message = f"The player eliminated IS the aswang. there's {aswang_player_count} remaining. the game continues..."
                         
                     else:
                         message = f"The player eliminated IS the aswang. there's {aswang_player_count} remaining. taumbayan wins!"
-                        game.winners = 'Mga Taumbayan' # send to winning phase (which is next phase, phase 9)
+                        state.winners = 'Mga Taumbayan' # send to winning phase (which is next phase, phase 9)
                         
                     data = {
                         'type': 'is_aswang',
@@ -755,14 +757,14 @@ def phaseInitialize(code):
                 'message': 'the vote is a TIE. no one will be eliminated'
             }
             
-        async_to_sync(channel_layer.group_send)(
+        loop_to_sync(channel_layer.group_send)(
             f'room_{code}',
             {
                 'type': 'send_message',
                 'data': data
             }
         )
-        async_to_sync(channel_layer.group_send)(
+        loop_to_sync(channel_layer.group_send)(
             f'room_{code}',
             {
                 'type': 'send_message',
@@ -772,23 +774,25 @@ def phaseInitialize(code):
                 }
             }
         )
-        mangangaso = game.players.filter(Q(role='mangangaso') & Q(alive=True) & Q(eliminated_from_game=False)).first()
+        mangangaso = state.find('mangangaso')
         if mangangaso:
             set_game_turn(code=code, role_turn='mangangaso')
         else:
-            role = searchAswangRole(game=game)
-            set_game_turn(code=code, role_turn=role.role)
-        game.game_phase = phase
-        game.save()
-        phaseCountdown.delay(code)
+            # turn_done of the aswang is only reset on the next night, so take the first aswang still in the game
+            aswang_players = state.aswang_players()
+            if aswang_players:
+                set_game_turn(code=code, role_turn=aswang_players[0].role)
+        state.game_phase = phase
+        state.flush()
+        phaseCountdown.delay(code, token)
         
         
     elif phase == 9:
         # go back to phase 2 to continue the game
-        if game.winners is None:
+        if state.winners is None:
             phase = 2
             
-            async_to_sync(channel_layer.group_send)(
+            loop_to_sync(channel_layer.group_send)(
                 f'room_{code}',
                 {
                     'type': 'send_message',
@@ -798,16 +802,16 @@ def phaseInitialize(code):
                     }
                 }
             )
-            game.game_phase = phase
-            game.save()
-            phaseCountdown.delay(code)
+            state.game_phase = phase
+            state.flush()
+            phaseCountdown.delay(code, token)
         else:
             data = {
                 'type': 'announce_winners',
-                'winners': str(game.winners)
+                'winners': str(state.winners)
             }
             
-            async_to_sync(channel_layer.group_send)(
+            loop_to_sync(channel_layer.group_send)(
                 f'room_{code}',
                 {
                     'type': 'send_message',
@@ -815,7 +819,7 @@ def phaseInitialize(code):
                 }
             )
             
-            async_to_sync(channel_layer.group_send)(
+            loop_to_sync(channel_layer.group_send)(
                 f'room_{code}',
                 {
                     'type': 'send_message',
@@ -825,10 +829,13 @@ def phaseInitialize(code):
                     }
                 }
             )
-            game.game_phase = phase
-            game.has_ended = True
+            state.game_phase = phase
+            state.has_ended = True
             #game.completed = date.now
-            game.save()
+            state.flush()
+            
+            # game is over, nothing left to keep in memory
+            GameState.discard(code)
             
             return True
         
@@ -836,10 +843,10 @@ def phaseInitialize(code):
     
     # applies to phase 2, 4, and 6 that doesn't require any data
     else:
-        if phase == 4 and (game.day_count % 4 == 0 and game.cycle != 0):
-            mangangaso = game.players.filter(Q(role='mangangaso') & Q(alive=True) & Q(eliminated_from_game=False)).first()
+        if phase == 4 and (state.day_count % 4 == 0 and state.cycle != 0):
+            mangangaso = state.find('mangangaso')
             if mangangaso:
-                async_to_sync(channel_layer.group_send)(
+                loop_to_sync(channel_layer.group_send)(
                     f'{mangangaso.username}_{code}',
                     {
                         'type': 'send_message',
@@ -850,19 +857,8 @@ def phaseInitialize(code):
                     }
                 )
         if phase == 6:
-            current_players = PlayersInLobby(game.players.filter(Q(alive=True) & Q(eliminated_from_game=False)), many=True).data
-        
-            async_to_sync(channel_layer.group_send)(
-                f'room_{code}',
-                {
-                    'type': 'send_message',
-                    'data': {
-                        'type': 'alive_players_list',
-                        'player_list': current_players
-                    }
-                }
-            )
-        async_to_sync(channel_layer.group_send)(
+            send_roster_delta(code, PlayersInLobby(state.alive_players(), many=True).data, replace=True)
+        loop_to_sync(channel_layer.group_send)(
             f'room_{code}',
             {
                 'type': 'send_message',
@@ -873,9 +869,9 @@ def phaseInitialize(code):
             }
         )
         
-        game.game_phase = phase
-        game.save()
-        phaseCountdown.delay(code)
+        state.game_phase = phase
+        state.flush()
+        phaseCountdown.delay(code, token)
         
 @shared_task
 def delete_inactive_players():
@@ -887,12 +883,62 @@ def delete_inactive_players():
     
     return 'inactive players deleted'
 
+@shared_task
+def reapStalePresence():
+    removed = reap_stale_presence()
+    return f'{removed} stale presence entries removed'
+
+@shared_task
+def redriveMailboxes():
+    redriven = redrive_mailboxes()
+    return f'{len(redriven)} room mailboxes redriven'
+
+# win conditions, counted once from the game state instead of querying each team separately
+WIN_MESSAGES = {
+    'Mga Aswang': 'There are no more players left aside from the aswang. Aswang wins!', # when aswang/s eliminate the last non aswang player during the night
+    'Mga Taumbayan': 'The aswang were eliminated by the mangangaso. Taumbayan wins!', # situations where the aswang is killed my the mangangaso
+    'TIE': 'There are no more players left in the game. the result is a TIE', # rare cases where aswang and mangangaso eliminate each other during the night
+}
+
+def evaluateWinners(state):
+    
+    """
+    returns the winners with the player count of both teams (winners, aswang count, non aswang count)
+    
+    winners is 'Mga Aswang' if only aswang are left, 'Mga Taumbayan' if no aswang are left,
+    'TIE' if no one is left and None if the game continues
+    
+    """
+    
+    aswang_player_count = 0
+    non_aswang_player_count = 0
+    
+    for player in state.alive_players():
+        if player.is_aswang:
+            aswang_player_count += 1
+        else:
+            non_aswang_player_count += 1
+    
+    if aswang_player_count != 0 and non_aswang_player_count == 0:
+        winners = 'Mga Aswang'
+    elif aswang_player_count == 0 and non_aswang_player_count >= 1:
+        winners = 'Mga Taumbayan'
+    elif aswang_player_count == 0 and non_aswang_player_count == 0:
+        winners = 'TIE'
+    else:
+        winners = None
+    
+    return winners, aswang_player_count, non_aswang_player_count
+
+
 # vote counting function
 def most_common(lst):
     
     """returns 2 items stored in a list 
     (it returns the top 2 candidates with highest votes)
     
+    lst is either a list of votes or a dict of the vote count per player (the vote tally)
+    
     if at least 1 vote, continue with vote counting
     if more than 2 players are nominated, get the second index of data 
     
@@ -930,104 +976,84 @@ def most_common(lst):
 
 # each night the vote target and the is_protected status 
 # of all players that are still alive and not eliminated will be reset
+# (players are records of the game state, the reset is written to the database right away with one UPDATE
+# since every player gets the same values, instead of being flushed with the rest of the state)
+NIGHT_RESET_FIELDS = ('is_protected', 'night_target', 'vote_target', 'turn_done', 'can_execute')
+
 def refreshPlayerState(players):
     
     new_player_list = []
+    eliminated_player_ids = []
     
     for player in players:
         
         if player.alive == True and player.eliminated_from_game == False:
-            if player.is_protected == True:
-                player.is_protected = False
-                
+            player.is_protected = False
             player.night_target = None
             player.vote_target = None
             player.turn_done = False
-            if player.can_execute:
-                player.can_execute = False
+            player.can_execute = False
             
-            player.save()
+            player.mark_flushed(NIGHT_RESET_FIELDS)
             new_player_list.append(player)
             
-        # this applies to the players who were eliminated from the game to not interfere with the vote count   
-        player.vote_target = None
-        player.save()
+        else:
+            # this applies to the players who were eliminated from the game to not interfere with the vote count   
+            player.vote_target = None
+            player.mark_flushed(['vote_target'])
+            eliminated_player_ids.append(player.id)
+    
+    if new_player_list:
+        Player.objects.filter(id__in=[player.id for player in new_player_list]).update(
+            is_protected=False,
+            night_target=None,
+            vote_target=None,
+            turn_done=False,
+            can_execute=False
+        )
+    
+    if eliminated_player_ids:
+        Player.objects.filter(id__in=eliminated_player_ids).update(vote_target=None)
             
     return new_player_list
     
     
     
 # couldn't import from views becuase it would be a circular import error
-def searchAswangRole(game):
-    
-    aswang_player = game.players.filter(Q(role__startswith='aswang') & Q(turn_done=False) & Q(eliminated_from_game=False) & Q(alive=True)).first()
-    
-    if not aswang_player:
-        return None
-    else:
-        return aswang_player
-
 
-def getAswangPlayers(game):
+# mangangaso (unless the aswang made it sit this night out) -> every aswang in the game -> babaylan -> manghuhula,
+# returns the players in that order
+def setNightOrder(state, skip_mangangaso=False):
     
-    aswang_players = PlayersInLobby(game.players.filter(
-        Q(role__startswith='aswang') & Q(alive=True) & Q(eliminated_from_game=False) 
-    ), many=True).data
+    mangangaso = None if skip_mangangaso else state.find('mangangaso')
+    night_order = [mangangaso] if mangangaso else []
+    night_order += state.aswang_players()
+    night_order += [player for player in (state.find('babaylan'), state.find('manghuhula')) if player]
     
-    if not aswang_players:
-        return None
+    set_night_order(state.code, [player.username for player in night_order])
     
-    return aswang_players
+    return night_order
 
-def searchBabaylanOrManghuhula(game):
-    
-    role_babaylan = checkRoleStatus(game=game, role='babaylan')
-    role_manghuhula = checkRoleStatus(game=game, role='manghuhula')
+
+# ends the turn of the player, returns the player whose turn is next (None when the night is done)
+def nextNightTurn(state, username):
     
-    if role_babaylan:
-        role = role_babaylan
-    elif role_manghuhula:
-        role = role_manghuhula
-    else:    
-        role = None
+    for next_username in end_night_turn(state.code, username):
+        player = state.players.get(next_username)
+        if player is not None and player.in_game:
+            return player
         
-    return role
+        # left the game during the night, their turn is passed too
+        end_night_turn(state.code, next_username)
+    
+    return None
 
 
-# checks the alive players' role, since after aswang its either 
-# babaylan or manghuhula, whichever one is alive (can be both)
-def checkRoleStatus(game, role):
-    try: 
-        player = game.players.filter(
-            Q(alive=True) & 
-            Q(eliminated_from_game=False) &
-            Q(role=role)
-        ).first()
-        
-        if role == 'babaylan':
-            if player:
-                return player
-            else:
-                return None
-        elif role == 'mangangaso':
-            if player:
-                return player
-            else:
-                return None
-        elif role in ['aswang - mandurugo', 'aswang - manananggal', 'aswang - berbalang']:
-            if player:
-                return player
-            else:
-                return None
-            
-        elif role == 'manghuhula':
-            if player:
-                return player
-            else:
-                return None
-            
-        else:
-            return None
-    except Exception as e:
-        print(f'error {e}')
+def getAswangPlayers(state):
+    
+    aswang_players = PlayersInLobby(state.aswang_players(), many=True).data
+    
+    if not aswang_players:
         return None
+    
+    return aswang_players
@@ -1,3 +1,1242 @@
-from django.test import TestCase
+import asyncio
+import os
+import subprocess
+import sys
+import threading
+import time
+from unittest import mock
 
-# Create your tests here.
+import msgpack
+from asgiref.sync import sync_to_async
+from channels.layers import InMemoryChannelLayer
+from channels.routing import URLRouter
+from channels.testing import WebsocketCommunicator
+from django.conf import settings
+from django.test import SimpleTestCase, TestCase, override_settings
+from django.urls import path
+from rest_framework.test import APIClient
+
+from .models import Game, Player
+from .state import GameState
+from .views import assignRole
+from .tasks import refreshPlayerState, setNightOrder, nextNightTurn, clearVotes, phaseActionsComplete, endPhaseEarly, evaluateWinners, WIN_MESSAGES, NIGHT_RESET_FIELDS
+from .benchmark import GameSimulation, load_baselines, compare_with_baseline, stand_in_services
+from .consumers import GameRoomConsumer
+from .broadcast import broadcast_loop, loop_to_sync
+from .clock import RoomClock, start_room_countdown, cancel_room_countdown, expire_phase_deadline, poll_phase_deadlines
+from .mailbox import room_task, mailbox_keys, redrive_mailboxes
+from .engine import GameEngine, RoomEngineHost, engine, send_to_engine
+from .outbox import Outbox, unbatch
+from .serializers import PlayersInLobby
+from .services import update_roster, get_room_players, schedule_phase_deadline, new_phase_token, set_room_timer, get_room_timer, reap_stale_presence, clear_legacy_presence
+from .protocol import MSGPACK_SUBPROTOCOL, TYPE_CODES, encode_frame, decode_frame
+from . import services, tasks
+
+
+def createGame(player_count, code='TESTROOM'):
+
+    players = [Player.objects.create(username=f'player{i}') for i in range(player_count)]
+    game = Game.objects.create(owner=players[0], room_code=code)
+    game.players.add(*players)
+
+    return game, players
+
+
+class RefreshPlayerStateTest(TestCase):
+
+    def setUp(self):
+        self.game, self.players = createGame(10)
+
+        target = self.players[1]
+        Player.objects.update(
+            is_protected=True,
+            night_target=True,
+            turn_done=True,
+            can_execute=True,
+            vote_target=target,
+        )
+
+        self.state = GameState.from_db(self.game.room_code)
+
+    def test_reset_is_a_single_update(self):
+
+        with self.assertNumQueries(1):
+            refreshed = refreshPlayerState(self.state.alive_players())
+
+        self.assertEqual(len(refreshed), 10)
+
+        for player in Player.objects.all():
+            self.assertFalse(player.is_protected)
+            self.assertIsNone(player.night_target)
+            self.assertIsNone(player.vote_target)
+            self.assertFalse(player.turn_done)
+            self.assertFalse(player.can_execute)
+
+    def test_reset_returns_records_without_extra_queries(self):
+
+        refreshed = refreshPlayerState(self.state.alive_players())
+
+        with self.assertNumQueries(0):
+            for player in refreshed:
+                self.assertIsNone(player.vote_target)
+                self.assertFalse(player.turn_done)
+
+    def test_reset_is_not_written_again_on_flush(self):
+
+        refreshed = refreshPlayerState(self.state.alive_players())
+
+        for player in refreshed:
+            self.assertFalse(player.unflushed & set(NIGHT_RESET_FIELDS))
+
+    def test_eliminated_players_only_lose_their_vote(self):
+
+        eliminated = self.state.players['player2']
+        eliminated.eliminated_from_game = True
+
+        with self.assertNumQueries(2):
+            refreshed = refreshPlayerState(list(self.state.players.values()))
+
+        self.assertEqual(len(refreshed), 9)
+
+        player = Player.objects.get(username='player2')
+        self.assertIsNone(player.vote_target)
+        self.assertTrue(player.turn_done)
+
+
+class GameStateTest(TestCase):
+
+    def setUp(self):
+        self.enterContext(stand_in_services(lambda name, args: None, lambda *args, **kwargs: None))
+        self.game, self.players = createGame(5, code='STATE')
+
+    def test_concurrent_saves_of_different_players_are_merged(self):
+
+        first, second = GameState.load('STATE'), GameState.load('STATE')
+
+        first.players['player0'].vote_target = 'player1'
+        second.players['player1'].is_protected = True
+        second.game_phase = 7
+
+        first.save()
+        second.save()
+
+        state = GameState.load('STATE')
+        self.assertEqual(state.players['player0'].vote_target, 'player1')
+        self.assertTrue(state.players['player1'].is_protected)
+        self.assertEqual(state.game_phase, 7)
+
+    def test_write_between_watch_and_exec_is_retried(self):
+
+        # different fields of the same player, both end up in one hash field
+        first, second = GameState.load('STATE'), GameState.load('STATE')
+        first.players['player0'].turn_done = True
+        second.players['player0'].is_protected = True
+
+        # the second save lands after the first one read the stored records, its transaction has to start over
+        pipeline = services.redis_client.pipeline
+        raced = []
+
+        def racing_pipeline(*args, **kwargs):
+            pipe = pipeline(*args, **kwargs)
+            hmget = pipe.hmget
+
+            def racing_hmget(*args, **kwargs):
+                stored = hmget(*args, **kwargs)
+                if not raced:
+                    raced.append(True)
+                    second.save()
+                return stored
+
+            pipe.hmget = racing_hmget
+            return pipe
+
+        with mock.patch.object(services.redis_client, 'pipeline', racing_pipeline):
+            first.save()
+
+        state = GameState.load('STATE')
+        self.assertEqual(raced, [True])
+        self.assertTrue(state.players['player0'].turn_done)
+        self.assertTrue(state.players['player0'].is_protected)
+
+    def test_flush_writes_the_changes_in_two_queries(self):
+
+        state = GameState.load('STATE')
+        state.players['player0'].vote_target = 'player1'
+        state.players['player2'].alive = False
+        state.day_count = 2
+        state.save()
+
+        state = GameState.load('STATE')
+        with self.assertNumQueries(2):
+            state.flush()
+
+        self.assertEqual(Player.objects.get(username='player0').vote_target_id, self.players[1].id)
+        self.assertFalse(Player.objects.get(username='player2').alive)
+        self.assertEqual(Game.objects.get(id=self.game.id).day_count, 2)
+
+        # nothing is left to write, for this snapshot or the next one
+        state = GameState.load('STATE')
+        self.assertFalse(state.unflushed or any(player.unflushed for player in state.players.values()))
+        with self.assertNumQueries(0):
+            state.flush()
+
+    def test_removed_player_is_not_written_back(self):
+
+        state = GameState.load('STATE')
+        services.cast_vote('STATE', 'player3', 'player1')
+
+        GameState.remove_player('STATE', 'player3')
+        self.assertEqual(services.get_vote_counts('STATE'), {})
+
+        # a snapshot loaded before the player left still has them
+        state.players['player3'].turn_done = True
+        state.save()
+
+        self.assertNotIn('player3', GameState.load('STATE').players)
+
+
+class GameBenchmarkTest(TestCase):
+
+    """
+    plays a full game per room size and fails if a step needs more queries or messages than in
+    benchmark_baselines.json, run python manage.py benchmarkgame --write after an intended change
+    (the times are only compared by benchmarkgame)
+
+    """
+
+    def assertNoRegressions(self, player_count):
+
+        baseline = load_baselines()[str(player_count)]
+        results = GameSimulation(player_count).run()
+
+        self.assertEqual(compare_with_baseline(results, baseline, timing=False), [])
+
+    def test_5_players(self):
+        self.assertNoRegressions(5)
+
+    def test_8_players(self):
+        self.assertNoRegressions(8)
+
+    def test_10_players(self):
+        self.assertNoRegressions(10)
+
+
+@override_settings(PLAYER_RECONNECT_GRACE=0, PLAYER_HEARTBEAT_INTERVAL=60)
+class DisconnectTest(TestCase):
+
+    """
+    the disconnect path must not block the consumers' event loop, the leave is handed to a worker
+
+    """
+
+    ROOMS = 5
+    BROKER_DELAY = 0.05 # a slow broker, on the event loop every leave would stall every other socket for this long
+    MAX_LOOP_LAG = 0.1
+
+    def setUp(self):
+        self.games = []
+        for i in range(self.ROOMS):
+            players = [Player.objects.create(username=f'room{i}_player{j}', in_game=True) for j in range(10)]
+            game = Game.objects.create(owner=players[0], room_code=f'ROOM{i}')
+            game.players.add(*players)
+            self.games.append(game)
+
+        self.leaves = []
+        self.channel_layer = self.enterContext(stand_in_services(self.queue, lambda *args, **kwargs: None))
+        self.application = URLRouter([
+            path('ws/socket-server/<str:username>/<str:code>/', GameRoomConsumer.as_asgi()),
+        ])
+
+    def queue(self, name, args):
+        time.sleep(self.BROKER_DELAY)
+        self.leaves.append((name, args))
+
+    async def test_mass_disconnect_does_not_block_the_event_loop(self):
+
+        communicators = []
+        for game in self.games:
+            async for player in game.players.all():
+                communicators.append(WebsocketCommunicator(self.application, f'/ws/socket-server/{player.username}/{game.room_code}/'))
+
+        for communicator in communicators:
+            connected, _ = await communicator.connect()
+            self.assertTrue(connected)
+
+        lag = []
+        done = asyncio.Event()
+
+        async def watch_loop():
+            # how late a short sleep wakes up is how long the loop was blocked
+            while not done.is_set():
+                start = time.perf_counter()
+                await asyncio.sleep(0.005)
+                lag.append(time.perf_counter() - start - 0.005)
+
+        watcher = asyncio.create_task(watch_loop())
+
+        await asyncio.gather(*[communicator.disconnect() for communicator in communicators])
+
+        for _ in range(200):
+            if len(self.leaves) == len(communicators):
+                break
+            await asyncio.sleep(0.01)
+
+        done.set()
+        await watcher
+
+        self.assertEqual(len(self.leaves), len(communicators))
+        self.assertTrue(all(name == 'leaveDisconnectedPlayer' for name, args in self.leaves))
+        self.assertLess(max(lag), self.MAX_LOOP_LAG)
+
+    def test_leave_removes_the_player_from_the_game(self):
+
+        game = self.games[0]
+        player = game.players.first()
+        update_roster(game.room_code, PlayersInLobby(game.players.all(), many=True).data, replace=True)
+
+        self.assertTrue(tasks.leaveDisconnectedPlayer(player.username, game.room_code))
+
+        self.assertFalse(game.players.filter(id=player.id).exists())
+        delta = self.channel_layer.sent[-1][1]['data']
+        self.assertEqual(delta['type'], 'roster_delta')
+        self.assertEqual(delta['removed'], [player.username])
+
+
+@override_settings(PLAYER_RECONNECT_GRACE=0.2, PLAYER_HEARTBEAT_INTERVAL=60)
+class ReconnectTest(TestCase):
+
+    def setUp(self):
+        self.game, self.players = createGame(2, code='GRACE')
+        self.leaves = []
+        self.enterContext(stand_in_services(lambda name, args: self.leaves.append((name, args)), lambda *args, **kwargs: None))
+        self.application = URLRouter([
+            path('ws/socket-server/<str:username>/<str:code>/', GameRoomConsumer.as_asgi()),
+        ])
+
+    async def connect(self):
+        communicator = WebsocketCommunicator(self.application, '/ws/socket-server/player0/GRACE/')
+        connected, _ = await communicator.connect()
+        self.assertTrue(connected)
+        return communicator
+
+    async def test_reconnecting_within_the_grace_window_keeps_the_player(self):
+
+        communicator = await self.connect()
+        await communicator.disconnect()
+
+        # a page refresh
+        await asyncio.sleep(0.05)
+        communicator = await self.connect()
+        await asyncio.sleep(0.3)
+        self.assertEqual(self.leaves, [])
+
+        await communicator.disconnect()
+        await asyncio.sleep(0.3)
+        self.assertEqual(self.leaves, [('leaveDisconnectedPlayer', ('player0', 'GRACE'))])
+
+    @override_settings(PLAYER_HEARTBEAT_INTERVAL=0.05, PLAYER_HEARTBEAT_TIMEOUT=0.15)
+    async def test_sockets_that_stop_answering_pings_are_closed(self):
+
+        communicator = await self.connect()
+        await communicator.receive_json_from() # player_list
+
+        # answering keeps the socket open past the timeout
+        for _ in range(5):
+            self.assertEqual(await communicator.receive_json_from(), {'type': 'ping'})
+            await communicator.send_json_to({'type': 'pong'})
+
+        # then the client goes quiet, the server closes the socket and the grace window starts
+        while (await communicator.receive_output(1))['type'] != 'websocket.close':
+            pass
+
+        # what the server sends the consumer once the socket is closed
+        await communicator.disconnect()
+
+        await asyncio.sleep(0.3)
+        self.assertEqual(self.leaves, [('leaveDisconnectedPlayer', ('player0', 'GRACE'))])
+
+
+@override_settings(PLAYER_RECONNECT_GRACE=0, PLAYER_HEARTBEAT_INTERVAL=60)
+class MsgpackProtocolTest(TestCase):
+
+    def setUp(self):
+        self.players = [Player.objects.create(username=f'msgpack{i}', in_game=True) for i in range(2)]
+        game = Game.objects.create(owner=self.players[0], room_code='PACK')
+        game.players.add(*self.players)
+
+        self.enterContext(stand_in_services(lambda *args: None, lambda *args, **kwargs: None))
+        self.application = URLRouter([
+            path('ws/socket-server/<str:username>/<str:code>/', GameRoomConsumer.as_asgi()),
+        ])
+
+    async def test_msgpack_and_json_clients_get_the_same_frames(self):
+
+        binary = WebsocketCommunicator(self.application, '/ws/socket-server/msgpack0/PACK/', subprotocols=[MSGPACK_SUBPROTOCOL])
+        text = WebsocketCommunicator(self.application, '/ws/socket-server/msgpack1/PACK/')
+
+        self.assertEqual(await binary.connect(), (True, MSGPACK_SUBPROTOCOL))
+        self.assertEqual(await text.connect(), (True, None))
+
+        frame = await binary.receive_output()
+        self.assertEqual(msgpack.unpackb(frame['bytes'])['type'], TYPE_CODES['player_list'])
+        self.assertEqual(decode_frame(frame['bytes'])['type'], 'player_list')
+
+        self.assertEqual(decode_frame(frame['bytes'])['players'], (await text.receive_json_from())['players'])
+
+        await binary.send_to(bytes_data=encode_frame({'type': 'ping'}))
+        self.assertEqual(decode_frame((await binary.receive_output())['bytes']), {'type': 'pong'})
+
+        await binary.disconnect()
+        await text.disconnect()
+
+
+@override_settings(PLAYER_RECONNECT_GRACE=0, PLAYER_HEARTBEAT_INTERVAL=60)
+class RosterTest(TestCase):
+
+    def setUp(self):
+        self.players = [Player.objects.create(username=f'roster{i}', in_game=True) for i in range(3)]
+        game = Game.objects.create(owner=self.players[0], room_code='ROSTER')
+        game.players.add(*self.players[:2])
+
+        self.enterContext(stand_in_services(lambda *args: None, lambda *args, **kwargs: None))
+        self.application = URLRouter([
+            path('ws/socket-server/<str:username>/<str:code>/', GameRoomConsumer.as_asgi()),
+        ])
+
+    def test_deltas_only_carry_what_changed(self):
+
+        first, second, third = [{'username': player.username, 'avatar': player.avatar} for player in self.players]
+
+        self.assertEqual(update_roster('ROSTER', [first, second])['added'], [first, second])
+        self.assertIsNone(update_roster('ROSTER', [first]))
+
+        delta = update_roster('ROSTER', [dict(first, avatar='babaylan'), third], replace=True)
+        self.assertEqual(delta['version'], 2)
+        self.assertEqual(delta['added'], [third])
+        self.assertEqual(delta['removed'], [second['username']])
+        self.assertEqual(delta['updated'], [dict(first, avatar='babaylan')])
+
+    def test_room_players_are_cached_until_the_room_changes(self):
+
+        with self.assertNumQueries(1):
+            get_room_players('ROSTER')
+        with self.assertNumQueries(0):
+            self.assertEqual([player['username'] for player in get_room_players('ROSTER')], ['roster0', 'roster1'])
+
+        APIClient().post('/game-api/join-room/', {'player': 'roster2', 'code': 'ROSTER'}, format='json')
+        self.assertEqual(len(get_room_players('ROSTER')), 3)
+
+        state = GameState.load('ROSTER')
+        state.players['roster0'].alive = False
+        state.players['roster1'].eliminated_from_game = True
+        state.flush()
+        self.assertEqual([player['username'] for player in get_room_players('ROSTER')], ['roster2'])
+
+    async def test_snapshot_is_only_sent_on_a_version_gap(self):
+
+        communicator = WebsocketCommunicator(self.application, '/ws/socket-server/roster0/ROSTER/')
+        await communicator.connect()
+
+        # the roster is built from the database on the first connect
+        snapshot = await communicator.receive_json_from()
+        self.assertEqual(snapshot['version'], 1)
+        self.assertEqual([player['username'] for player in snapshot['players']], ['roster0', 'roster1'])
+
+        await communicator.send_json_to({'type': 'roster_sync', 'version': 1})
+        self.assertTrue(await communicator.receive_nothing())
+
+        await sync_to_async(update_roster)('ROSTER', removed=['roster1'])
+        await communicator.send_json_to({'type': 'roster_sync', 'version': 1})
+        snapshot = await communicator.receive_json_from()
+        self.assertEqual((snapshot['version'], len(snapshot['players'])), (2, 1))
+
+        await communicator.disconnect()
+
+
+class OutboxTest(TestCase):
+
+    def setUp(self):
+        self.channel_layer = self.enterContext(stand_in_services(lambda *args: None, lambda *args, **kwargs: None))
+
+    def test_messages_to_the_same_group_are_one_frame(self):
+
+        with Outbox('BOX', self.channel_layer) as outbox:
+            outbox.room({'type': 'update_roleTurn', 'role': 'mangangaso'})
+            outbox.player('box0', {'type': 'player_select_target', 'player': 'box0'})
+            outbox.room({'type': 'next_phase', 'phase': 3})
+
+        self.assertEqual([group for group, message in self.channel_layer.sent], ['room_BOX', 'box0_BOX'])
+
+        batch = self.channel_layer.sent[0][1]['data']
+        self.assertEqual([data['type'] for data in unbatch(batch)], ['update_roleTurn', 'next_phase'])
+        self.assertEqual(unbatch(self.channel_layer.sent[1][1]['data']), [{'type': 'player_select_target', 'player': 'box0'}])
+
+        # the messages of a batch get their type codes too
+        self.assertEqual(msgpack.unpackb(encode_frame(batch))['messages'][1]['type'], TYPE_CODES['next_phase'])
+        self.assertEqual(decode_frame(encode_frame(batch)), batch)
+
+    def test_nothing_is_sent_when_the_task_fails(self):
+
+        with self.assertRaises(ValueError), Outbox('BOX', self.channel_layer) as outbox:
+            outbox.room({'type': 'next_phase', 'phase': 3})
+            raise ValueError
+
+        self.assertEqual(self.channel_layer.sent, [])
+
+
+class BroadcastLoopTest(SimpleTestCase):
+
+    @override_settings(GAME_BROADCAST_BACKEND='loop')
+    def test_sends_share_one_background_loop(self):
+
+        async def running_loop():
+            return asyncio.get_running_loop()
+
+        first = loop_to_sync(running_loop)()
+
+        self.assertIs(loop_to_sync(running_loop)(), first)
+        self.assertIs(broadcast_loop.loop, first)
+        self.assertTrue(first.is_running())
+
+    @override_settings(GAME_BROADCAST_BACKEND='loop')
+    def test_sends_from_many_threads_keep_their_order(self):
+
+        # the in memory layer is only read and written on the broadcast loop here
+        layer = InMemoryChannelLayer(capacity=1000)
+
+        def send(sender):
+            for i in range(20):
+                loop_to_sync(layer.send)(f'broadcast.{sender}', {'type': 'send_message', 'i': i})
+
+        threads = [threading.Thread(target=send, args=(sender,)) for sender in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join(timeout=10)
+
+        self.assertFalse(any(thread.is_alive() for thread in threads))
+        for sender in range(8):
+            received = [loop_to_sync(layer.receive)(f'broadcast.{sender}')['i'] for i in range(20)]
+            self.assertEqual(received, list(range(20)))
+
+    def test_sends_from_gevent_greenlets(self):
+
+        # a celery worker with -P gevent, the sends come from greenlets at the same time
+        script = '\n'.join([
+            'from gevent import monkey; monkey.patch_all()',
+            'import asyncio, django, gevent',
+            'django.setup()',
+            'from game.broadcast import broadcast_loop, loop_to_sync',
+            'async def double(i):',
+            '    await asyncio.sleep(0.01)',
+            '    return i * 2',
+            'greenlets = [gevent.spawn(loop_to_sync(double), i) for i in range(10)]',
+            'gevent.joinall(greenlets, timeout=10)',
+            'print([greenlet.value for greenlet in greenlets], broadcast_loop.loop.is_running())',
+        ])
+        env = dict(os.environ, DJANGO_SETTINGS_MODULE='kutob_backend.settings', GAME_BROADCAST_BACKEND='loop')
+        result = subprocess.run([sys.executable, '-c', script], cwd=settings.BASE_DIR, env=env, capture_output=True, text=True, timeout=60)
+
+        self.assertEqual(result.returncode, 0, result.stderr)
+        self.assertEqual(result.stdout.strip(), f'{[i * 2 for i in range(10)]} True')
+
+
+class StartGameTest(TestCase):
+
+    def setUp(self):
+        self.queued = []
+        self.enterContext(stand_in_services(lambda name, args: self.queued.append((name, args)), lambda *args, **kwargs: None))
+        self.client = APIClient()
+        self.game, self.players = createGame(5, code='START')
+
+    def start(self, code='START'):
+        return self.client.post('/game-api/start/', {'code': code}, format='json')
+
+    def test_unknown_rooms_leave_no_state(self):
+
+        self.assertEqual(self.start(code='NOSUCHROOM').status_code, 400)
+        self.assertEqual(services.redis_client.keys('room_*'), [])
+
+    def test_phase_token_keeps_increasing_across_games(self):
+
+        self.assertEqual(self.start().status_code, 200)
+        self.assertEqual(services.get_phase_token('START'), 1)
+
+        # the game is still running
+        self.assertEqual(self.start().status_code, 400)
+
+        Game.objects.filter(id=self.game.id).update(has_ended=True)
+        self.assertEqual(self.start().status_code, 200)
+
+        # a transition queued in the first game can't claim the token of the second one
+        self.assertEqual(services.get_phase_token('START'), 2)
+        self.assertEqual(services.claim_phase_token('START', 1), 0)
+        self.assertEqual([args for name, args in self.queued if name == 'phaseCountdown'], [('START', 1), ('START', 2)])
+
+
+class AssignRoleTest(TestCase):
+
+    def setUp(self):
+        self.game, self.players = createGame(10, code='ROLES')
+        Player.objects.update(in_lobby=True, vote_target=self.players[1])
+
+    def test_roles_are_dealt_in_one_update(self):
+
+        players = list(self.game.players.order_by('id'))
+
+        with self.assertNumQueries(1):
+            roles = assignRole(players, 3)
+
+        self.assertEqual(roles, {player.username: player.role for player in Player.objects.all()})
+        self.assertEqual([role for role in roles.values() if not role.startswith('aswang')], ['mangangaso', 'babaylan', 'manghuhula'] + ['taumbayan'] * 4)
+        self.assertEqual(len([role for role in roles.values() if role.startswith('aswang')]), 3)
+
+        # the vote of the last game in the room doesn't carry over
+        for player in Player.objects.all():
+            self.assertTrue(player.in_game)
+            self.assertFalse(player.in_lobby)
+            self.assertIsNone(player.vote_target)
+
+    def test_important_roles_come_first(self):
+
+        roles = assignRole(list(Player.objects.order_by('id')[:5]), 1)
+
+        self.assertEqual(list(roles), [f'player{i}' for i in range(5)])
+        self.assertEqual(roles['player0'], 'mangangaso')
+        self.assertTrue(roles['player1'].startswith('aswang'))
+        self.assertEqual([roles['player2'], roles['player3'], roles['player4']], ['babaylan', 'manghuhula', 'taumbayan'])
+
+
+class WinnersTest(TestCase):
+
+    def setUp(self):
+        self.channel_layer = self.enterContext(stand_in_services(lambda name, args: None, lambda *args, **kwargs: None))
+        self.game, self.players = createGame(5, code='WIN')
+
+        for player, role in zip(self.players, ['mangangaso', 'aswang - mandurugo', 'babaylan', 'manghuhula', 'taumbayan']):
+            Player.objects.filter(id=player.id).update(role=role, in_game=True)
+
+    def eliminate(self, *usernames):
+        state = GameState.load('WIN')
+        for username in usernames:
+            state.players[username].alive = False
+        return state
+
+    def test_winners_are_counted_from_the_alive_players(self):
+
+        self.assertEqual(evaluateWinners(self.eliminate('player2')), (None, 1, 3))
+        self.assertEqual(evaluateWinners(self.eliminate('player1')), ('Mga Taumbayan', 0, 4))
+        self.assertEqual(evaluateWinners(self.eliminate('player0', 'player2', 'player3', 'player4')), ('Mga Aswang', 1, 0))
+        self.assertEqual(evaluateWinners(self.eliminate(*[player.username for player in self.players])), ('TIE', 0, 0))
+
+        # voted out players count as eliminated too
+        state = GameState.load('WIN')
+        state.players['player1'].eliminated_from_game = True
+        self.assertEqual(evaluateWinners(state)[0], 'Mga Taumbayan')
+
+    def test_night_that_eliminates_everyone_ends_in_a_tie(self):
+
+        # the aswang and the mangangaso took each other out, the others were already gone
+        Player.objects.filter(username__in=['player2', 'player3', 'player4']).update(alive=False)
+        Player.objects.filter(username__in=['player0', 'player1']).update(night_target=True)
+        Game.objects.filter(id=self.game.id).update(game_phase=4)
+
+        tasks.phaseInitialize('WIN', new_phase_token('WIN'))
+
+        announcements = [message['data'] for group, message in self.channel_layer.sent if message['data'].get('type') == 'announce_winners']
+        self.assertEqual(announcements, [{'type': 'announce_winners', 'winners': 'TIE', 'message': WIN_MESSAGES['TIE']}])
+
+        game = Game.objects.get(id=self.game.id)
+        self.assertEqual((game.winners, game.has_ended, game.game_phase), ('TIE', True, 8))
+
+
+class VoteTest(TestCase):
+
+    def setUp(self):
+        self.enterContext(stand_in_services(lambda name, args: None, lambda *args, **kwargs: None))
+        self.client = APIClient()
+        self.game, self.players = createGame(5, code='VOTES')
+
+    def vote(self, player, target):
+        return self.client.patch('/game-api/vote-player/', {'code': 'VOTES', 'player': player, 'vote_target': target}, format='json')
+
+    def test_votes_outside_the_voting_phase_are_rejected(self):
+
+        Game.objects.filter(id=self.game.id).update(game_phase=3)
+
+        response = self.vote('player0', 'player1')
+        self.assertEqual((response.status_code, response.data['message']), (400, 'Voting is closed'))
+        self.assertEqual(services.get_vote_counts('VOTES'), {})
+        self.assertIsNone(GameState.load('VOTES').players['player0'].vote_target)
+
+    def test_votes_of_the_last_day_are_cleared_with_the_tally(self):
+
+        Game.objects.filter(id=self.game.id).update(game_phase=7)
+        for player in self.players:
+            self.assertEqual(self.vote(player.username, 'player1').status_code, 201)
+
+        state = GameState.load('VOTES')
+        self.assertTrue(phaseActionsComplete(state))
+
+        clearVotes('VOTES', state)
+        self.assertFalse(phaseActionsComplete(state))
+        self.assertEqual(services.get_vote_counts('VOTES'), {})
+
+
+class RecordingChannelLayer:
+
+    def __init__(self):
+        self.sent = []
+
+    async def group_send(self, group, message):
+        self.sent.append((group, message['data']))
+
+
+class SteppedRoomClock(RoomClock):
+
+    # the clock's time only moves when the test says so
+    time = 0
+
+    def now(self):
+        return self.time
+
+    async def step(self, time):
+        self.time = time
+        await self.tick(time)
+
+    async def expire(self, code, token=None):
+        self.expired.append((code, token))
+
+
+class RoomClockTest(SimpleTestCase):
+
+    def setUp(self):
+        self.channel_layer = RecordingChannelLayer()
+        self.clock = SteppedRoomClock(self.channel_layer)
+        self.clock.expired = []
+
+    def countdowns(self):
+        sent, self.channel_layer.sent = self.channel_layer.sent, []
+        return [(group, data['countdown']) for group, data in sent]
+
+    async def test_ticks_of_every_room_come_out_of_one_heap_in_time_order(self):
+
+        self.clock.start('A', 3, token=1)
+        await self.clock.step(0.5)
+        self.clock.start('B', 2, token=7)
+        self.assertEqual(self.countdowns(), [('room_A', 3)])
+
+        await self.clock.step(0.5)
+        self.assertEqual(self.countdowns(), [('room_B', 2)])
+
+        for time, countdowns in ((1, [('room_A', 2)]), (1.5, [('room_B', 1)]), (2, [('room_A', 1)]), (2.5, [])):
+            await self.clock.step(time)
+            self.assertEqual(self.countdowns(), countdowns)
+
+        self.assertEqual(self.clock.expired, [('B', 7)])
+
+        await self.clock.step(3)
+        self.assertEqual(self.clock.expired, [('B', 7), ('A', 1)])
+        self.assertEqual((self.clock.heap, self.clock.rooms), ([], {}))
+
+    async def test_missed_seconds_are_skipped_when_the_loop_falls_behind(self):
+
+        self.clock.start('LATE', 5)
+        await self.clock.step(0)
+        await self.clock.step(2.5)
+
+        # one countdown for the second it is now, not one for every second it missed
+        self.assertEqual(self.countdowns(), [('room_LATE', 5), ('room_LATE', 4)])
+        await self.clock.step(3)
+        self.assertEqual(self.countdowns(), [('room_LATE', 2)])
+
+    async def test_cancelled_and_replaced_countdowns_stop_ticking(self):
+
+        self.clock.start('CANCEL', 5)
+        self.clock.start('REPLACE', 5, token=1)
+        await self.clock.step(0)
+        self.countdowns()
+
+        self.clock.cancel('CANCEL')
+        self.clock.start('REPLACE', 2, token=2)
+
+        for time in (0, 1, 2, 3):
+            await self.clock.step(time)
+
+        self.assertEqual(self.countdowns(), [('room_REPLACE', 2), ('room_REPLACE', 1)])
+        self.assertEqual(self.clock.expired, [('REPLACE', 2)])
+
+
+class CountdownModeTest(TestCase):
+
+    def setUp(self):
+        self.channel_layer = self.enterContext(stand_in_services(lambda name, args: None, lambda *args, **kwargs: None))
+        self.countdown_timer = self.enterContext(mock.patch.object(tasks.countdown_timer, 'apply_async'))
+        self.countdown_expired = self.enterContext(mock.patch.object(tasks.countdown_expired, 'apply_async'))
+
+    def sent(self):
+        return [message['data'] for group, message in self.channel_layer.sent]
+
+    async def test_deadline_rooms_only_get_their_deadline_on_the_clock(self):
+
+        clock = SteppedRoomClock(RecordingChannelLayer())
+        clock.expired = []
+
+        clock.start('DEADLINE', 2, ticks=False, token=3)
+        for time in (0, 1, 1.9):
+            await clock.step(time)
+        self.assertEqual((clock.channel_layer.sent, clock.expired), ([], []))
+
+        await clock.step(2)
+        self.assertEqual((clock.channel_layer.sent, clock.expired), ([], [('DEADLINE', 3)]))
+
+    @override_settings(GAME_COUNTDOWN_MODE='deadline')
+    def test_deadline_mode_sends_the_deadline_once_and_corrects_it_when_cut_short(self):
+
+        start_room_countdown('DEADLINE', 30, phase=7, token=1)
+
+        deadline, = self.sent()
+        self.assertEqual((deadline['type'], deadline['phase'], deadline['duration'], deadline['correction']), ('phase_deadline', 7, 30, False))
+        self.assertAlmostEqual(deadline['deadline'] - deadline['server_time'], 30)
+
+        # only the end of the phase is scheduled, nothing every second
+        self.countdown_timer.assert_not_called()
+        self.assertEqual(self.countdown_expired.call_args.kwargs['countdown'], 30)
+
+        cancel_room_countdown('DEADLINE', phase=7)
+        correction = self.sent()[-1]
+        self.assertEqual((correction['type'], correction['duration'], correction['correction']), ('phase_deadline', 0, True))
+
+    def test_ticks_mode_sends_no_deadline(self):
+
+        start_room_countdown('TICKS', 30, phase=7, token=1)
+        cancel_room_countdown('TICKS', phase=7)
+
+        self.assertEqual(self.sent(), [])
+        self.assertEqual(self.countdown_timer.call_args.kwargs['args'][:2], ['TICKS', 30])
+        self.countdown_expired.assert_not_called()
+
+
+class LegacyPresenceTest(TestCase):
+
+    def setUp(self):
+        self.enterContext(stand_in_services(lambda name, args: None, lambda *args, **kwargs: None))
+
+    def test_only_keys_of_the_legacy_shape_are_cleared(self):
+
+        client = services.redis_client
+        client.set('room_OLD_player_juan', 'connected')
+        client.set('room_OLD_player_maria', 'disconnected')
+        client.set('room_NEW_player_pedro', 'connected', ex=60) # has an expiry
+        client.hset('room_NEW_player_x_roster', 'a', 'connected') # a room key with _player_ in it
+        client.set('room_NEW_players', 'cached')
+
+        # the beat only reaps the presence hashes
+        self.assertEqual(reap_stale_presence(), 0)
+        self.assertEqual(client.exists('room_OLD_player_juan'), 1)
+
+        self.assertEqual(clear_legacy_presence(), 2)
+        self.assertEqual(
+            [client.exists(key) for key in ('room_OLD_player_juan', 'room_OLD_player_maria', 'room_NEW_player_pedro', 'room_NEW_player_x_roster', 'room_NEW_players')],
+            [0, 0, 1, 1, 1]
+        )
+
+
+@override_settings(PHASE_DEADLINE_GRACE=0)
+class PhaseDeadlineTest(TestCase):
+
+    def setUp(self):
+        self.queued = []
+        self.enterContext(stand_in_services(lambda name, args: self.queued.append((name, args)), lambda *args, **kwargs: None))
+
+    def test_lost_countdown_is_ended_by_the_poller_once(self):
+
+        schedule_phase_deadline('LOST', 1, 0)
+        schedule_phase_deadline('LOST', 2, 0) # replaces the first one
+
+        self.assertEqual(poll_phase_deadlines(), [('LOST', 2)])
+        self.assertEqual(poll_phase_deadlines(), [])
+        self.assertEqual(self.queued, [('phaseInitialize', ('LOST', 2))])
+
+        # the countdown turning up late doesn't run the transition again
+        expire_phase_deadline('LOST', 2)
+        self.assertEqual(len(self.queued), 1)
+
+    def test_countdown_that_ends_claims_its_deadline(self):
+
+        schedule_phase_deadline('ENDED', 1, 0)
+        expire_phase_deadline('ENDED', 1)
+
+        self.assertEqual(poll_phase_deadlines(), [])
+        self.assertEqual(self.queued, [('phaseInitialize', ('ENDED', 1))])
+
+
+class NightTurnOrderTest(TestCase):
+
+    def setUp(self):
+        self.enterContext(stand_in_services(lambda name, args: None, lambda *args, **kwargs: None))
+
+        self.game, self.players = createGame(6, code='NIGHT')
+        for player, role in zip(self.players, ['mangangaso', 'aswang - mandurugo', 'aswang - berbalang', 'babaylan', 'manghuhula', 'taumbayan']):
+            player.role = role
+            player.save()
+
+        self.state = GameState.load('NIGHT')
+
+    def turns(self, *usernames):
+        turns = [nextNightTurn(self.state, username) for username in usernames]
+        return [player.username if player else None for player in turns]
+
+    def test_turns_follow_the_order_of_the_night(self):
+
+        order = setNightOrder(self.state)
+        self.assertEqual([player.username for player in order], ['player0', 'player1', 'player2', 'player3', 'player4'])
+
+        # passing the turn doesn't read the players from the database again
+        with self.assertNumQueries(0):
+            self.assertEqual(self.turns('player0', 'player1', 'player2', 'player3', 'player4'), ['player1', 'player2', 'player3', 'player4', None])
+
+    def test_only_the_player_whose_turn_it_is_passes_it(self):
+
+        setNightOrder(self.state, skip_mangangaso=True)
+
+        # the mangangaso sat this night out and the second aswang acted out of turn
+        self.assertEqual(self.turns('player0', 'player2'), ['player1', 'player1'])
+        self.assertEqual(self.turns('player1'), ['player2'])
+
+    def test_players_that_left_during_the_night_are_skipped(self):
+
+        setNightOrder(self.state)
+        GameState.remove_player('NIGHT', 'player1')
+        self.state = GameState.load('NIGHT')
+
+        self.assertEqual(self.turns('player0', 'player2'), ['player2', 'player3'])
+
+
+@override_settings(PHASE_DEADLINE_GRACE=0)
+class EndPhaseEarlyTest(TestCase):
+
+    def setUp(self):
+        self.queued = []
+        self.enterContext(stand_in_services(lambda name, args: self.queued.append((name, args)), lambda *args, **kwargs: None))
+        self.client = APIClient()
+
+        self.game, self.players = createGame(5, code='EARLY')
+        Game.objects.filter(id=self.game.id).update(game_phase=7)
+
+        # the voting phase is running with its countdown (celery timer) and deadline
+        self.token = new_phase_token('EARLY')
+        self.timer_id = set_room_timer('EARLY')
+        schedule_phase_deadline('EARLY', self.token, 0)
+
+    def run_queued(self):
+        # runs the queued transitions, returns the phases the room went through
+        phases = []
+        queued, self.queued = self.queued, []
+        for name, args in queued:
+            if name == 'phaseInitialize':
+                tasks.phaseInitialize(*args)
+                phases.append(GameState.load('EARLY').game_phase)
+        return phases
+
+    def vote_all(self):
+        for player in self.players:
+            self.client.patch('/game-api/vote-player/', {'code': 'EARLY', 'player': player.username, 'vote_target': 'player1'}, format='json')
+
+    def test_last_vote_ends_the_phase_and_cancels_its_countdown(self):
+
+        self.vote_all()
+
+        self.assertEqual(self.queued, [('phaseInitialize', ('EARLY', self.token))])
+        self.assertIsNone(get_room_timer('EARLY'))
+        self.assertEqual(poll_phase_deadlines(), [])
+        self.assertEqual(self.run_queued(), [8])
+
+        # the countdown turning up afterwards doesn't move the room again
+        tasks.countdown_expired('EARLY', self.timer_id, self.token)
+        expire_phase_deadline('EARLY', self.token)
+        self.assertNotIn('phaseInitialize', [name for name, args in self.queued])
+
+    def test_early_end_and_expiry_at_the_same_time_run_one_transition(self):
+
+        # the countdown expired while the last vote was coming in, both carry the same token
+        expire_phase_deadline('EARLY', self.token)
+        self.vote_all()
+
+        self.assertEqual([args for name, args in self.queued if name == 'phaseInitialize'], [('EARLY', self.token), ('EARLY', self.token)])
+        self.assertEqual(self.run_queued(), [8, 8])
+        self.assertEqual(services.get_phase_token('EARLY'), self.token + 1)
+
+    def test_two_last_votes_at_the_same_time_end_the_phase(self):
+
+        for player in self.players[:3]:
+            self.client.patch('/game-api/vote-player/', {'code': 'EARLY', 'player': player.username, 'vote_target': 'player1'}, format='json')
+
+        # both requests loaded the room before the other one voted, neither snapshot has everyone's vote
+        snapshots = [GameState.load('EARLY'), GameState.load('EARLY')]
+        with mock.patch('game.views.GameState.load', side_effect=snapshots):
+            for player in self.players[3:]:
+                self.client.patch('/game-api/vote-player/', {'code': 'EARLY', 'player': player.username, 'vote_target': 'player1'}, format='json')
+
+        self.assertEqual(services.get_vote_counts('EARLY'), {'player1': 5})
+        self.assertEqual(self.queued, [('phaseInitialize', ('EARLY', self.token))])
+        self.assertEqual(self.run_queued(), [8])
+
+    def test_stale_tokens_are_ignored(self):
+
+        tasks.phaseInitialize('EARLY', self.token - 1)
+        self.assertEqual(GameState.load('EARLY').game_phase, 7)
+        self.assertIsNone(tasks.phaseCountdown('EARLY', self.token - 1))
+
+        # the phase isn't complete until everyone voted
+        self.client.patch('/game-api/vote-player/', {'code': 'EARLY', 'player': 'player0', 'vote_target': 'player1'}, format='json')
+        self.assertFalse(phaseActionsComplete(GameState.load('EARLY')))
+        self.assertEqual(self.queued, [])
+
+
+ran_room_tasks = []
+
+@room_task
+def recordRoomTask(code, value):
+    ran_room_tasks.append(value)
+    return value
+
+@room_task
+def recordNestedRoomTask(code, value):
+    ran_room_tasks.append(value)
+    return recordRoomTask(code, value + 1)
+
+
+class RoomMailboxTest(TestCase):
+
+    def setUp(self):
+        ran_room_tasks.clear()
+        self.enterContext(stand_in_services(lambda *args: None, lambda *args, **kwargs: None))
+
+    def test_tasks_of_a_busy_room_wait_for_its_worker(self):
+
+        self.assertEqual(recordRoomTask('MAILBOX', 1), 1)
+
+        # another worker has the room, the tasks are left in its mailbox in order
+        services.redis_client.set(mailbox_keys('MAILBOX')[0], 'other worker')
+        self.assertIsNone(recordRoomTask('MAILBOX', 2))
+        self.assertIsNone(recordRoomTask(code='MAILBOX', value=3))
+        self.assertEqual(recordRoomTask('OTHER', 4), 4)
+        self.assertEqual(ran_room_tasks, [1, 4])
+
+        # its worker died, the room is taken over once the owner expires
+        services.redis_client.delete(mailbox_keys('MAILBOX')[0])
+        self.assertEqual(recordRoomTask('MAILBOX', 5), 5)
+        self.assertEqual(ran_room_tasks, [1, 4, 2, 3, 5])
+
+    def test_mailboxes_of_dead_workers_are_redriven(self):
+
+        services.redis_client.set(mailbox_keys('STRANDED')[0], 'dead worker')
+        recordRoomTask('STRANDED', 1)
+
+        # its worker is still thought to be running it
+        self.assertEqual(redrive_mailboxes(), [])
+
+        services.redis_client.delete(mailbox_keys('STRANDED')[0])
+        self.assertEqual(redrive_mailboxes(), ['STRANDED'])
+        self.assertEqual(redrive_mailboxes(), [])
+        self.assertEqual(ran_room_tasks, [1])
+
+
+@override_settings(GAME_ENGINE='actor')
+class GameEngineTest(TestCase):
+
+    def setUp(self):
+        ran_room_tasks.clear()
+        self.channel_layer = self.enterContext(stand_in_services(lambda *args: None, lambda *args, **kwargs: None))
+
+    async def wait_for_room_tasks(self, count):
+        for _ in range(100):
+            if len(ran_room_tasks) >= count:
+                return
+            await asyncio.sleep(0.01)
+
+    async def test_room_tasks_run_in_order_on_the_room_actor(self):
+
+        engine.start()
+        try:
+            for value in range(3):
+                send_to_engine({'type': 'engine.task', 'code': 'ENGINE', 'task': 'recordRoomTask', 'args': ['ENGINE', value]})
+            await self.wait_for_room_tasks(3)
+
+            # from a process without the engine, through the channel layer
+            await self.channel_layer.send(settings.ROOM_ENGINE_CHANNEL, {'type': 'engine.task', 'code': 'ENGINE', 'task': 'recordRoomTask', 'args': ['ENGINE', 3]})
+
+            await self.wait_for_room_tasks(4)
+            self.assertEqual(ran_room_tasks, [0, 1, 2, 3])
+            self.assertEqual(list(engine.rooms), ['ENGINE'])
+        finally:
+            engine.stop()
+
+    async def test_room_tasks_called_on_the_actor_skip_the_mailbox(self):
+
+        # the mailbox would leave the nested task to this other worker
+        services.redis_client.set(mailbox_keys('NESTED')[0], 'other worker')
+
+        engine.start()
+        try:
+            send_to_engine({'type': 'engine.task', 'code': 'NESTED', 'task': 'recordNestedRoomTask', 'args': ['NESTED', 1]})
+            await self.wait_for_room_tasks(2)
+            self.assertEqual(ran_room_tasks, [1, 2])
+        finally:
+            engine.stop()
+
+    def test_room_tasks_with_a_countdown_go_to_the_engine(self):
+
+        with mock.patch('game.engine.send_to_engine') as send, mock.patch('celery.Task.apply_async') as broker:
+            tasks.phaseInitialize.__class__.apply_async(tasks.phaseInitialize, args=['ENGINE', 1], countdown=5)
+
+        send.assert_called_once_with({'type': 'engine.task', 'code': 'ENGINE', 'task': 'phaseInitialize', 'args': ['ENGINE', 1], 'kwargs': {}, 'countdown': 5})
+        broker.assert_not_called()
+
+    async def test_engine_waits_for_the_countdown_of_a_room_task(self):
+
+        engine.start()
+        try:
+            send_to_engine({'type': 'engine.task', 'code': 'LATER', 'task': 'recordRoomTask', 'args': ['LATER', 1], 'countdown': 0.1})
+            await asyncio.sleep(0.05)
+            self.assertEqual(ran_room_tasks, [])
+
+            await self.wait_for_room_tasks(1)
+            self.assertEqual(ran_room_tasks, [1])
+
+            # the engine stopped (lost its lease) before the countdown was over
+            send_to_engine({'type': 'engine.task', 'code': 'LATER', 'task': 'recordRoomTask', 'args': ['LATER', 2], 'countdown': 0.05})
+            await asyncio.sleep(0.01)
+            self.assertEqual(len(engine.timers), 1)
+        finally:
+            engine.stop()
+
+        await asyncio.sleep(0.1)
+        self.assertEqual(ran_room_tasks, [1])
+
+    async def test_daphne_process_takes_part_in_the_lease(self):
+
+        calls = []
+
+        async def application(scope, receive, send):
+            calls.append(scope['type'])
+
+        host = RoomEngineHost(application)
+        try:
+            await host({'type': 'websocket'}, None, None)
+            await host({'type': 'http'}, None, None)
+            lease = host.lease
+
+            await asyncio.sleep(0.05)
+            self.assertEqual(calls, ['websocket', 'http'])
+            self.assertIs(host.lease, lease)
+            self.assertTrue(engine.running_here())
+        finally:
+            host.lease.cancel()
+            await asyncio.gather(host.lease, return_exceptions=True)
+
+        self.assertFalse(engine.running_here())
+
+    @override_settings(ROOM_ENGINE_LEASE_TTL=0.3)
+    async def test_only_the_process_with_the_lease_hosts_the_rooms(self):
+
+        first, second = GameEngine(), GameEngine()
+        runs = [asyncio.create_task(first.run()), asyncio.create_task(second.run())]
+        try:
+            await asyncio.sleep(0.2)
+            self.assertEqual([first.running_here(), second.running_here()], [True, False])
+
+            # the first process stopped, the second one takes over
+            runs[0].cancel()
+            await asyncio.sleep(0.3)
+            self.assertEqual([first.running_here(), second.running_here()], [False, True])
+        finally:
+            for run in runs:
+                run.cancel()
+            await asyncio.gather(*runs, return_exceptions=True)
+
+
+@override_settings(PLAYER_RECONNECT_GRACE=0, PLAYER_HEARTBEAT_INTERVAL=60)
+class WebsocketActionTest(TestCase):
+
+    def setUp(self):
+        self.game, self.players = createGame(5, code='ACTIONS')
+        Game.objects.filter(id=self.game.id).update(game_phase=7)
+
+        self.channel_layer = self.enterContext(stand_in_services(lambda *args: None, lambda *args, **kwargs: None))
+        self.application = URLRouter([
+            path('ws/socket-server/<str:username>/<str:code>/', GameRoomConsumer.as_asgi()),
+        ])
+
+    async def receive(self, communicator, *message_types):
+        # the acknowledgement and the room's messages can arrive in any order
+        messages = {}
+        while set(message_types) - set(messages):
+            message = await communicator.receive_json_from()
+            messages[message['type']] = message
+        return [messages[message_type] for message_type in message_types]
+
+    async def test_actions_are_acknowledged_with_the_client_message_id(self):
+
+        communicator = WebsocketCommunicator(self.application, '/ws/socket-server/player0/ACTIONS/')
+        await communicator.connect()
+
+        await communicator.send_json_to({'type': 'cast_vote', 'id': 'vote-1', 'vote_target': 'player1'})
+
+        # the room gets the vote the same as from the rest endpoint
+        vote, ack = await self.receive(communicator, 'vote_delta', 'ack')
+        self.assertEqual((vote['username'], vote['vote_target']['username']), ('player0', 'player1'))
+        self.assertEqual((ack['id'], ack['action'], ack['status'], ack['message']), ('vote-1', 'cast_vote', 201, 'Nice vote!'))
+
+        await communicator.send_json_to({'type': 'select_target', 'id': 7, 'role': 'mangangaso', 'target': 'nobody'})
+        ack, = await self.receive(communicator, 'ack')
+        self.assertEqual((ack['id'], ack['status'], ack['message']), (7, 400, 'Player is not in the game'))
+
+        await communicator.disconnect()
+
+    @override_settings(GAME_ENGINE='actor')
+    async def test_actions_run_on_the_room_actor_in_actor_mode(self):
+
+        # the actor runs the action off the test's thread, the game state is in redis already so it doesn't need the database
+        await sync_to_async(GameState.load)('ACTIONS')
+
+        engine.start()
+        try:
+            communicator = WebsocketCommunicator(self.application, '/ws/socket-server/player0/ACTIONS/')
+            await communicator.connect()
+
+            await communicator.send_json_to({'type': 'cast_vote', 'id': 'vote-2', 'vote_target': 'player2'})
+
+            # the engine answers the socket that sent the action
+            vote, ack = await self.receive(communicator, 'vote_delta', 'ack')
+            self.assertEqual((ack['id'], ack['status'], vote['vote_target']['username']), ('vote-2', 201, 'player2'))
+            self.assertEqual(list(engine.rooms), ['ACTIONS'])
+
+            await communicator.disconnect()
+        finally:
+            engine.stop()
+
+    @override_settings(GAME_ENGINE='actor')
+    async def test_rest_actions_run_on_the_room_actor_in_actor_mode(self):
+
+        await sync_to_async(GameState.load)('ACTIONS')
+
+        engine.start()
+        try:
+            with mock.patch('game.views.votePlayerAction', side_effect=AssertionError('ran outside of the actor')):
+                response = await sync_to_async(APIClient().patch)('/game-api/vote-player/', {'code': 'ACTIONS', 'player': 'player0', 'vote_target': 'player3'}, format='json')
+
+            self.assertEqual((response.status_code, response.data['message']), (201, 'Nice vote!'))
+            self.assertEqual(list(engine.rooms), ['ACTIONS'])
+            self.assertEqual(await sync_to_async(services.get_vote_counts)('ACTIONS'), {'player3': 1})
+        finally:
+            engine.stop()
+
+    @override_settings(GAME_ENGINE='actor', ROOM_ENGINE_REPLY_TIMEOUT=0.1)
+    def test_rest_actions_fail_without_an_engine(self):
+
+        response = APIClient().patch('/game-api/vote-player/', {'code': 'ACTIONS', 'player': 'player0', 'vote_target': 'player3'}, format='json')
+
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(services.get_vote_counts('ACTIONS'), {})
@@ -1,15 +1,19 @@
+from django.conf import settings
 from django.shortcuts import render, get_object_or_404
+from django.http import Http404
 from rest_framework.response import Response
 from rest_framework.decorators import api_view
 from channels.layers import get_channel_layer
-from asgiref.sync import async_to_sync
+from .broadcast import loop_to_sync
+from .engine import call_engine_action
 from django.db.models import Q
 
 from .models import Game, Player
 from .serializers import GameSerializer
 from game.serializers import PlayersInLobby, PlayerVoteSerializer, PlayerSerializer
-from game.services import set_player_connected_non_sync, set_player_disconnected_non_sync, set_game_turn
-from .tasks import send_role, phaseCountdown, phaseInitialize
+from game.services import set_player_connected_non_sync, set_player_disconnected_non_sync, set_game_turn, get_phase_token, new_phase_token, cast_vote, clear_votes, remove_player_presence_non_sync, update_roster, get_room_players, invalidate_room_players
+from .tasks import send_roles, send_roster_delta, phaseCountdown, phaseInitialize, phaseActionsComplete, endPhaseEarly, nextNightTurn, getAswangPlayers
+from .state import GameState, get_state_or_404
 from django.core.cache import cache
 
 import math
@@ -65,6 +69,9 @@ def createRoom(request):
             user.save()
             
             game.save()
+            
+            invalidate_room_players(room_code)
+            update_roster(room_code, [PlayersInLobby(user).data], replace=True)
 
             context['message'] = 'Lobby created'
             return Response(context, status=200)
@@ -116,8 +123,11 @@ def joinRoom(request):
                 # add user to redis to keep track of player status: Connected or Disconnected
                 #set_player_connected_non_sync(username=user.username, code=code)
 
-                players = PlayersInLobby(game.players.all(), many=True).data
+                invalidate_room_players(game.room_code)
+                players = get_room_players(game.room_code)
                 
+                # the players already in the room only get the player who joined
+                send_roster_delta(game.room_code, [PlayersInLobby(user).data], message=f'{user.username} has joined the lobby')
                 
                 context['players'] = players
                 context['player_count'] = game.room_limit
@@ -155,6 +165,10 @@ def leaveRoom(request):
         if game.players.filter(username=player).exists():
             game.players.remove(player)
             player.game.remove(game)
+            GameState.remove_player(code, player.username)
+            remove_player_presence_non_sync(player.username, code)
+            invalidate_room_players(code)
+            send_roster_delta(code, removed=[player.username], message=f'{player.username} left the lobby')
             
             # to track the last time since user played, will be used to check if user is inactive 
             if game.has_ended or not player.in_lobby and not player.in_game:
@@ -187,7 +201,7 @@ def leaveRoom(request):
                 if random_player is not None:
                     player = PlayerSerializer(random_player).data
                     print(player.get('username'))
-                    async_to_sync(channel_layer.group_send)(
+                    loop_to_sync(channel_layer.group_send)(
                         f'room_{code}',
                         {
                             'type': 'send_message',
@@ -271,7 +285,7 @@ def updateRoomSettings(request):
                 }
                 
                 # broadcast message
-                async_to_sync(channel_layer.group_send)(
+                loop_to_sync(channel_layer.group_send)(
                     f'room_{code}',
                     {
                         'type': 'send_update_message',
@@ -363,7 +377,7 @@ def updateRoomSettings(request):
                 'update': update,
                 'new_aswang_limit': new_aswang_limit
             }
-            async_to_sync(channel_layer.group_send)(
+            loop_to_sync(channel_layer.group_send)(
                 f'room_{code}',
                 {
                     'type': 'send_update_message',
@@ -386,9 +400,6 @@ def startGameSession(request):
     code = request.data['code']
     channel_layer = get_channel_layer()
     
-    # set turn to mangangaso
-    set_game_turn(code=code, role_turn='mangangaso')
-    
     try: 
         game = Game.objects.get(room_code=code)
         
@@ -397,6 +408,15 @@ def startGameSession(request):
         context['message'] = 'Game not found'
         return Response(context, status=400)
     
+    if game.has_started and not game.has_ended:
+        context['message'] = 'Game already started'
+        return Response(context, status=400)
+    
+    # set turn to mangangaso
+    set_game_turn(code=code, role_turn='mangangaso')
+    token = new_phase_token(code)
+    clear_votes(code)
+    
     
     #ready_players = checkIfPlayersReady(game)
     
@@ -409,10 +429,16 @@ def startGameSession(request):
     if game:
         game.has_started = True
         game.room_state = 'IN_GAME'
-        players = game.players.all().order_by('?')
+        # shuffled here instead of order_by('?') which makes the database sort the whole table randomly
+        players = list(game.players.all())
+        random.shuffle(players)
         
 
         playerDict = assignRole(players=players, aswang_limit=game.aswang_limit)
+        
+        # roles changed, the game state is loaded again from the database on the first phase
+        GameState.discard(code)
+        invalidate_room_players(code)
             
         data = {
             'type': 'game_start',
@@ -422,7 +448,7 @@ def startGameSession(request):
         }
         
         # broadcast message to group to redirect users to game view
-        async_to_sync(channel_layer.group_send)(
+        loop_to_sync(channel_layer.group_send)(
             f'room_{code}',
             {
                 'type': 'send_message',
@@ -431,11 +457,9 @@ def startGameSession(request):
         )
         
         # each player in team will receive their respective role in the frontend
-        for player, role in playerDict.items():
-            print(player, role)
-            send_role.delay(player, code, role)
+        send_roles(code, playerDict)
         
-        phaseCountdown.delay(code)
+        phaseCountdown.delay(code, token)
         game.save()
         context['message'] = 'OK'
         return Response(context, status=200)
@@ -458,33 +482,68 @@ def checkIfPlayersReady(game):
 @api_view(['POST'])
 def selectTarget(request):
     
-    context = {}
+    if settings.GAME_ENGINE == 'actor':
+        return engineActionResponse('select_target', request.data['code'], request.data['player'], request.data)
     
-    channel_layer = get_channel_layer()
+    context, status = selectTargetAction(
+        code=request.data['code'],
+        role=request.data['role'],
+        username=request.data['player'], # refers to self
+        target_username=request.data['target'],
+    )
+    
+    return Response(context, status=status)
+    
+    
+@api_view(['PATCH'])
+def votePlayer(request):
+    
+    if settings.GAME_ENGINE == 'actor':
+        return engineActionResponse('cast_vote', request.data.get('code'), request.data.get('player'), request.data)
+    
+    context, status = votePlayerAction(
+        code=request.data.get('code'),
+        username=request.data.get('player'),
+        target_username=request.data.get('vote_target'),
+    )
+    
+    return Response(context, status=status)
 
 
-    code = request.data['code']
-    role = request.data['role']
+# the game actions, shared by the rest endpoints and the websocket actions of GameRoomConsumer
+# both return (context, status code)
+
+def selectTargetAction(code, role, username, target_username):
+    
+    context = {}
+    
+    channel_layer = get_channel_layer()
     
     
-    game = get_object_or_404(Game, room_code=code)
-    target = Player.objects.get(username=request.data['target'])
-    player = Player.objects.get(username=request.data['player']) # refers to self
+    state = get_state_or_404(code)
+    target = state.players.get(target_username)
+    player = state.players.get(username)
     
+    if target is None or player is None:
+        context['message'] = 'Player is not in the game'
+        return context, 400
     
-    role = roleTargetProcess(role=role, player=player, game=game, target=target, code=code)
+    role = roleTargetProcess(role=role, player=player, state=state, target=target, code=code)
+    
+    # targets are only kept in the game state until the night ends
+    state.save()
     
     if role == 'No role':
         context['aswang_message'] = 'Cannot select fellow aswang as target'
-        return Response(context, status=400)
+        return context, 400
     
     elif role == 'No role mangangaso':
         context['mangangaso_message'] = 'Cannot select yourself as target'
-        return Response(context, status=400)
+        return context, 400
     
     elif role == 'None': # a different none
         context['message'] = 'No aswang detected. Must be a connection problem'
-        return Response(context, status=400)
+        return context, 400
         
     elif role is not None:
         # next player with major role to select target
@@ -493,7 +552,7 @@ def selectTarget(request):
             'role': role,
         }
         
-        async_to_sync(channel_layer.group_send)(
+        loop_to_sync(channel_layer.group_send)(
             f'room_{code}',
             {
                 'type': 'send_message',
@@ -501,102 +560,145 @@ def selectTarget(request):
             }
         )
         context['message'] = 'OK'
-        return Response(context, status=200)
+        return context, 200
     
     else:
         # change phase
         context['message'] = 'night done'
-        phaseInitialize.delay(code)
-        return Response(context, status=200)
-    
-    
-@api_view(['PATCH'])
-def votePlayer(request):
+        phaseInitialize.delay(code, get_phase_token(code))
+        return context, 200
+
+
+def votePlayerAction(code, username, target_username):
     
     context = {}
     channel_layer = get_channel_layer()
-    code = request.data.get('code')
     
     try:
-        player_that_voted = get_object_or_404(Player, username=request.data['player'])
-        vote_target = get_object_or_404(Player, username=request.data['vote_target'])
-        game = get_object_or_404(Game, room_code=code)
+        state = get_state_or_404(code)
+        player_that_voted = state.players[username]
+        vote_target = state.players[target_username]
         
     except Exception as e:
         print(f'error {e}')
         context['message'] = 'Not found'
-        return Response(context, status=400)
+        return context, 400
+    
+    # votes are only counted during the voting phase
+    if int(state.game_phase) != 7:
+        context['message'] = 'Voting is closed'
+        return context, 400
+    
+    # eliminated players can't vote
+    if not player_that_voted.in_game:
+        context['message'] = 'Player is not in the game'
+        return context, 400
     
-    # assign vote target
-    player_that_voted.vote_target = vote_target
-    player_that_voted.save()
+    # assign vote target, written to the database when the voting result phase flushes the game state
+    player_that_voted.vote_target = vote_target.username
+    state.save()
     
-    # only get players that have voted
-    votes = PlayerVoteSerializer(game.players.filter(
-        Q(alive=True) & Q(eliminated_from_game=False) & ~Q(vote_target=None)
-    ), many=True).data
+    # counted in the room's tally, the result phase reads the counts from there
+    previous, counts, voters = cast_vote(code, player_that_voted.username, vote_target.username)
     
-    # send votes to frontend for icons of who voted for which user
-    async_to_sync(channel_layer.group_send)(
+    # send only the vote that changed, the frontend moves the voter's icon from the previous target to the new one
+    loop_to_sync(channel_layer.group_send)(
         f'room_{code}',
         {
             'type': 'send_message',
             'data': {
-                'type': 'update_votes',
-                'votes': votes
+                'type': 'vote_delta',
+                'username': player_that_voted.username,
+                'avatar': player_that_voted.avatar,
+                'vote_target': PlayerSerializer(vote_target).data,
+                'previous': previous,
+                'counts': counts
             }
         }
     )
     
+    
+    # everyone has voted, no need to wait for the rest of the voting countdown
+    if phaseActionsComplete(state, voters):
+        endPhaseEarly(code, state.game_phase)
             
     context['message'] = 'Nice vote!'
-    return Response(context, status=201)
+    return context, 201
+
+
+# websocket game actions, the same as the selectTarget/votePlayer endpoints. action -> (function, message field -> argument)
+GAME_ACTIONS = {
+    'select_target': (selectTargetAction, {'role': 'role', 'target': 'target_username'}),
+    'cast_vote': (votePlayerAction, {'vote_target': 'target_username'}),
+}
 
 
-def roleTargetProcess(role, player, game, target, code):
+# runs a websocket action of a player, returns the status and context of its acknowledgement
+def runGameAction(name, code, username, arguments):
+    
+    action, fields = GAME_ACTIONS[name]
+    
+    try:
+        context, status = action(code, username=username, **{argument: arguments.get(field) for field, argument in fields.items()})
+    except Http404:
+        context, status = {'message': 'Room does not exist'}, 404
+    except Exception as e:
+        print(f'Error: {e}')
+        context, status = {'message': 'Something went wrong'}, 500
+    
+    return {'status': status, **context}
+
+
+# with GAME_ENGINE = 'actor' the rest actions run on the actor of the room too, in turn with its phases
+def engineActionResponse(name, code, username, data):
+    
+    fields = GAME_ACTIONS[name][1]
+    ack = call_engine_action(name, code, username, {field: data.get(field) for field in fields})
+    status = ack.pop('status')
+    
+    return Response(ack, status=status)
+
+
+def roleTargetProcess(role, player, state, target, code):
     
     channel_layer = get_channel_layer()
     
     if role == 'mangangaso':
         
-        next_role = searchAswang(game=game)
-        aswang_players = getAswangPlayers(game=game)
-        
-        
         if not player.can_execute: # player refers to self
 
             target.is_protected = True
-            target.save()
-            role = next_role.role
         else:
             if target.username == player.username:
                 role = 'No role mangangaso'
                 return role   
             
             target.night_target = True
-            target.save()
-            role = next_role.role
+        
+        # the aswang come right after the mangangaso in the night's turn order
+        next_role = nextNightTurn(state, player.username)
             
         # end the game since there is no point in continuing the game when there is no aswang left
-        if next_role is None and not aswang_players:
-            game.game_phase = 4
-            game.save()
+        if next_role is None or not next_role.is_aswang:
+            state.game_phase = 4
+            state.save()
             set_game_turn(code=code, role_turn='mangangaso')
-            phaseInitialize.apply_async(args=[code])
+            phaseInitialize.apply_async(args=[code, get_phase_token(code)])
             
             # a different None type since the keyword None
             role = 'None' 
             return role
 
+        role = next_role.role
         set_game_turn(code=code, role_turn=next_role.role)
-        async_to_sync(channel_layer.group_send)(
+        loop_to_sync(channel_layer.group_send)(
             f'{next_role.username}_{code}',
             {
                 'type': 'send_message',
                 'data': {
                     'type': 'player_select_target', # helps with multiple aswang during target select
                     'player': next_role.username,
-                    'aswang_players': aswang_players
+                    'aswang_players': getAswangPlayers(state)
                 }
             }
         )
@@ -612,7 +714,6 @@ def roleTargetProcess(role, player, game, target, code):
             return role
         
         player_obj.night_target = True
-        player_obj.save()
         
         """
         need to check if players with these roles are alive, if true then change role to the corresponding role, 
@@ -621,33 +722,26 @@ def roleTargetProcess(role, player, game, target, code):
         """
         
         player.turn_done = True
-        player.save()
-        
-        aswang_role = searchAswang(game=game)
-        aswang_players = getAswangPlayers(game=game)
-
-        if aswang_role:
-            role = aswang_role.role
-            next_player = aswang_role.username
-        else: 
-            get_role = searchBabaylanOrManghuhula(game=game) # returns player obj
-            if get_role:
-                role = get_role.role
-                next_player = get_role.username
-                
-            else:
-                role = None
+        
+        # the next aswang, then babaylan or manghuhula, whoever is next in the night's turn order
+        next_role = nextNightTurn(state, player.username) # returns player obj
+
+        if next_role:
+            role = next_role.role
+            next_player = next_role.username
+        else:
+            role = None
         
         if role is not None:
             set_game_turn(code=code, role_turn=role)
-            async_to_sync(channel_layer.group_send)(
+            loop_to_sync(channel_layer.group_send)(
                 f'{next_player}_{code}',
                 {
                     'type': 'send_message',
                     'data': {
                         'type': 'player_select_target', # helps with multiple aswang during target select
                         'player': next_player,
-                        'aswang_players': aswang_players if role == 'aswang - mandurugo' or role == 'aswang - manananggal' or role == 'aswang - berbalang' else None
+                        'aswang_players': getAswangPlayers(state) if next_role.is_aswang else None
                     }
                 }
             )
@@ -667,53 +761,42 @@ def roleTargetProcess(role, player, game, target, code):
             player_obj = target
             
             player_obj.night_target = True
-            player_obj.save()
 
             
         # target will live but will render mangangaso ineffective next night
         elif target.is_protected == True:
-            mangangaso = game.players.filter(Q(alive=True) & Q(role='mangangaso')).first()
+            mangangaso = next((player for player in state.players.values() if player.alive and player.role == 'mangangaso'), None)
             
             if mangangaso: 
                 player_obj = mangangaso
                 player_obj.skip_turn = True
-                player_obj.night_skip = int(game.night_count) + 2
-                player_obj.save()
+                player_obj.night_skip = int(state.night_count) + 2
         
         player.turn_done = True
-        player.save()
 
         """
         need to check if players with these roles are alive, if true then change role to the corresponding role, 
         if both are not alive, then skip role and change phase 
         """
         
-        aswang_role = searchAswang(game=game)
-        aswang_players = getAswangPlayers(game=game)
+        next_role = nextNightTurn(state, player.username) # returns player obj
         
-        if aswang_role:
-            
-            role = aswang_role.role
-            next_player = aswang_role.username
-            
-        else: 
-            get_role = searchBabaylanOrManghuhula(game=game) # returns player obj
-            if get_role:
-                role = get_role.role
-                next_player = get_role.username
-            else:
-                role = None
+        if next_role:
+            role = next_role.role
+            next_player = next_role.username
+        else:
+            role = None
         
         if role is not None:    
             set_game_turn(code=code, role_turn=role)
-            async_to_sync(channel_layer.group_send)(
+            loop_to_sync(channel_layer.group_send)(
                 f'{next_player}_{code}',
                 {
                     'type': 'send_message',
                     'data': {
                         'type': 'player_select_target', # helps with multiple aswang during target select
                         'player': next_player,
-                        'aswang_players': aswang_players if role == 'aswang - mandurugo' or role == 'aswang - manananggal' or role == 'aswang - berbalang' else None
+                        'aswang_players': getAswangPlayers(state) if next_role.is_aswang else None
                     }
                 }
             )
@@ -731,36 +814,27 @@ def roleTargetProcess(role, player, game, target, code):
         if target.is_protected == False:
             player_obj = target
             player_obj.night_target = True
-            player_obj.save()
 
         player.turn_done = True
-        player.save()
         
-        aswang_role = searchAswang(game=game)
-        aswang_players = getAswangPlayers(game=game)
+        next_role = nextNightTurn(state, player.username) # returns player obj
         
-        if aswang_role:
-            
-            role = aswang_role.role
-            next_player = aswang_role.username
+        if next_role:
+            role = next_role.role
+            next_player = next_role.username
             set_game_turn(code=code, role_turn=role)
-        else: 
-            get_role = searchBabaylanOrManghuhula(game=game) # returns player obj
-            if get_role:
-                role = get_role.role
-                next_player = get_role.username
-            else:
-                role = None
+        else:
+            role = None
             
         if role is not None:
-            async_to_sync(channel_layer.group_send)(
+            loop_to_sync(channel_layer.group_send)(
                 f'{next_player}_{code}',
                 {
                     'type': 'send_message',
                     'data': {
                         'type': 'player_select_target', # helps with multiple aswang during target select
                         'player': next_player,
-                        'aswang_players':aswang_players if role == 'aswang - mandurugo' or role == 'aswang - manananggal' or role == 'aswang - berbalang' else None
+                        'aswang_players':getAswangPlayers(state) if next_role.is_aswang else None
                     }
                 }
             )
@@ -772,9 +846,8 @@ def roleTargetProcess(role, player, game, target, code):
         if player.night_target or target.night_target:
             player_obj = target
             player_obj.night_target = False
-            player_obj.save()
             
-        role_manghuhula = checkRoleStatus(game=game, role='manghuhula') # returns player obj
+        role_manghuhula = nextNightTurn(state, player.username) # returns player obj
         #redis_client.set
         if role_manghuhula:
             role = role_manghuhula.role
@@ -782,7 +855,7 @@ def roleTargetProcess(role, player, game, target, code):
             
             set_game_turn(code=code, role_turn=role)
             
-            async_to_sync(channel_layer.group_send)(
+            loop_to_sync(channel_layer.group_send)(
             f'{next_player}_{code}',
             {
                 'type': 'send_message',
@@ -800,7 +873,7 @@ def roleTargetProcess(role, player, game, target, code):
         
         set_game_turn(code=code, role_turn=role)
         
-        async_to_sync(channel_layer.group_send)(
+        loop_to_sync(channel_layer.group_send)(
             f'{player.username}_{code}',
             {
                 'type': 'send_message',
@@ -823,130 +896,29 @@ def assignRole(players, aswang_limit): # order of players are shuffled
     7-5 players and 1 aswang == 4 important figures (3 roles above and 1 aswang) 
     
     remaining players in the group will be the taumbayan
+    
+    the roles are dealt in order to the already shuffled players, important roles first
     """
 
-    count = int(aswang_limit)
-    player_role_dict = {}
-    
-    # initialize roles
-    roles = ['mangangaso', 'aswang', 'babaylan', 'manghuhula']
     aswang_roles = ['aswang - mandurugo', 'aswang - manananggal', 'aswang - berbalang'] 
     #'aswang - mandurugo'
     
-    for player in players:
+    # initialize roles, if there are less players than important roles the last ones are left out
+    roles = ['mangangaso'] + [random.choice(aswang_roles) for i in range(int(aswang_limit))] + ['babaylan', 'manghuhula']
+    roles += ['taumbayan'] * (len(players) - len(roles))
+    
+    player_role_dict = {}
+    
+    for player, role in zip(players, roles):
         player.in_lobby = False
         player.in_game = True
+        player.role = role
+        player.vote_target = None # left over from the last game in the room
         
-        while True:
-            role = random.choice(roles)
-            
-            # we must populate dictionary with the most important roles first before assigning taumbayan
-            if len(player_role_dict) >= (len(roles) + (aswang_limit - 1)):
-                player.role = 'taumbayan'
-                player.save()
-                player_role_dict[f'{player.username}'] = player.role
-                break
-            
-            # if important role is not yet in dictionary, add it
-            # this will catch the chances where the role is aswang, if its not yet in the role dictionary, then the
-            # aswang assign logic will happen here
-            if role not in player_role_dict.values() :
-                
-                if role != 'aswang':
-                    player.role = role
-                    player.save()
-                    player_role_dict[f'{player.username}'] = player.role
-                    
-                    break
-                
-                if role == 'aswang' and count != 0:
-                    aswang_role = random.choice(aswang_roles)
-                    count -= 1
-                    player.role = aswang_role
-                    player.save()
-                    
-                    player_role_dict[f'{player.username}'] = player.role
-                    break
-            
-            # if the aswang role is already in the dictionary and the role given is aswang
-            # as long as the count is not zero, this will run.
-            elif (role == 'aswang') and count != 0:
-
-                aswang_role = random.choice(aswang_roles)
-                count -= 1
-                player.role = aswang_role
-                player.save()
-    
-                # add player and role to dictionary
-                player_role_dict[f'{player.username}'] = player.role
-                
-                break       
-    player.save()
+        player_role_dict[f'{player.username}'] = player.role
     
-    return player_role_dict
-
-
-def getAswangPlayers(game):
-    
-    aswang_players = PlayersInLobby(game.players.filter(
-        Q(role__startswith='aswang') & Q(alive=True) & Q(eliminated_from_game=False) 
-    ), many=True).data
-    
-    if not aswang_players:
-        return None
-    
-    return aswang_players
-
-
-
-def searchAswang(game):
-    
-    aswang_player = game.players.filter(Q(role__startswith='aswang') & Q(turn_done=False) & Q(eliminated_from_game=False) & Q(alive=True)).first()
-    if not aswang_player:
-        return None
-    else:
-        return aswang_player
-
-
-def searchBabaylanOrManghuhula(game):
+    # all roles are written at once
+    Player.objects.bulk_update(players, ['role', 'in_lobby', 'in_game', 'vote_target'])
     
-    role_babaylan = checkRoleStatus(game=game, role='babaylan')
-    role_manghuhula = checkRoleStatus(game=game, role='manghuhula')
-    
-    if role_babaylan:
-        role = role_babaylan
-    elif role_manghuhula:
-        role = role_manghuhula
-    else:    
-        role = None
-        
-    return role
-
+    return player_role_dict
 
-# checks the alive players' role, since after aswang its either 
-# babaylan or manghuhula, whichever one is alive (can be both)
-def checkRoleStatus(game, role):
-    try: 
-        player = game.players.filter(
-            Q(alive=True) & 
-            Q(eliminated_from_game=False) &
-            Q(role=role)
-        ).first()
-        
-        if role == 'babaylan':
-            if player:
-                return player
-            else:
-                return None
-            
-        elif role == 'manghuhula':
-            if player:
-                return player
-            else:
-                return None
-            
-        else:
-            return None
-    except Exception as e:
-        print(f'error {e}')
-        return None
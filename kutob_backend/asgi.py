@@ -14,13 +14,15 @@ from channels.auth import AuthMiddlewareStack
 from django.core.asgi import get_asgi_application
 
 import game.routing
+from game.engine import RoomEngineHost
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'kutob_backend.settings')
 django_asgi_app = get_asgi_application()
 
-application = ProtocolTypeRouter({
+# with GAME_ENGINE = 'actor' the daphne processes take turns hosting the room engine
+application = RoomEngineHost(ProtocolTypeRouter({
     "http": django_asgi_app,
     'websocket': AuthMiddlewareStack(
         URLRouter(game.routing.websocket_urlpatterns)
     )
-})
+}))
@@ -108,16 +108,87 @@ CELERY_BEAT_SCHEDULE = {
     'delete_inactive_users': {
         'task': "game.tasks.delete_inactive_players",
         "schedule": crontab(minute='*/10') # Execute every 10 mins.
+    },
+    'reap_stale_presence': {
+        'task': "game.tasks.reapStalePresence",
+        "schedule": crontab(minute='*/5')
+    },
+    'redrive_mailboxes': {
+        'task': "game.tasks.redriveMailboxes",
+        "schedule": 30.0 # seconds, the mailbox of a dead worker is free again ROOM_MAILBOX_TTL after its last task
     }
 }
 
 # SESSION_EXPIRE_AT_BROWSER_CLOSE = True
 
+# GAME TIMERS
+
+# 'clock': countdowns of all rooms are driven by the room clock service (python manage.py runroomclock)
+# 'celery': fallback, countdown_timer re-enqueues itself every second
+GAME_TIMER_BACKEND = os.environ.get('GAME_TIMER_BACKEND', 'clock')
+ROOM_CLOCK_CHANNEL = 'room-clock'
+
+# 'ticks': a countdown message is sent to the room every second
+# 'deadline': a single phase_deadline message per phase, clients render the countdown locally
+GAME_COUNTDOWN_MODE = os.environ.get('GAME_COUNTDOWN_MODE', 'ticks')
+
+# every countdown's deadline is also kept in redis, python manage.py runphasedeadlines ends the phases whose
+# countdown got lost (crashed worker or clock) PHASE_DEADLINE_GRACE seconds after their deadline
+PHASE_DEADLINE_GRACE = int(os.environ.get('PHASE_DEADLINE_GRACE', 3))
+PHASE_DEADLINE_POLL_INTERVAL = 1
+
+# the tasks of a room run one at a time through its mailbox (see game/mailbox.py), a worker that died
+# running a room's mailbox gives the room up after ROOM_MAILBOX_TTL seconds
+ROOM_MAILBOX_TTL = 60
+
+# 'celery': the phases and tasks of the rooms run on the celery workers
+# 'actor': every active room is an asyncio actor in one of the daphne processes that runs its tasks, actions and
+# countdowns (see game/engine.py)
+GAME_ENGINE = os.environ.get('GAME_ENGINE', 'celery')
+ROOM_ENGINE_CHANNEL = 'room-engine'
+
+# only one daphne process hosts the rooms at a time, another one takes over this many seconds after it stopped renewing
+ROOM_ENGINE_LEASE_TTL = 10
+
+# seconds a rest game action waits for the room's actor to answer
+ROOM_ENGINE_REPLY_TIMEOUT = 10
+
+# seconds without any work before the actor of a room stops
+GAME_ENGINE_ROOM_IDLE = 60 * 5
+
+# GAME BROADCASTS
+
+# 'loop': sync code sends to the channel layer through one background event loop per process (see game/broadcast.py)
+# 'async_to_sync': an event loop bridge per send
+GAME_BROADCAST_BACKEND = os.environ.get('GAME_BROADCAST_BACKEND', 'loop')
+
+# PLAYER CONNECTIONS
+
+# seconds a disconnected player has to reconnect before they are removed from the game
+PLAYER_RECONNECT_GRACE = int(os.environ.get('PLAYER_RECONNECT_GRACE', 15))
+
+# the server pings every client, a socket that hasn't answered for PLAYER_HEARTBEAT_TIMEOUT seconds is closed
+PLAYER_HEARTBEAT_INTERVAL = 20
+PLAYER_HEARTBEAT_TIMEOUT = 60
+
+# GAME REDIS (presence, turns, timers and game state, see game/services.py)
+
+REDIS_HOST = os.environ.get('REDIS_HOST', 'localhost')
+REDIS_PORT = int(os.environ.get('REDIS_PORT', 6379))
+GAME_REDIS_DB = 1
+
+# per process, shared by every request/task (sync client) and every consumer (asyncio client)
+GAME_REDIS_MAX_CONNECTIONS = int(os.environ.get('GAME_REDIS_MAX_CONNECTIONS', 50))
+
 CHANNEL_LAYERS = {
     "default": {
         "BACKEND": "channels_redis.core.RedisChannelLayer",
         "CONFIG": {
             "hosts": [("redis", 6379)],
+            "channel_capacity": {
+                ROOM_CLOCK_CHANNEL: 10000, # every room starting a countdown at once must not fill the clock channel
+                ROOM_ENGINE_CHANNEL: 10000,
+            },
         },
     },
 }